@@ -1,6 +1,7 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')  
@@ -8,6 +9,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import io
+import sys
 import base64
 import os
 import json
@@ -15,13 +17,31 @@ import re
 from dotenv import load_dotenv
 from werkzeug.exceptions import BadRequest
 import logging
-from functools import wraps
+from functools import wraps, lru_cache
 import random
-import datetime
 import squarify
+import threading
+import contextvars
+import hashlib
+import inspect
+import copy
+import uuid
+import sqlite3
+import queue
+import time
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
 from dateutil import parser as date_parser
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.fs as pa_fs
+except ImportError:  # Arrow and Parquet uploads are optional
+    pa = None
 
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -29,22 +49,121 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# Validate API key exists
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    logger.error("GEMINI_API_KEY environment variable not set")
-    raise ValueError("GEMINI_API_KEY environment variable not set")
+MODEL_NAME = 'gemini-2.0-flash'
 
-# Configure Gemini API 
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel('gemini-2.0-flash')
+def cache_identity(prompt, generation_config=None):
+    """The text cache keys are derived from: the prompt plus any structured-output configuration"""
+    if generation_config is None:
+        return prompt
+    return f"{prompt}\n{json.dumps(generation_config, sort_keys=True)}"
+
+def fixture_key(prompt, generation_config=None):
+    """Name a recorded response by model, prompt and structured-output configuration"""
+    return hashlib.sha256(f"{MODEL_NAME}\n{cache_identity(prompt, generation_config)}".encode('utf-8')).hexdigest()
+
+class GeminiBackend:
+    """Sends prompts to the Gemini API"""
+
+    name = "gemini"
+
+    def __init__(self, model_name, api_key):
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt, generation_config=None, timeout=None):
+        if generation_config is None:
+            response = self.model.generate_content(prompt, request_options={"timeout": timeout})
+        else:
+            response = self.model.generate_content(prompt, generation_config=generation_config, request_options={"timeout": timeout})
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return response.text, {}
+        return response.text, {"prompt_tokens": usage.prompt_token_count, "response_tokens": usage.candidates_token_count}
+
+class RecordingBackend:
+    """Passes calls through to another backend and saves every prompt -> response pair as a fixture"""
+
+    name = "record"
+
+    def __init__(self, inner, fixtures_dir):
+        self.inner = inner
+        self.fixtures_dir = fixtures_dir
+        os.makedirs(fixtures_dir, exist_ok=True)
+
+    def generate(self, prompt, generation_config=None, timeout=None):
+        text, usage = self.inner.generate(prompt, generation_config, timeout)
+        key = fixture_key(prompt, generation_config)
+        path = os.path.join(self.fixtures_dir, f"{key}.json")
+        # Write then rename so concurrent workers never see half a fixture
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"model": MODEL_NAME, "prompt": prompt, "generation_config": generation_config, "text": text, "usage": usage}, f, indent=2)
+        os.replace(temp_path, path)
+        return text, usage
+
+class ReplayBackend:
+    """Serves recorded fixtures instead of calling the API, with optional injected latency"""
+
+    name = "replay"
+
+    def __init__(self, fixtures_dir, latency_ms=0, jitter_ms=0):
+        self.fixtures_dir = fixtures_dir
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        # Fixture keys asked for but not recorded; the pipeline falls back past them, so callers check here
+        self.missing_keys = set()
+
+    def generate(self, prompt, generation_config=None, timeout=None):
+        delay = max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise google_exceptions.DeadlineExceeded(f"Replayed call exceeded its {timeout:.1f}s timeout")
+        time.sleep(delay)
+
+        key = fixture_key(prompt, generation_config)
+        path = os.path.join(self.fixtures_dir, f"{key}.json")
+        try:
+            with open(path, encoding='utf-8') as f:
+                fixture = json.load(f)
+            return fixture["text"], fixture.get("usage") or {}
+        except FileNotFoundError:
+            logger.error(f"No recorded response {key} for prompt starting {prompt.strip()[:80]!r}")
+            self.missing_keys.add(key)
+            raise MissingFixtureError(key, self.fixtures_dir)
+
+# Which backend serves model calls: gemini (default), record (gemini + save fixtures) or replay (fixtures only)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+LLM_FIXTURES_DIR = os.getenv("LLM_FIXTURES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+
+if LLM_BACKEND == "replay":
+    llm_backend = ReplayBackend(
+        LLM_FIXTURES_DIR,
+        latency_ms=float(os.getenv("LLM_REPLAY_LATENCY_MS", "0")),
+        jitter_ms=float(os.getenv("LLM_REPLAY_JITTER_MS", "0"))
+    )
+elif LLM_BACKEND in ("gemini", "record"):
+    # Validate API key exists
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY environment variable not set")
+        raise ValueError("GEMINI_API_KEY environment variable not set")
+
+    # Configure Gemini API
+    llm_backend = GeminiBackend(MODEL_NAME, api_key)
+    if LLM_BACKEND == "record":
+        llm_backend = RecordingBackend(llm_backend, LLM_FIXTURES_DIR)
+else:
+    raise ValueError(f"Unknown LLM_BACKEND '{LLM_BACKEND}', expected gemini, record or replay")
+logger.info(f"Using the {llm_backend.name} LLM backend")
 
 app = Flask(__name__)
+# Uploaded files above 500 KB are spooled to disk by werkzeug, so this bounds disk use rather than memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "512")) * 1024 * 1024
 CORS(app, 
      origins=["https://plott.hitanshu.tech", "http://plott.hitanshu.tech"],
      supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "Accept"],
-     methods=["GET", "POST", "OPTIONS"])
+     allow_headers=["Content-Type", "Authorization", "Accept", "X-Cache-Bypass"],
+     methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"])
 
 # Initialize rate limiter
 limiter = Limiter(
@@ -55,6 +174,18 @@ limiter = Limiter(
     strategy="fixed-window"
 )
 
+# Thread pool for running independent pipeline stages (Gemini calls) concurrently
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "8"))
+stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="pipeline-stage")
+
+# pyplot keeps global figure state, so only one chart may be rendered at a time
+render_lock = threading.Lock()
+
+def submit_stage(fn, *args, **kwargs):
+    """Run a pipeline stage on the stage executor, carrying over the caller's context variables"""
+    ctx = contextvars.copy_context()
+    return stage_executor.submit(ctx.run, fn, *args, **kwargs)
+
 # Custom error class
 class DiagramError(Exception):
     def __init__(self, message, status_code=400):
@@ -79,474 +210,3632 @@ def handle_errors(f):
             return jsonify({"error": "An unexpected error occurred"}), 500
     return decorated_function
 
-def parse_gemini_json(text):
-    """Extract JSON from Gemini response text which might include markdown code blocks"""
-    # Try to extract JSON from code blocks
-    code_block_match = re.search(r'```(?:json)?\s*([\s\S]+?)\s*```', text)
-    if code_block_match:
-        try:
-            return json.loads(code_block_match.group(1))
-        except json.JSONDecodeError:
-            pass
-    
-    # Try the whole text as JSON
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        # Last resort: look for anything that resembles JSON
-        json_like_match = re.search(r'({[\s\S]+})', text)
-        if json_like_match:
-            try:
-                return json.loads(json_like_match.group(1))
-            except json.JSONDecodeError:
-                pass
-    
-    raise DiagramError("Could not extract valid JSON from AI response")
+JSON_LITERALS = {"true": "true", "false": "false", "null": "null",
+                 "True": "true", "False": "false", "None": "null",
+                 "NaN": "null"}
+# A JSON number, checked before a scanned run of digits and signs is copied through as one
+JSON_NUMBER_PATTERN = re.compile(r"-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?")
+JSON_ESCAPES = set('"\\/bfnrtu')
+json_repair_stats = {}
+json_repair_lock = threading.Lock()
+# Opening brackets tried as the start of the payload, so bracketed prose before it such as "see [1]" is skipped
+JSON_START_CANDIDATES = 8
+
+def repair_json_text(text):
+    """Turn almost-JSON from the model into valid JSON text, returning (json_text, repairs)
+
+    Each '{' or '[' not inside an already scanned value is a candidate start, those inside a ```
+    block first. With a single candidate its scan is the answer; otherwise the longest scan that
+    parses wins, so a short bracketed aside before the payload is passed over.
+    """
+    fence = text.find("```")
+    candidates = [match.start() for match in re.finditer(r"[{\[]", text)]
+    if not candidates:
+        raise DiagramError("Could not extract valid JSON from AI response")
+    if fence >= 0:
+        candidates = [i for i in candidates if i > fence] + [i for i in candidates if i < fence]
+
+    scanned = []  # (start, end, json_text, repairs)
+    for start in candidates[:JSON_START_CANDIDATES]:
+        if any(first <= start < end for first, end, _, _ in scanned):
+            continue
+        json_text, repairs, end = scan_json_value(text, start)
+        scanned.append((start, end, json_text, repairs))
+    if len(scanned) == 1:
+        return scanned[0][2], scanned[0][3]
+
+    parseable = [entry for entry in scanned if is_valid_json(entry[2])]
+    chosen = max(parseable or scanned[:1], key=lambda entry: (entry[0] > fence, entry[1] - entry[0]))
+    repairs = chosen[3] if chosen is scanned[0] else sorted(set(chosen[3]) | {"leading_brackets"})
+    return chosen[2], repairs
+
+def is_valid_json(text):
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+def scan_json_value(text, start):
+    """Single-pass, linear-time scan of the bracketed value opening at text[start]
+
+    Stops when its brackets balance. Along the way it drops comments, trailing commas and stray
+    characters, converts single quotes and Python literals, quotes bare keys and values, escapes raw
+    control characters and closes output that was cut off. Returns (json_text, repairs, end), where
+    repairs names each kind of fix applied and end is the index just past the scanned text.
+    """
+    out = []
+    repairs = set()
+    stack = []         # open brackets, innermost last
+    object_state = []  # per open bracket: "key", "colon" or "value" for objects, None for arrays
+    quote = None       # quote character of the string being scanned
+    i = start
+    n = len(text)
+
+    def bare_value_end(j):
+        """End of an unquoted value starting before j: the next comma, closing bracket or line break"""
+        while j < n and text[j] not in ",]}\n":
+            j += 1
+        return j
+
+    def drop_trailing_comma():
+        j = len(out) - 1
+        while j >= 0 and out[j].isspace():
+            j -= 1
+        if j >= 0 and out[j] == ",":
+            del out[j]
+            repairs.add("trailing_commas")
+
+    while i < n:
+        ch = text[i]
+        if quote:
+            if ch == "\\" and i + 1 < n:
+                nxt = text[i + 1]
+                if nxt in JSON_ESCAPES:
+                    out.append(ch + nxt)
+                elif nxt == "'":
+                    out.append("'")
+                else:
+                    out.append("\\\\" + nxt)
+                    repairs.add("invalid_escapes")
+                i += 2
+                continue
+            if ch == quote:
+                out.append('"')
+                quote = None
+                if object_state and object_state[-1] == "key":
+                    object_state[-1] = "colon"
+            elif ch == '"':
+                out.append('\\"')
+            elif ch < " ":
+                out.append({"\n": "\\n", "\r": "\\r", "\t": "\\t"}.get(ch, " "))
+                repairs.add("control_characters")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in "\"'":
+            if ch == "'":
+                repairs.add("single_quotes")
+            quote = ch
+            out.append('"')
+        elif ch == "/" and text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            repairs.add("comments")
+            continue
+        elif ch == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            repairs.add("comments")
+            continue
+        elif ch == "#":
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            repairs.add("comments")
+            continue
+        elif ch in "{[":
+            stack.append(ch)
+            object_state.append("key" if ch == "{" else None)
+            out.append(ch)
+        elif ch in "}]":
+            if not stack:
+                break
+            drop_trailing_comma()
+            expected = "}" if stack[-1] == "{" else "]"
+            if ch != expected:
+                repairs.add("mismatched_brackets")
+            if object_state[-1] == "colon":
+                out.append(": null")
+                repairs.add("missing_values")
+            stack.pop()
+            object_state.pop()
+            out.append(expected)
+            if not stack:
+                break
+        elif ch == ",":
+            drop_trailing_comma()
+            out.append(ch)
+            if object_state and object_state[-1] is not None:
+                object_state[-1] = "key"
+        elif ch == ":":
+            out.append(ch)
+            if object_state and object_state[-1] is not None:
+                object_state[-1] = "value"
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] in "_-$"):
+                j += 1
+            word = text[i:j]
+            if object_state and object_state[-1] == "key":
+                out.append(json.dumps(word))
+                object_state[-1] = "colon"
+                repairs.add("unquoted_keys")
+            elif word in JSON_LITERALS and not text[j:bare_value_end(j)].strip():
+                out.append(JSON_LITERALS[word])
+                if word != JSON_LITERALS[word]:
+                    repairs.add("python_literals")
+            else:
+                # Unquoted strings such as [Jan, Feb] or New York
+                j = bare_value_end(j)
+                out.append(json.dumps(text[i:j].rstrip()))
+                repairs.add("bare_values")
+            i = j
+            continue
+        elif ch.isdigit() or ch in "-+.":
+            j = i
+            while j < n and (text[j].isdigit() or text[j] in "-+.eE"):
+                j += 1
+            sign = "-" if ch == "-" else ""
+            number = text[i:j].lstrip("+-")
+            if not number and not (j < n and text[j].isalpha()):
+                repairs.add("stray_characters")
+                i = j
+                continue
+            if number.startswith("."):
+                number = "0" + number
+            if number.endswith("."):
+                number += "0"
+            if not JSON_NUMBER_PATTERN.fullmatch(sign + number) or (j < n and (text[j].isalnum() or text[j] in "_/:")):
+                # Not a number after all: ranges such as 1-5, dates, 10am
+                j = bare_value_end(j)
+                out.append(json.dumps(text[i:j].rstrip()))
+                repairs.add("bare_values")
+                i = j
+                continue
+            if sign + number != text[i:j]:
+                repairs.add("number_formats")
+            out.append(sign + number)
+            i = j
+            continue
+        elif ch.isspace():
+            out.append(ch)
+        else:
+            repairs.add("stray_characters")
+        i += 1
+
+    # Output cut off before the brackets balanced: close what is still open
+    if quote or stack:
+        repairs.add("truncated")
+    if quote:
+        out.append('"')
+        if object_state and object_state[-1] == "key":
+            object_state[-1] = "colon"
+    if stack:
+        drop_trailing_comma()
+        if object_state[-1] == "colon":
+            out.append(": null")
+        elif object_state[-1] == "value" and "".join(out[-2:]).rstrip().endswith(":"):
+            out.append(" null")
+    # The loop breaks on the bracket that balanced the value, or runs off the end of the text
+    end = min(i + 1, n)
+    while stack:
+        drop_trailing_comma()
+        out.append("}" if stack.pop() == "{" else "]")
+        object_state.pop()
+
+    return "".join(out), sorted(repairs), end
+
+def parse_gemini_json_with_repairs(text):
+    """Parse JSON from a Gemini response, returning (value, repairs applied)"""
+    repaired_text, repairs = repair_json_text(text)
+    try:
+        value = json.loads(repaired_text)
+    except json.JSONDecodeError:
+        raise DiagramError("Could not extract valid JSON from AI response")
+    if repairs:
+        with json_repair_lock:
+            for repair in repairs:
+                json_repair_stats[repair] = json_repair_stats.get(repair, 0) + 1
+    return value, repairs
+
+def parse_gemini_json(text):
+    """Extract JSON from Gemini response text which might include markdown code blocks"""
+    value, repairs = parse_gemini_json_with_repairs(text)
+    if repairs:
+        logger.info(f"Repaired AI JSON response: {', '.join(repairs)}")
+    return value
+
+class MissingFixtureError(DiagramError):
+    """The replay backend has no recorded response for a prompt; a setup problem, not an upstream failure"""
+    def __init__(self, key, fixtures_dir):
+        super().__init__(f"No recorded model response {key} in {fixtures_dir}; record one with LLM_BACKEND=record", 500)
+        self.key = key
+
+class ModelUnavailableError(DiagramError):
+    """The model can't be called right now: request budget exhausted, call timed out or circuit open"""
+    def __init__(self, message):
+        super().__init__(message, status_code=503)
+
+class RequestCancelledError(DiagramError):
+    """The client went away, so the rest of the pipeline isn't worth its model calls or render time"""
+    def __init__(self):
+        super().__init__("The request was cancelled", status_code=499)
+
+class RequestBudget:
+    """End-to-end deadline for one diagram request, split into per-stage caps"""
+
+    def __init__(self, total_seconds, cancelled=None):
+        self.total_seconds = total_seconds
+        self.deadline = time.monotonic() + total_seconds
+        self.cancelled = cancelled or threading.Event()
+        self.degradations = []
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        if self.cancelled.is_set():
+            return 0.0
+        return max(0.0, self.deadline - time.monotonic())
+
+    def stage_timeout(self, stage):
+        """Seconds a model call for this stage may take: its share of the budget, capped by what's left"""
+        return min(self.remaining(), self.total_seconds * STAGE_BUDGET_FRACTIONS.get(stage, 0.3))
+
+    def degrade(self, name):
+        with self.lock:
+            if name not in self.degradations:
+                logger.warning(f"Degrading request: {name} ({self.remaining():.1f}s of budget left)")
+                self.degradations.append(name)
+
+class CircuitBreaker:
+    """Fails model calls fast after repeated upstream errors, letting one trial call through after a cool-down"""
+
+    def __init__(self, failure_threshold, reset_timeout_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def is_open(self):
+        with self.lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout_seconds
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout_seconds:
+                    self.stats["rejected"] += 1
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.trial_in_flight:
+                    self.stats["rejected"] += 1
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """End a call that says nothing about upstream health, freeing the half-open trial slot"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.error(f"Opening model circuit breaker after {self.consecutive_failures} consecutive failures")
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, state=self.state, consecutive_failures=self.consecutive_failures)
+
+# Total time one diagram request may spend; keep it under gunicorn's 30 s worker timeout
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "25"))
+# Timeout for model calls made outside a diagram request (e.g. prompt enhancement)
+MODEL_CALL_TIMEOUT_SECONDS = float(os.getenv("MODEL_CALL_TIMEOUT_SECONDS", "20"))
+# Don't start a model call with less time than this left
+MIN_MODEL_CALL_SECONDS = float(os.getenv("MIN_MODEL_CALL_SECONDS", "1.5"))
+# Below these amounts of remaining budget, run fewer chart chains or only the fallback chart
+FULL_CHARTS_MIN_SECONDS = float(os.getenv("FULL_CHARTS_MIN_SECONDS", "10"))
+CHART_CHAIN_MIN_SECONDS = float(os.getenv("CHART_CHAIN_MIN_SECONDS", "4"))
+# Largest share of the whole budget a single model call of each stage may use
+STAGE_BUDGET_FRACTIONS = {
+    "recommendation": 0.35,
+    "parse": 0.35,
+    "extraction": 0.3,
+    "data_generation": 0.3,
+    "fallback": 0.2
+}
+# Upstream errors that mean "try again later" rather than a bad request
+MODEL_UNAVAILABLE_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    TimeoutError
+)
+# Errors that say the model is unhealthy and count toward opening the breaker; bad requests and blocked
+# content are the caller's problem and don't
+MODEL_HEALTH_ERRORS = MODEL_UNAVAILABLE_ERRORS + (google_exceptions.ServerError, ConnectionError)
+
+request_budget = contextvars.ContextVar("request_budget", default=None)
+model_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5")),
+    reset_timeout_seconds=float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+)
+
+def note_degradation(name):
+    """Record a degradation on the current request's budget, if there is one"""
+    budget = request_budget.get()
+    if budget is not None:
+        budget.degrade(name)
+
+def raise_if_cancelled():
+    """Stop the current request's pipeline if its client has gone away"""
+    budget = request_budget.get()
+    if budget is not None and budget.cancelled.is_set():
+        raise RequestCancelledError()
+
+class ResponseCache:
+    """Thread-safe in-process LRU cache with per-entry TTL and per-stage hit/miss counters"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.stage_stats = {}
+
+    @staticmethod
+    def make_key(model_name, prompt):
+        return hashlib.sha256(f"{model_name}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def record(self, stage, outcome):
+        counters = self.stage_stats.setdefault(stage, {"hits": 0, "misses": 0, "bypassed": 0})
+        counters[outcome] += 1
+
+    def get(self, key, stage):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                # Expired entries count as misses and are dropped right away
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.record(stage, "misses")
+                return None
+            self.entries.move_to_end(key)
+            self.record(stage, "hits")
+            return entry[1]
+
+    def set(self, key, value, ttl_seconds):
+        if self.max_entries <= 0 or ttl_seconds <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "evictions": self.evictions,
+                "hits": sum(c["hits"] for c in self.stage_stats.values()),
+                "misses": sum(c["misses"] for c in self.stage_stats.values()),
+                "stages": {stage: dict(counters) for stage, counters in self.stage_stats.items()}
+            }
+
+# Default TTL (seconds) per pipeline stage; override with RESPONSE_CACHE_TTL_<STAGE>
+RESPONSE_CACHE_TTLS = {
+    "recommendation": 3600,
+    "parse": 3600,
+    "extraction": 3600,
+    "data_generation": 1800,
+    "fallback": 600,
+    "enhance": 600
+}
+for stage_name in RESPONSE_CACHE_TTLS:
+    RESPONSE_CACHE_TTLS[stage_name] = int(os.getenv(f"RESPONSE_CACHE_TTL_{stage_name.upper()}", RESPONSE_CACHE_TTLS[stage_name]))
+
+response_cache = ResponseCache(max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512")))
+
+# Set per request from the X-Cache-Bypass header; copied into stage threads by submit_stage
+cache_bypass = contextvars.ContextVar("cache_bypass", default=False)
+
+def wants_cache_bypass():
+    """Whether the current request asked to skip cached model responses"""
+    if request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("Cache-Control", "").lower()
+
+def request_flag(name):
+    """Read a boolean option from the JSON body, or from the form fields of a multipart upload"""
+    value = (request.get_json(silent=True) or request.form).get(name)
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+def wants_timings():
+    """Whether the current request asked for the timings block in its response"""
+    if request_flag("include_timings"):
+        return True
+    return request.args.get("timings", "").lower() in ("1", "true", "yes")
+
+def wants_spec_only():
+    """Whether the current request asked for chart specs only, with images rendered on demand"""
+    return request_flag("spec_only")
+
+class RequestTimings:
+    """Stage timings and model call accounting collected over one diagram request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+        self.model_calls = []
+        self.lock = threading.Lock()
+
+    def add(self, kind, entry):
+        with self.lock:
+            getattr(self, kind).append(entry)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "total_seconds": round(time.perf_counter() - self.started, 4),
+                "stages": list(self.stages),
+                "model_calls": list(self.model_calls)
+            }
+
+class TimingStats:
+    """Process-wide per-stage latency and prompt/response size totals"""
+
+    def __init__(self):
+        self.stages = {}
+        self.model_calls = {}
+        self.lock = threading.Lock()
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            totals["count"] += 1
+            totals["total_seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+
+    def record_model_call(self, entry):
+        with self.lock:
+            totals = self.model_calls.setdefault(entry["stage"], {
+                "calls": 0, "model": 0, "memory_cache": 0, "disk_cache": 0, "error": 0,
+                "total_seconds": 0.0, "max_seconds": 0.0, "prompt_chars": 0, "max_prompt_chars": 0,
+                "response_chars": 0, "prompt_tokens": 0, "response_tokens": 0
+            })
+            totals["calls"] += 1
+            totals[entry["source"]] += 1
+            totals["total_seconds"] += entry["seconds"]
+            totals["max_seconds"] = max(totals["max_seconds"], entry["seconds"])
+            totals["prompt_chars"] += entry["prompt_chars"]
+            totals["max_prompt_chars"] = max(totals["max_prompt_chars"], entry["prompt_chars"])
+            totals["response_chars"] += entry["response_chars"] or 0
+            totals["prompt_tokens"] += entry["prompt_tokens"] or 0
+            totals["response_tokens"] += entry["response_tokens"] or 0
+
+    def get_stats(self):
+        with self.lock:
+            stages = {
+                stage: {"count": t["count"], "mean_seconds": round(t["total_seconds"] / t["count"], 4),
+                        "max_seconds": round(t["max_seconds"], 4)}
+                for stage, t in self.stages.items()
+            }
+            model_calls = {}
+            for stage, t in self.model_calls.items():
+                model_calls[stage] = dict(
+                    t,
+                    total_seconds=round(t["total_seconds"], 4),
+                    max_seconds=round(t["max_seconds"], 4),
+                    mean_seconds=round(t["total_seconds"] / t["calls"], 4),
+                    mean_prompt_chars=round(t["prompt_chars"] / t["calls"])
+                )
+            return {"stages": stages, "model_calls": model_calls}
+
+# Set per diagram request by run_diagram_pipeline; copied into stage threads by submit_stage
+request_timings = contextvars.ContextVar("request_timings", default=None)
+# Chart type the current stage thread is working on, so its timings can be told apart
+timing_chart_type = contextvars.ContextVar("timing_chart_type", default=None)
+timing_stats = TimingStats()
+
+def record_stage_timing(stage, seconds):
+    """Add one stage's duration to the current request's timings and the process-wide totals"""
+    timing_stats.record_stage(stage, seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add("stages", {"stage": stage, "chart_type": timing_chart_type.get(), "seconds": round(seconds, 4)})
+
+def record_model_call(stage, seconds, source, prompt, text, usage=None):
+    """Account for one model call (or the cache lookup that answered it) and its prompt/response sizes"""
+    usage = usage or {}
+    entry = {
+        "stage": stage,
+        "chart_type": timing_chart_type.get(),
+        "source": source,
+        "seconds": round(seconds, 4),
+        "prompt_chars": len(prompt),
+        "response_chars": len(text) if text is not None else None,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "response_tokens": usage.get("response_tokens")
+    }
+    timing_stats.record_model_call(entry)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add("model_calls", entry)
+    if source == "model":
+        logger.info(f"[{stage}] Model call took {seconds:.2f}s: {entry['prompt_chars']} prompt chars / "
+                    f"{entry['prompt_tokens']} tokens, {entry['response_chars']} response chars / {entry['response_tokens']} tokens")
+
+def timed(stage):
+    """Decorator recording how long each call of the wrapped pipeline stage takes"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record_stage_timing(stage, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def generate_model_text(prompt, stage, generation_config=None):
+    """Call Gemini through the response cache and return the response text"""
+    started = time.perf_counter()
+    key = ResponseCache.make_key(MODEL_NAME, cache_identity(prompt, generation_config))
+    if cache_bypass.get():
+        response_cache.record(stage, "bypassed")
+    else:
+        cached_text = response_cache.get(key, stage)
+        if cached_text is not None:
+            logger.info(f"[{stage}] Serving model response from cache")
+            record_model_call(stage, time.perf_counter() - started, "memory_cache", prompt, cached_text)
+            return cached_text
+
+    raise_if_cancelled()
+    budget = request_budget.get()
+    if budget is not None:
+        timeout = budget.stage_timeout(stage)
+        if timeout < MIN_MODEL_CALL_SECONDS:
+            raise ModelUnavailableError(f"Not enough time left in the request budget for the {stage} stage")
+    else:
+        timeout = MODEL_CALL_TIMEOUT_SECONDS
+    if not model_breaker.allow_request():
+        raise ModelUnavailableError("The AI model is temporarily unavailable, please try again shortly")
+
+    try:
+        text, usage = llm_backend.generate(prompt, generation_config, timeout)
+    except Exception as e:
+        record_model_call(stage, time.perf_counter() - started, "error", prompt, None)
+        if isinstance(e, MODEL_HEALTH_ERRORS):
+            model_breaker.record_failure()
+        else:
+            # e.g. a missing replay fixture or an invalid argument: free a half-open trial without judging it
+            model_breaker.release_trial()
+        if isinstance(e, MODEL_UNAVAILABLE_ERRORS) or (budget is not None and budget.remaining() <= 0):
+            raise ModelUnavailableError(f"The {stage} model call did not complete in time: {str(e)}") from e
+        raise
+    model_breaker.record_success()
+    record_model_call(stage, time.perf_counter() - started, "model", prompt, text, usage)
+
+    response_cache.set(key, text, RESPONSE_CACHE_TTLS.get(stage, 600))
+    return text
+
+# Hits whose access time waits for the next write; past this many, further hits go unrecorded until then
+DISK_CACHE_MAX_PENDING_TOUCHES = 1000
+
+class DiskResponseCache:
+    """SQLite-backed cache of parsed stage outputs, shared by all gunicorn workers on the host"""
+
+    def __init__(self, path, max_bytes, schema_version):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.schema_version = schema_version
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "errors": 0}
+        # Access times of hits, written with the next set() so reads never take the write lock
+        self.pending_touches = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stage_cache (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                schema_version INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS stage_cache_last_access ON stage_cache (last_access)")
+        # Entries written by older prompt templates or parsers may hold outdated shapes
+        deleted = conn.execute("DELETE FROM stage_cache WHERE schema_version != ?", (schema_version,)).rowcount
+        if deleted:
+            logger.info(f"Disk cache dropped {deleted} entries from older schema versions")
+
+    def connection(self):
+        """One connection per thread; WAL mode lets several processes read while one writes"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def make_key(self, stage, prompt):
+        return hashlib.sha256(f"{self.schema_version}\n{stage}\n{MODEL_NAME}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, stage, prompt):
+        key = self.make_key(stage, prompt)
+        try:
+            conn = self.connection()
+            row = conn.execute("SELECT value FROM stage_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.count("misses")
+                return None
+            value = json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"Disk cache read failed: {str(e)}")
+            self.count("errors")
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+            if len(self.pending_touches) < DISK_CACHE_MAX_PENDING_TOUCHES:
+                self.pending_touches[key] = time.time()
+        return value
+
+    def set(self, stage, prompt, value):
+        key = self.make_key(stage, prompt)
+        payload = json.dumps(value)
+        now = time.time()
+        try:
+            conn = self.connection()
+            # BEGIN IMMEDIATE takes the write lock up front so concurrent workers queue instead of deadlocking
+            conn.execute("BEGIN IMMEDIATE")
+            with self.lock:
+                touches, self.pending_touches = self.pending_touches, {}
+            try:
+                conn.executemany("UPDATE stage_cache SET last_access = ? WHERE key = ?",
+                                 [(accessed, touched) for touched, accessed in touches.items()])
+                conn.execute(
+                    "INSERT OR REPLACE INTO stage_cache (key, stage, schema_version, value, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, stage, self.schema_version, payload, len(payload), now, now)
+                )
+                self.evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.count("writes")
+        except sqlite3.Error as e:
+            logger.warning(f"Disk cache write failed: {str(e)}")
+            self.count("errors")
+
+    def evict(self, conn):
+        """Drop least recently used entries until the store is back under its size budget"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM stage_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM stage_cache ORDER BY last_access ASC").fetchall():
+            if total <= target:
+                break
+            conn.execute("DELETE FROM stage_cache WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.stats["evictions"] += evicted
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        try:
+            entries, total = self.connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM stage_cache").fetchone()
+            stats.update({"entries": entries, "bytes": total})
+        except sqlite3.Error:
+            pass
+        stats.update({"max_bytes": self.max_bytes, "schema_version": self.schema_version})
+        return stats
+
+# Stages whose parsed JSON output is persisted across restarts
+DISK_CACHE_STAGES = {"recommendation", "parse", "extraction", "data_generation"}
+# The disk cache itself is opened once the prompt builders it is versioned by are defined, after generate_fallback_chart
+disk_cache = None
+
+# Words that don't change what a chart request means
+FILLER_WORDS = {"a", "an", "the", "please", "kindly", "just", "me", "can", "could", "would",
+                "you", "my", "our", "some", "really", "very", "quick", "simple", "nice"}
+# Numbers (with optional decimals/percent) and quoted values must match exactly to reuse a result
+EXACT_VALUE_PATTERN = re.compile(r'"[^"]*"|(?<!\w)\'[^\']*\'(?!\w)|[-+]?\w*\d(?:[\w%]|[.,]\d)*')
+
+class NearDuplicateCache:
+    """MinHash/LSH index over normalized prompts for reusing stage results of near-identical requests"""
+
+    # (a * h + b) mod p with a, b, h below 2**31 - 1 can't overflow uint64
+    MERSENNE_PRIME = (1 << 31) - 1
+
+    def __init__(self, max_entries, threshold, num_perm=64, bands=16, shingle_size=2):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(1)
+        self.perm_a = rng.randint(1, self.MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.perm_b = rng.randint(0, self.MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.entries = OrderedDict()  # normalized prompt hash -> {"signature", "shingles", "exact_values", "results"}
+        self.buckets = [dict() for _ in range(bands)]
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "exact_hits": 0, "misses": 0, "evictions": 0}
+
+    def normalize(self, prompt):
+        """Return (word list, exact values) for a prompt, ignoring case, punctuation and filler words"""
+        exact_values = tuple(EXACT_VALUE_PATTERN.findall(prompt.lower()))
+        text = EXACT_VALUE_PATTERN.sub(" ", prompt.lower())
+        words = [w for w in re.findall(r"[a-z0-9_]+", text) if w not in FILLER_WORDS]
+        return words, exact_values
+
+    def shingles(self, words):
+        if len(words) < self.shingle_size:
+            return frozenset([" ".join(words)])
+        return frozenset(" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1))
+
+    def signature(self, shingles):
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little') % self.MERSENNE_PRIME
+             for s in shingles],
+            dtype=np.uint64
+        )
+        permuted = (np.outer(self.perm_a, hashes) + self.perm_b[:, None]) % np.uint64(self.MERSENNE_PRIME)
+        return permuted.min(axis=1)
+
+    def band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def prepare(self, prompt):
+        words, exact_values = self.normalize(prompt)
+        key = hashlib.sha256(" ".join(words).encode('utf-8') + repr(exact_values).encode('utf-8')).hexdigest()
+        return key, words, exact_values
+
+    def lookup(self, prompt, stage):
+        """Return a copy of the stage result stored for the most similar earlier prompt, or None"""
+        key, words, exact_values = self.prepare(prompt)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and stage in entry["results"]:
+                self.entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return copy.deepcopy(entry["results"][stage])
+
+        shingles = self.shingles(words)
+        signature = self.signature(shingles)
+        with self.lock:
+            candidates = set()
+            for band, band_key in enumerate(self.band_keys(signature)):
+                candidates.update(self.buckets[band].get(band_key, ()))
+            best_key, best_similarity = None, 0.0
+            for candidate_key in candidates:
+                candidate = self.entries[candidate_key]
+                # Never reuse a result computed for different numbers or quoted values
+                if candidate["exact_values"] != exact_values or stage not in candidate["results"]:
+                    continue
+                # LSH only finds candidates; whether one is close enough is decided on the exact Jaccard similarity
+                similarity = len(candidate["shingles"] & shingles) / len(candidate["shingles"] | shingles)
+                if similarity > best_similarity:
+                    best_key, best_similarity = candidate_key, similarity
+            if best_key is None or best_similarity < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(best_key)
+            self.stats["hits"] += 1
+            logger.info(f"[{stage}] Reusing result of a near-duplicate prompt (similarity {best_similarity:.2f})")
+            return copy.deepcopy(self.entries[best_key]["results"][stage])
+
+    def store(self, prompt, stage, value):
+        if self.max_entries <= 0:
+            return
+        key, words, exact_values = self.prepare(prompt)
+        shingles = self.shingles(words)
+        signature = self.signature(shingles)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {"signature": signature, "shingles": shingles, "exact_values": exact_values, "results": {}}
+                self.entries[key] = entry
+                for band, band_key in enumerate(self.band_keys(signature)):
+                    self.buckets[band].setdefault(band_key, set()).add(key)
+            entry["results"][stage] = copy.deepcopy(value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                for band, band_key in enumerate(self.band_keys(evicted["signature"])):
+                    bucket = self.buckets[band].get(band_key)
+                    if bucket is not None:
+                        bucket.discard(evicted_key)
+                        if not bucket:
+                            del self.buckets[band][band_key]
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), max_entries=self.max_entries, threshold=self.threshold)
+
+near_duplicate_cache = NearDuplicateCache(
+    max_entries=int(os.getenv("NEAR_DUPLICATE_CACHE_MAX_ENTRIES", "1000")),
+    threshold=float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+)
+
+def generate_model_json(prompt, stage, generation_config=None):
+    """Call Gemini through the in-process and on-disk caches and parse the JSON answer"""
+    use_disk_cache = disk_cache is not None and stage in DISK_CACHE_STAGES
+    if use_disk_cache and not cache_bypass.get():
+        started = time.perf_counter()
+        cached_value = disk_cache.get(stage, cache_identity(prompt, generation_config))
+        if cached_value is not None:
+            logger.info(f"[{stage}] Serving parsed output from disk cache")
+            record_model_call(stage, time.perf_counter() - started, "disk_cache", prompt, None)
+            return cached_value
+
+    text = generate_model_text(prompt, stage, generation_config)
+    try:
+        parsed = parse_gemini_json(text)
+    except DiagramError:
+        # Never keep serving an answer we can't parse
+        response_cache.discard(ResponseCache.make_key(MODEL_NAME, cache_identity(prompt, generation_config)))
+        raise
+
+    if use_disk_cache:
+        disk_cache.set(stage, cache_identity(prompt, generation_config), parsed)
+    return parsed
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify({"status": "healthy"}), 200
+
+@app.route('/cors-test', methods=['GET', 'OPTIONS'])
+def cors_test():
+    return jsonify({
+        "status": "success",
+        "message": "CORS is properly configured",
+        "cors_config": {
+            "allowed_origins": ["https://plott.hitanshu.tech", "http://plott.hitanshu.tech"],
+            "allowed_methods": ["GET", "POST", "PATCH", "DELETE", "OPTIONS"],
+            "allowed_headers": ["Content-Type", "Authorization", "Accept", "X-Cache-Bypass"],
+            "supports_credentials": True
+        }
+    }), 200
+
+# Numbers as users type them: 1,200 / 3.5 / $40 / 25%
+INLINE_NUMBER = r"[-+]?\$?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+# A year standing in for a label when a value follows it: "1990 10", "in 2019 were 1,200"
+INLINE_YEAR_LABEL = r"(?:1\d|20)\d{2}(?=\s+(?:(?:was|were|is)\s+)?[-+$]?\d)"
+# "Q1 120", "Apple: 40%", "2019 = 1,200", "2019 1,200" at the end of a comma/semicolon/newline separated item
+INLINE_ITEM_PATTERN = re.compile(
+    r"(?:^|\s)(?:and\s+|or\s+)?(?:in\s+)?"
+    r"(?P<label>[A-Za-z][\w&'/.-]*(?:\s+[A-Za-z0-9][\w&'/.-]*){0,3}?|\d[\w/.-]*(?=\s*[:=])|"
+    + INLINE_YEAR_LABEL + r")"
+    r"\s*[:=]?\s*(?:(?:was|were|is)\s+)?(?P<value>" + INLINE_NUMBER + r")(?P<percent>%?)\s*[.!]?\s*$"
+)
+INLINE_ITEM_SEPARATOR = re.compile(r",(?!\d{3}\b)|;|\n")
+# Prompts whose inline data is longer than this send a short summary to the recommendation and parse stages
+INLINE_DATA_CONDENSE_CHARS = int(os.getenv("INLINE_DATA_CONDENSE_CHARS", "200"))
+
+def parse_inline_number(text):
+    try:
+        return float(text.replace(",", "").replace("$", ""))
+    except ValueError:
+        return None
+
+def table_from_rows(rows):
+    """Turn rows of cells into labels plus numeric series; the first row is a header if it isn't numeric"""
+    width = len(rows[0])
+    if width < 2 or any(len(row) != width for row in rows):
+        return None
+    header = None
+    if sum(parse_inline_number(cell) is not None for cell in rows[0][1:]) == 0 and len(rows) > 2:
+        header, rows = rows[0], rows[1:]
+    numeric_columns = [
+        column for column in range(width)
+        if all(parse_inline_number(row[column]) is not None for row in rows)
+    ]
+    first_is_label = 0 not in numeric_columns
+    series_columns = [column for column in numeric_columns if column > 0 or not first_is_label]
+    if first_is_label and not series_columns:
+        return None
+    if not first_is_label and len(series_columns) > 1:
+        # All-numeric table: the first column is the x value
+        series_columns = series_columns[1:]
+    return {
+        "label_name": header[0] if header else None,
+        "labels": [row[0] for row in rows],
+        "series": OrderedDict(
+            (header[column] if header else f"Series {i + 1}", [parse_inline_number(row[column]) for row in rows])
+            for i, column in enumerate(series_columns)
+        ),
+        "percent": False
+    }
+
+def find_inline_table(user_prompt):
+    """Find a markdown table or a delimited (CSV/TSV) block of at least two data rows"""
+    lines = user_prompt.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    # Markdown: consecutive |-delimited lines, skipping the --- separator row
+    start = None
+    for i, line in enumerate(lines + [""]):
+        if line.strip().startswith("|") and line.strip().endswith("|") and len(line.strip()) > 1:
+            if start is None:
+                start = i
+            continue
+        if start is not None and i - start >= 3:
+            rows = [[cell.strip() for cell in l.strip().strip("|").split("|")]
+                    for l in lines[start:i] if not re.match(r"^[\s|:-]+$", l)]
+            table = table_from_rows(rows)
+            if table:
+                table["span"] = (offsets[start], offsets[i])
+                return table
+        start = None
+
+    # Delimited: consecutive lines with the same number of commas, tabs or semicolons
+    for delimiter in ("\t", ";", ","):
+        start = None
+        for i, line in enumerate(lines + [""]):
+            count = line.count(delimiter)
+            if count >= 1 and (start is None or count == lines[start].count(delimiter)):
+                if start is None:
+                    start = i
+                continue
+            if start is not None and i - start >= 3:
+                rows = [[cell.strip() for cell in l.strip().split(delimiter)] for l in lines[start:i]]
+                table = table_from_rows(rows)
+                if table:
+                    table["span"] = (offsets[start], offsets[i])
+                    return table
+            start = i if count >= 1 else None
+    return None
+
+def find_inline_pairs(user_prompt):
+    """Find the longest run of "label value" items such as "Q1 120, Q2 135, Q3 150" """
+    items = []
+    position = 0
+    for match in INLINE_ITEM_SEPARATOR.finditer(user_prompt + "\n"):
+        items.append((position, match.start()))
+        position = match.end()
+
+    best, run = [], []
+    for start, end in items:
+        segment = user_prompt[start:end]
+        match = INLINE_ITEM_PATTERN.search(segment)
+        # Only the first item of a run may carry leading text ("Monthly revenue: Jan 120")
+        if match and (not run or not segment[:match.start()].strip()):
+            run.append((start + match.start("label"), start + match.end(), match))
+        elif match:
+            run = [(start + match.start("label"), start + match.end(), match)]
+        else:
+            run = []
+        if len(run) > len(best):
+            best = list(run)
+
+    labels = [m.group("label").strip() for _, _, m in best]
+    # Two values keyed by years ("in 2019 were 1,200, in 2020 1,500") are already a series
+    if len(best) < 3 and not (len(best) == 2 and all(re.fullmatch(r"(?:1\d|20)\d{2}", label.split()[-1]) for label in labels)):
+        return None
+
+    span_start = best[0][0]
+    # The first label may have swallowed leading words ("Market share Apple"); trim it to the others' length
+    label_words = max(len(label.split()) for label in labels[1:])
+    first_words = list(re.finditer(r"\S+", labels[0]))
+    if len(first_words) > label_words:
+        offset = first_words[-label_words].start()
+        labels[0] = labels[0][offset:]
+        span_start += offset
+
+    return {
+        "label_name": None,
+        "labels": labels,
+        "series": OrderedDict([("Values", [parse_inline_number(m.group("value")) for _, _, m in best])]),
+        "percent": all(m.group("percent") for _, _, m in best),
+        "span": (span_start, best[-1][1])
+    }
+
+@lru_cache(maxsize=128)
+def extract_inline_data(user_prompt):
+    """Deterministically parse data pasted into the prompt (table, CSV block or label/value list)"""
+    return find_inline_table(user_prompt) or find_inline_pairs(user_prompt)
+
+def build_local_chart_data(chart_type, table):
+    """Map an inline table onto the fields generate_chart_image expects for this chart type, or None"""
+    labels = list(table["labels"])
+    names = list(table["series"].keys())
+    series = [list(values) for values in table["series"].values()]
+    first = series[0]
+
+    if chart_type in ("bar", "line", "area"):
+        return {"x_values": labels, "y_values": first}
+    if chart_type == "pie":
+        return {"labels": labels, "sizes": first}
+    if chart_type == "treemap":
+        return {"labels": labels, "sizes": first}
+    if chart_type == "funnel":
+        return {"stages": labels, "values": first}
+    if chart_type == "radar":
+        return {"categories": labels, "values": first}
+    if chart_type == "histogram":
+        return {"y_values": [value for values in series for value in values]}
+    if chart_type == "scatter":
+        x_numeric = [parse_inline_number(str(label)) for label in labels]
+        if len(series) >= 2:
+            return {"x_values": series[0], "y_values": series[1]}
+        if all(x is not None for x in x_numeric):
+            return {"x_values": x_numeric, "y_values": first}
+        return None
+    if chart_type == "bubble" and len(series) >= 3:
+        return {"x_values": series[0], "y_values": series[1], "sizes": series[2]}
+    if chart_type == "heatmap" and len(series) >= 2:
+        return {"x_values": names, "y_values": labels, "z_values": [list(row) for row in zip(*series)]}
+    if chart_type in ("boxplot", "violin") and len(series) >= 2:
+        return {"x_values": names, "distributions": series}
+    if chart_type == "stacked_bar" and len(series) >= 2:
+        return {
+            "x_values": [label for _ in names for label in labels],
+            "y_values": [value for values in series for value in values],
+            "groups": [name for name in names for _ in labels]
+        }
+    return None
+
+def condense_inline_data(user_prompt):
+    """Replace large inline data with a short summary for stages that only need its shape"""
+    table = extract_inline_data(user_prompt)
+    if not table:
+        return user_prompt
+    start, end = table["span"]
+    if end - start <= INLINE_DATA_CONDENSE_CHARS:
+        return user_prompt
+    preview = ", ".join(f"{label}={table['series'][next(iter(table['series']))][i]:g}" for i, label in enumerate(table["labels"][:3]))
+    columns = ", ".join(([table["label_name"]] if table["label_name"] else []) + list(table["series"].keys()))
+    summary = f"[inline data: {len(table['labels'])} rows; columns: {columns}; e.g. {preview}, ...]"
+    return user_prompt[:start] + summary + user_prompt[end:]
+
+# Uploaded tables are read this many rows at a time, so memory stays bounded for very large files
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "100000"))
+# Distinct labels tracked per grouping before the rest are folded into "Other"
+UPLOAD_MAX_GROUPS = int(os.getenv("UPLOAD_MAX_GROUPS", "10000"))
+# Most categories shown by a chart built from uploaded data
+UPLOAD_MAX_CATEGORIES = int(os.getenv("UPLOAD_MAX_CATEGORIES", "25"))
+# Most points of a line/area chart built from uploaded data
+UPLOAD_MAX_SERIES_POINTS = int(os.getenv("UPLOAD_MAX_SERIES_POINTS", "5000"))
+UPLOAD_SAMPLE_ROWS = int(os.getenv("UPLOAD_SAMPLE_ROWS", "2000"))
+# Points kept for scatter/bubble charts of uploaded data; above DENSITY_POINT_THRESHOLD so large uploads are drawn binned
+UPLOAD_SCATTER_POINTS = int(os.getenv("UPLOAD_SCATTER_POINTS", "20000"))
+# Example rows shown to the model in a dataset profile, each value cut to PROFILE_VALUE_CHARS
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "3"))
+PROFILE_VALUE_CHARS = 30
+UPLOAD_AGGREGATIONS = ("sum", "mean", "count")
+OTHER_LABEL = "Other"
+
+def format_label(value):
+    """Group keys become chart labels; whole floats read better without the trailing .0"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class GroupAggregator:
+    """Running sum/count/min/max of a value column per group key, merged chunk by chunk"""
+
+    def __init__(self, max_groups):
+        self.max_groups = max_groups
+        self.groups = OrderedDict()  # key -> [sum, count, min, max], in first-seen order
+        self.truncated = False
+
+    def update(self, keys, values):
+        """Fold one chunk in; keys is a Series (or a list of Series for tuple keys), values None to count rows"""
+        if values is None:
+            first_keys = keys[0] if isinstance(keys, list) else keys
+            values = pd.Series(0.0, index=first_keys.index)
+        chunk_stats = values.groupby(keys, sort=False).agg(["sum", "count", "min", "max"])
+        for key, total, count, low, high in zip(chunk_stats.index, chunk_stats["sum"], chunk_stats["count"],
+                                                chunk_stats["min"], chunk_stats["max"]):
+            if key not in self.groups and len(self.groups) >= self.max_groups:
+                self.truncated = True
+                key = OTHER_LABEL
+            current = self.groups.get(key)
+            if current is None:
+                self.groups[key] = [float(total), int(count), float(low), float(high)]
+            else:
+                current[0] += float(total)
+                current[1] += int(count)
+                current[2] = min(current[2], float(low))
+                current[3] = max(current[3], float(high))
+
+    def values(self, aggregation):
+        """Aggregated value per key in first-seen order"""
+        result = OrderedDict()
+        for key, (total, count, _, _) in self.groups.items():
+            if aggregation == "count":
+                result[key] = count
+            elif aggregation == "mean":
+                result[key] = total / count if count else 0.0
+            else:
+                result[key] = total
+        return result
+
+class NumericSummary:
+    """Count, min, max and mean of one numeric column over all chunks"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def update(self, values):
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return
+        self.count += int(values.size)
+        self.total += float(values.sum())
+        low, high = float(values.min()), float(values.max())
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+class StreamingCorrelation:
+    """Pearson correlation of two columns from running sums"""
+
+    def __init__(self):
+        self.n = 0
+        self.sums = np.zeros(5)  # x, y, xx, yy, xy
+
+    def update(self, x, y):
+        mask = np.isfinite(x) & np.isfinite(y)
+        x, y = x[mask], y[mask]
+        self.n += int(x.size)
+        self.sums += [x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()]
+
+    def value(self):
+        if self.n < 3:
+            return None
+        sx, sy, sxx, syy, sxy = self.sums
+        variance_x = self.n * sxx - sx * sx
+        variance_y = self.n * syy - sy * sy
+        if variance_x <= 0 or variance_y <= 0:
+            return None
+        return float((self.n * sxy - sx * sy) / np.sqrt(variance_x * variance_y))
+
+class StreamingHistogram:
+    """Fixed number of equal-width bins whose width doubles whenever a value falls outside the range"""
+
+    def __init__(self, bins=64, low=None, high=None):
+        self.bins = bins  # must be even so bins can be merged in pairs
+        self.counts = np.zeros(bins, dtype=np.int64)
+        # A known range up front saves growing (and losing resolution) on later chunks
+        self.low = low
+        self.width = None if low is None else ((high - low) / bins if high > low else 1.0)
+
+    def update(self, values):
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return
+        low, high = float(values.min()), float(values.max())
+        if self.low is None:
+            self.low = low
+            self.width = (high - low) / self.bins if high > low else 1.0
+        while low < self.low:
+            self.grow(left=True)
+        # The top edge itself counts into the last bin
+        while high > self.low + self.width * self.bins:
+            self.grow(left=False)
+        positions = ((values - self.low) / self.width).astype(np.int64)
+        self.counts += np.bincount(np.clip(positions, 0, self.bins - 1), minlength=self.bins)
+
+    def grow(self, left):
+        """Double the bin width, keeping existing counts: merge neighbouring bins into one half of the range"""
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        if left:
+            self.counts[self.bins // 2:] = merged
+            self.low -= self.width * self.bins
+        else:
+            self.counts[:self.bins // 2] = merged
+        self.width *= 2
+
+    def result(self):
+        """(bin_edges, counts) with empty bins at either end dropped"""
+        if self.low is None:
+            return None
+        filled = np.nonzero(self.counts)[0]
+        first, last = filled[0], filled[-1] + 1
+        edges = self.low + self.width * np.arange(first, last + 1)
+        return edges.tolist(), self.counts[first:last].tolist()
+
+# Every histogram is first counted into this many equal-width bins; display bins and the KDE are derived from them
+HISTOGRAM_FINE_BINS = 512
+HISTOGRAM_MAX_BINS = int(os.getenv("HISTOGRAM_MAX_BINS", "100"))
+
+def bin_values(values):
+    """(bin_edges, counts) of raw values on the fine grid, binned CSV_CHUNK_ROWS values at a time"""
+    finite = np.isfinite(values)
+    if not finite.any():
+        return None
+    histogram = StreamingHistogram(HISTOGRAM_FINE_BINS, float(values[finite].min()), float(values[finite].max()))
+    for start in range(0, values.size, CSV_CHUNK_ROWS):
+        histogram.update(values[start:start + CSV_CHUNK_ROWS])
+    return histogram.result()
+
+def binned_quantile(edges, counts, q):
+    """Quantile of the binned values, interpolating linearly inside the bin it falls in"""
+    cumulative = np.cumsum(counts)
+    target = q * cumulative[-1]
+    i = min(int(np.searchsorted(cumulative, target)), counts.size - 1)
+    before = cumulative[i - 1] if i else 0
+    fraction = (target - before) / counts[i] if counts[i] else 0.0
+    return edges[i] + fraction * (edges[i + 1] - edges[i])
+
+def histogram_bin_count(edges, counts):
+    """Display bins for binned data: the larger of the Freedman-Diaconis and Sturges estimates, like numpy's 'auto'"""
+    total = counts.sum()
+    if total < 1:
+        return 1
+    sturges = int(np.ceil(np.log2(total))) + 1
+    iqr = binned_quantile(edges, counts, 0.75) - binned_quantile(edges, counts, 0.25)
+    freedman_diaconis = int(np.ceil((edges[-1] - edges[0]) / (2 * iqr * total ** (-1 / 3)))) if iqr > 0 else 0
+    return min(HISTOGRAM_MAX_BINS, max(sturges, freedman_diaconis))
+
+def rebin(edges, counts, bins):
+    """Merge runs of neighbouring equal-width bins so at most bins remain"""
+    factor = max(1, -(-counts.size // bins))
+    padded = np.zeros(-(-counts.size // factor) * factor)
+    padded[:counts.size] = counts
+    merged = padded.reshape(-1, factor).sum(axis=1)
+    return edges[0] + (edges[1] - edges[0]) * factor * np.arange(merged.size + 1), merged
+
+def binned_kde(edges, counts):
+    """Gaussian KDE of binned data as (x, counts per bin), by convolving the counts; None without any spread"""
+    width = edges[1] - edges[0]
+    total = counts.sum()
+    if total < 2:
+        return None
+    centers = (edges[:-1] + edges[1:]) / 2
+    mean = (centers * counts).sum() / total
+    std = np.sqrt(((centers - mean) ** 2 * counts).sum() / total)
+    iqr = binned_quantile(edges, counts, 0.75) - binned_quantile(edges, counts, 0.25)
+    spread = min(std, iqr / 1.34) if iqr > 0 else std
+    if spread <= 0:
+        return None
+    # Silverman's rule of thumb, in bins
+    sigma = 0.9 * spread * total ** -0.2 / width
+    half = int(min(np.ceil(4 * sigma), 4 * counts.size))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma) ** 2)
+    smoothed = np.convolve(np.pad(counts.astype(float), half), kernel / kernel.sum(), mode='same')
+    return edges[0] + width * (np.arange(smoothed.size) - half + 0.5), smoothed
+
+class ReservoirSample:
+    """Uniform sample of at most size rows from a stream of chunks (Algorithm R, vectorised per chunk)"""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seen = 0
+        self.columns = None
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, columns):
+        rows = len(next(iter(columns.values())))
+        if self.columns is None:
+            self.columns = {name: values[:self.size].copy() for name, values in columns.items()}
+            taken = min(rows, self.size)
+        else:
+            free = self.size - len(next(iter(self.columns.values())))
+            taken = max(0, min(rows, free))
+            if taken:
+                self.columns = {name: np.concatenate([self.columns[name], values[:taken]]) for name, values in columns.items()}
+        start = self.seen + taken
+        self.seen += rows
+        if rows == taken:
+            return
+        # Row i of the stream replaces a random slot with probability size / (i + 1)
+        positions = np.arange(start, start + rows - taken)
+        slots = (self.rng.random(positions.size) * (positions + 1)).astype(np.int64)
+        keep = slots < self.size
+        for name, values in columns.items():
+            self.columns[name][slots[keep]] = values[taken:][keep]
+
+def column_dtype(series, numeric):
+    """Type name of a column as the dataset profile reports it"""
+    if pd.api.types.is_bool_dtype(series):
+        return "boolean"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    if pd.api.types.is_integer_dtype(series):
+        return "integer"
+    return "number" if numeric else "text"
+
+class UploadedDataset:
+    """Chart-ready aggregates of an uploaded table, reduced one chunk at a time so the table is never held in memory"""
+
+    def __init__(self, name, label_column=None, value_column=None, group_column=None, aggregation=None):
+        self.dataset_id = uuid.uuid4().hex
+        self.name = name
+        self.label_column = label_column
+        self.value_column = value_column
+        self.group_column = group_column
+        self.aggregation = aggregation
+        self.x_column = None
+        self.columns = []
+        self.numeric_columns = []
+        self.rows = 0
+        self.parse_seconds = None
+        self.registered = False
+        self.dtypes = {}
+        self.distinct = {}  # text column -> distinct values, up to UPLOAD_MAX_GROUPS
+        self.scanned_columns = set()
+        self.sample_rows = []
+        self.by_label = GroupAggregator(UPLOAD_MAX_GROUPS)
+        self.by_label_and_group = GroupAggregator(UPLOAD_MAX_GROUPS)
+        self.summaries = {}
+        self.histogram = StreamingHistogram(HISTOGRAM_FINE_BINS)
+        self.correlation = StreamingCorrelation()
+        self.sample = ReservoirSample(UPLOAD_SAMPLE_ROWS)
+        # Only two float columns, so it can hold many more rows than the labelled sample
+        self.points = ReservoirSample(UPLOAD_SCATTER_POINTS)
+
+    def bind_columns(self, chunk, user_prompt=""):
+        """Pick label/value/group columns from the first chunk for any the client didn't name, preferring ones the prompt mentions"""
+        self.columns = [str(column) for column in chunk.columns]
+        chunk.columns = self.columns
+        for column in (self.label_column, self.value_column, self.group_column):
+            if column and column not in self.columns:
+                raise DiagramError(f"Column '{column}' not found in the uploaded file; columns are: {', '.join(self.columns)}")
+        self.numeric_columns = [
+            column for column in self.columns
+            if not pd.api.types.is_datetime64_any_dtype(chunk[column])
+            and pd.to_numeric(chunk[column], errors="coerce").notna().mean() >= 0.9
+        ]
+        text_columns = [column for column in self.columns if column not in self.numeric_columns]
+        prompt_words = set(re.findall(r"\w+", user_prompt.lower()))
+        mentioned = lambda column: set(re.findall(r"\w+", column.lower())) <= prompt_words
+        text_columns.sort(key=lambda column: not mentioned(column))
+
+        if not self.label_column:
+            self.label_column = text_columns[0] if text_columns else self.columns[0]
+        if not self.value_column:
+            candidates = [c for c in self.numeric_columns if c != self.label_column]
+            self.value_column = next((c for c in candidates if mentioned(c)), candidates[0] if candidates else None)
+        if self.value_column and self.value_column not in self.numeric_columns:
+            raise DiagramError(f"Column '{self.value_column}' is not numeric")
+        if not self.group_column:
+            self.group_column = next((c for c in text_columns if c != self.label_column and chunk[c].nunique() <= UPLOAD_MAX_CATEGORIES), None)
+        if not self.aggregation:
+            self.aggregation = "sum" if self.value_column else "count"
+        self.dtypes = {column: column_dtype(chunk[column], column in self.numeric_columns) for column in self.columns}
+        self.distinct = {column: set(chunk[column].dropna().astype(str).unique()[:UPLOAD_MAX_GROUPS]) for column in text_columns}
+        self.sample_rows = [
+            {column: (value if isinstance(value, (int, float)) else str(value)[:PROFILE_VALUE_CHARS])
+             for column, value in row.items() if not (isinstance(value, float) and np.isnan(value))}
+            for row in chunk.head(PROFILE_SAMPLE_ROWS).to_dict("records")
+        ]
+        if self.label_column in self.numeric_columns:
+            self.x_column = self.label_column
+        else:
+            self.x_column = next((c for c in self.numeric_columns if c != self.value_column), None)
+
+    def required_columns(self):
+        """The bound columns, the only ones a columnar reader has to load"""
+        bound = (self.label_column, self.value_column, self.group_column, self.x_column)
+        return list(OrderedDict.fromkeys(column for column in bound if column))
+
+    def update(self, chunk):
+        """Fold in one chunk holding all columns (CSV) or just the required ones (Arrow/Parquet)"""
+        chunk.columns = [str(column) for column in chunk.columns]
+        self.rows += len(chunk)
+        labels = chunk[self.label_column]
+        if self.label_column in self.numeric_columns:
+            labels = pd.to_numeric(labels, errors="coerce")
+        else:
+            labels = labels.fillna("(missing)")
+        values = pd.to_numeric(chunk[self.value_column], errors="coerce") if self.value_column else None
+
+        self.by_label.update(labels, values)
+        if self.group_column:
+            self.by_label_and_group.update([labels, chunk[self.group_column].fillna("(missing)").astype(str)], values)
+
+        for column, values in self.distinct.items():
+            if column in chunk.columns and len(values) < UPLOAD_MAX_GROUPS:
+                values.update(chunk[column].dropna().astype(str).unique()[:UPLOAD_MAX_GROUPS - len(values)])
+        self.scanned_columns.update(chunk.columns)
+
+        numeric = {column: pd.to_numeric(chunk[column], errors="coerce").to_numpy(dtype=float)
+                   for column in self.numeric_columns if column in chunk.columns}
+        for column, column_values in numeric.items():
+            self.summaries.setdefault(column, NumericSummary()).update(column_values)
+        sampled = {"label": labels.to_numpy(dtype=object)}
+        if self.value_column:
+            self.histogram.update(numeric[self.value_column])
+            sampled["value"] = numeric[self.value_column]
+        self.sample.update(sampled)
+        if self.x_column and self.value_column:
+            self.correlation.update(numeric[self.x_column], numeric[self.value_column])
+            self.points.update({"x": numeric[self.x_column], "value": numeric[self.value_column]})
+
+    def profile(self):
+        """Column names, types, cardinalities and ranges plus a few example rows; all the model ever sees of the data"""
+        columns = []
+        for column in self.columns:
+            entry = {"name": column, "dtype": self.dtypes.get(column, "text")}
+            summary = self.summaries.get(column)
+            if summary and summary.count:
+                entry.update(min=summary.minimum, max=summary.maximum, mean=summary.mean())
+            elif column in self.distinct:
+                entry["distinct"] = len(self.distinct[column])
+                # Capped, or only seen in the first chunk because a columnar reader skipped it
+                entry["distinct_is_lower_bound"] = (entry["distinct"] >= UPLOAD_MAX_GROUPS
+                                                    or column not in self.scanned_columns)
+            columns.append(entry)
+        return {
+            "name": self.name,
+            "rows": self.rows,
+            "columns": columns,
+            "sample_rows": self.sample_rows,
+            "bindings": {
+                "x_column": self.label_column,
+                "y_column": self.value_column,
+                "group_column": self.group_column,
+                "aggregation": self.aggregation
+            }
+        }
+
+    def describe(self):
+        """The profile as a compact line for prompts"""
+        parts = []
+        for entry in self.profile()["columns"]:
+            if "min" in entry:
+                parts.append(f"{entry['name']} ({entry['dtype']}, {entry['min']:g} to {entry['max']:g})")
+            elif "distinct" in entry:
+                more = "+" if entry["distinct_is_lower_bound"] else ""
+                parts.append(f"{entry['name']} ({entry['dtype']}, {entry['distinct']}{more} distinct)")
+            else:
+                parts.append(f"{entry['name']} ({entry['dtype']})")
+        measure = f"{self.aggregation} of {self.value_column}" if self.value_column else "row count"
+        description = (f"[uploaded data {self.name}: {self.rows} rows; columns: {', '.join(parts)}; "
+                       f"charts show {measure} by {self.label_column}")
+        if self.group_column:
+            description += f" and {self.group_column}"
+        correlation = self.correlation.value()
+        if correlation is not None:
+            description += f"; correlation of {self.x_column} and {self.value_column}: {correlation:.2f}"
+        if self.sample_rows:
+            description += f"; sample rows: {json.dumps(self.sample_rows, default=str)}"
+        return description + "]"
+
+    def memory_bytes(self):
+        """Rough size of what the dataset keeps: group tables, distinct values and the row samples"""
+        group_keys = list(self.by_label.groups) + list(self.by_label_and_group.groups)
+        # Each group also holds a 4-item list of floats and its dict slot
+        size = sum(sys.getsizeof(key) + 250 for key in group_keys)
+        size += sum(sys.getsizeof(value) for values in self.distinct.values() for value in values)
+        for values in [*(self.sample.columns or {}).values(), *(self.points.columns or {}).values()]:
+            size += values.nbytes
+            if values.dtype == object:
+                size += sum(sys.getsizeof(value) for value in values)
+        return size + self.histogram.counts.nbytes
+
+    def axis_labels(self, chart_type):
+        """(x_axis, y_axis) titles for a chart of this dataset"""
+        measure = f"{self.value_column} ({self.aggregation})" if self.value_column else "Count"
+        if chart_type == "histogram":
+            return self.value_column, "Count"
+        if chart_type in ("scatter", "bubble"):
+            return self.x_column, self.value_column
+        if chart_type in ("boxplot", "violin"):
+            return self.label_column, self.value_column
+        return self.label_column, measure
+
+    def top_labels(self, limit, by_value=True):
+        values = self.by_label.values(self.aggregation)
+        items = list(values.items())
+        if by_value:
+            items.sort(key=lambda item: item[1], reverse=True)
+        elif self.label_column in self.numeric_columns:
+            items.sort(key=lambda item: item[0] if isinstance(item[0], (int, float)) else float("inf"))
+        return items[:limit]
+
+    def chart_data(self, chart_type):
+        """Map the aggregates onto the fields generate_chart_image expects for this chart type, or None"""
+        source = {"data_source": "uploaded"}
+        if chart_type in ("line", "area"):
+            items = self.top_labels(UPLOAD_MAX_SERIES_POINTS, by_value=False)
+            return dict(source, x_values=[format_label(k) for k, _ in items], y_values=[v for _, v in items])
+        if chart_type in ("bar", "pie", "treemap", "funnel", "radar"):
+            limit = {"pie": 8, "radar": 10}.get(chart_type, UPLOAD_MAX_CATEGORIES)
+            items = self.top_labels(limit)
+            labels, values = [format_label(k) for k, _ in items], [v for _, v in items]
+            fields = CHART_DATA_PAIRS[chart_type]
+            return dict(source, **{fields[0]: labels, fields[1]: values})
+        if chart_type == "histogram":
+            binned = self.histogram.result()
+            if binned is None:
+                return None
+            return dict(source, bin_edges=binned[0], counts=binned[1])
+        if chart_type in ("scatter", "bubble"):
+            if not self.points.columns:
+                return None
+            x, y = self.points.columns["x"], self.points.columns["value"]
+            mask = np.isfinite(x) & np.isfinite(y)
+            return dict(source, x_values=x[mask].tolist(), y_values=y[mask].tolist())
+        if chart_type in ("boxplot", "violin"):
+            if not self.sample.columns or "value" not in self.sample.columns:
+                return None
+            labels, values = self.sample.columns["label"], self.sample.columns["value"]
+            groups = [k for k, _ in self.top_labels(8)]
+            distributions = [values[(labels == group) & np.isfinite(values)].tolist() for group in groups]
+            kept = [(format_label(group), dist) for group, dist in zip(groups, distributions) if dist]
+            if not kept:
+                return None
+            return dict(source, x_values=[g for g, _ in kept], distributions=[d for _, d in kept])
+        if chart_type in ("heatmap", "stacked_bar"):
+            if not self.group_column:
+                return None
+            labels = [k for k, _ in self.top_labels(15 if chart_type == "heatmap" else 10)]
+            cells = self.by_label_and_group.values(self.aggregation)
+            groups = list(OrderedDict.fromkeys(key[1] for key in cells if isinstance(key, tuple)))[:15]
+            if chart_type == "heatmap":
+                return dict(source, x_values=[format_label(k) for k in labels], y_values=groups,
+                            z_values=[[cells.get((label, group), 0) for label in labels] for group in groups])
+            pairs = [(label, group) for group in groups for label in labels]
+            return dict(source, x_values=[format_label(label) for label, _ in pairs],
+                        y_values=[cells.get(pair, 0) for pair in pairs], groups=[group for _, group in pairs])
+        return None
+
+def check_aggregation(aggregation):
+    if aggregation and aggregation not in UPLOAD_AGGREGATIONS:
+        raise DiagramError(f"Unsupported aggregation '{aggregation}', expected one of: {', '.join(UPLOAD_AGGREGATIONS)}")
+
+def finish_upload(dataset, started, description):
+    """Reject empty uploads, then record how long the file took to reduce"""
+    if not dataset.rows:
+        raise DiagramError(f"The uploaded {description} has no data rows")
+    dataset.parse_seconds = time.perf_counter() - started
+    record_stage_timing("upload_parse", dataset.parse_seconds)
+    logger.info(f"Aggregated {dataset.rows} uploaded rows in {dataset.parse_seconds:.2f}s: {dataset.describe()}")
+    return dataset
+
+def read_uploaded_csv(file_storage, user_prompt, label_column=None, value_column=None, group_column=None, aggregation=None):
+    """Reduce an uploaded CSV to an UploadedDataset, reading it CSV_CHUNK_ROWS rows at a time"""
+    check_aggregation(aggregation)
+    dataset = UploadedDataset(file_storage.filename or "upload.csv", label_column, value_column, group_column, aggregation)
+    started = time.perf_counter()
+    try:
+        for chunk in pd.read_csv(file_storage.stream, chunksize=CSV_CHUNK_ROWS, low_memory=True):
+            if not dataset.columns:
+                dataset.bind_columns(chunk, user_prompt)
+            dataset.update(chunk)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise DiagramError(f"Could not parse the uploaded CSV: {str(e)}")
+    return finish_upload(dataset, started, "CSV")
+
+# Upload formats by file extension, then by magic bytes for unnamed uploads
+UPLOAD_FORMAT_EXTENSIONS = {
+    ".csv": "csv", ".txt": "csv",
+    ".parquet": "parquet", ".pq": "parquet",
+    ".arrow": "ipc", ".feather": "ipc", ".ipc": "ipc"
+}
+UPLOAD_FORMAT_MAGIC = ((b"PAR1", "parquet"), (b"ARROW1", "ipc"))
+UPLOAD_FORMAT_NAMES = {"csv": "CSV", "parquet": "Parquet", "ipc": "Arrow"}
+
+def uploaded_file_format(file_storage):
+    """'csv', 'parquet' or 'ipc' (Arrow IPC / Feather v2) for an uploaded file"""
+    extension = os.path.splitext((file_storage.filename or "").lower())[1]
+    if extension in UPLOAD_FORMAT_EXTENSIONS:
+        return UPLOAD_FORMAT_EXTENSIONS[extension]
+    head = file_storage.stream.read(8)
+    file_storage.stream.seek(0)
+    return next((file_format for magic, file_format in UPLOAD_FORMAT_MAGIC if head.startswith(magic)), "csv")
+
+ARROW_FILTER_OPERATORS = ("==", "!=", "<", "<=", ">", ">=", "in", "not in")
+
+def arrow_filter_expression(filters, schema):
+    """Turn [[column, operator, value], ...] (all must hold) into a dataset filter expression"""
+    if isinstance(filters, str):
+        try:
+            filters = json.loads(filters)
+        except json.JSONDecodeError:
+            raise DiagramError("filters must be a JSON list of [column, operator, value] triples")
+    if not filters:
+        return None
+    if not isinstance(filters, list):
+        raise DiagramError("filters must be a JSON list of [column, operator, value] triples")
+    expression = None
+    for condition in filters:
+        if not isinstance(condition, list) or len(condition) != 3:
+            raise DiagramError(f"Invalid filter {condition!r}, expected [column, operator, value]")
+        column, operator, value = condition
+        if column not in schema.names:
+            raise DiagramError(f"Filter column '{column}' not found in the uploaded file; columns are: {', '.join(schema.names)}")
+        if operator not in ARROW_FILTER_OPERATORS:
+            raise DiagramError(f"Unsupported filter operator '{operator}', expected one of: {', '.join(ARROW_FILTER_OPERATORS)}")
+        field = pa_dataset.field(column)
+        if operator in ("in", "not in"):
+            if not isinstance(value, list):
+                raise DiagramError(f"Filter '{operator}' on '{column}' needs a list of values")
+            condition_expression = field.isin(value)
+            if operator == "not in":
+                condition_expression = ~condition_expression
+        else:
+            condition_expression = {
+                "==": field == value, "!=": field != value,
+                "<": field < value, "<=": field <= value,
+                ">": field > value, ">=": field >= value
+            }[operator]
+        expression = condition_expression if expression is None else expression & condition_expression
+    return expression
+
+def arrow_to_pandas(table):
+    """Convert a record batch or table, decoding dictionary columns so they aggregate like plain text"""
+    frame = table.to_pandas()
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype(object)
+    return frame
+
+def read_uploaded_arrow(file_storage, file_format, user_prompt, label_column=None, value_column=None,
+                        group_column=None, aggregation=None, filters=None):
+    """Reduce an uploaded Parquet or Arrow IPC/Feather file to an UploadedDataset, scanning only the bound columns"""
+    description = UPLOAD_FORMAT_NAMES[file_format]
+    if pa is None:
+        raise DiagramError(f"{description} uploads need pyarrow installed on the server", 415)
+    check_aggregation(aggregation)
+    dataset = UploadedDataset(file_storage.filename or f"upload.{file_format}", label_column, value_column, group_column, aggregation)
+    started = time.perf_counter()
+    # Memory mapping needs a named file; the request body may still be spooled in memory
+    handle, path = tempfile.mkstemp(suffix=f".{file_format}")
+    try:
+        with os.fdopen(handle, "wb") as spooled:
+            shutil.copyfileobj(file_storage.stream, spooled, 1024 * 1024)
+        try:
+            source = pa_dataset.dataset(path, format=file_format, filesystem=pa_fs.LocalFileSystem(use_mmap=True))
+            expression = arrow_filter_expression(filters, source.schema)
+            sample = source.head(UPLOAD_SAMPLE_ROWS, filter=expression)
+            if not sample.num_rows and expression is not None:
+                raise DiagramError(f"No rows of the uploaded {description} file match the filters")
+            dataset.bind_columns(arrow_to_pandas(sample), user_prompt)
+            # Parquet row groups whose statistics rule the filter out are skipped without being read
+            for batch in source.to_batches(columns=dataset.required_columns(), filter=expression, batch_size=CSV_CHUNK_ROWS):
+                if batch.num_rows:
+                    dataset.update(arrow_to_pandas(batch))
+        except (pa.ArrowException, OSError) as e:
+            raise DiagramError(f"Could not read the uploaded {description} file: {str(e)}")
+    finally:
+        os.remove(path)
+    return finish_upload(dataset, started, f"{description} file")
+
+def read_uploaded_file(file_storage, user_prompt, filters=None, **bindings):
+    """Reduce an uploaded CSV, Parquet or Arrow file to an UploadedDataset"""
+    file_format = uploaded_file_format(file_storage)
+    if file_format == "csv":
+        if filters:
+            raise DiagramError("filters are only supported for Parquet and Arrow uploads")
+        return read_uploaded_csv(file_storage, user_prompt, **bindings)
+    return read_uploaded_arrow(file_storage, file_format, user_prompt, filters=filters, **bindings)
+
+class DatasetRegistry:
+    """Uploaded datasets kept for reuse by id, evicting the least recently used once their total size passes max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.datasets = OrderedDict()  # dataset_id -> (dataset, bytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"registered": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def add(self, dataset):
+        size = dataset.memory_bytes()
+        if size > self.max_bytes:
+            raise DiagramError(f"The dataset needs about {size // (1024 * 1024)} MB, more than the registry holds", 413)
+        dataset.registered = True
+        with self.lock:
+            previous = self.datasets.pop(dataset.dataset_id, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self.datasets[dataset.dataset_id] = (dataset, size)
+            self.total_bytes += size
+            self.stats["registered"] += 1
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.datasets.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.stats["evictions"] += 1
+        return size
+
+    def get(self, dataset_id):
+        with self.lock:
+            entry = self.datasets.get(dataset_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.datasets.move_to_end(dataset_id)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def remove(self, dataset_id):
+        with self.lock:
+            entry = self.datasets.pop(dataset_id, None)
+            if entry is None:
+                return False
+            self.total_bytes -= entry[1]
+            return True
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.datasets), bytes=self.total_bytes, max_bytes=self.max_bytes)
+
+dataset_registry = DatasetRegistry(max_bytes=int(os.getenv("DATASET_REGISTRY_MAX_MB", "256")) * 1024 * 1024)
+
+# Set per diagram request when data was uploaded; copied into stage threads by submit_stage
+request_dataset = contextvars.ContextVar("request_dataset", default=None)
+
+DEFAULT_RECOMMENDATIONS = [
+    {"chart_type": "bar", "reason": "Default recommendation for comparing values"},
+    {"chart_type": "line", "reason": "Default recommendation for showing trends"},
+    {"chart_type": "pie", "reason": "Default recommendation for showing proportions"}
+]
+
+CHART_TYPE_PURPOSES = {
+    "bar": "For comparing values across categories",
+    "line": "For showing trends over time or ordered categories",
+    "pie": "For showing proportions of a whole",
+    "scatter": "For showing relationship between two variables",
+    "histogram": "For showing distribution of a single variable",
+    "heatmap": "For showing patterns in a matrix of values",
+    "boxplot": "For showing distribution statistics with quartiles",
+    "violin": "For showing distribution density across categories",
+    "area": "For showing cumulative totals over time",
+    "stacked_bar": "For showing part-to-whole relationships across categories",
+    "bubble": "For showing relationships between three variables",
+    "radar": "For showing multivariate data on axes radiating from center",
+    "treemap": "For showing hierarchical data as nested rectangles",
+    "funnel": "For showing stages in a process with decreasing quantities"
+}
+
+CHART_TYPE_GUIDE = "\n" + "".join(f"       - {chart_type}: {purpose}\n" for chart_type, purpose in CHART_TYPE_PURPOSES.items())
+
+def build_recommendation_prompt(user_prompt):
+    """Build the prompt asking for the 3 most appropriate chart types for one request"""
+    return f"""
+    You are a data visualization expert tasked with recommending the most appropriate chart types.
+
+    USER REQUEST: {condense_inline_data(user_prompt)}
+
+    CRITICAL INSTRUCTIONS:
+    1. CAREFULLY ANALYZE what the user is trying to visualize, what data they've provided, and the relationships they want to show
+    2. Consider the exact data structure mentioned (if any) in the user's request
+    3. Recommend the 3 MOST APPROPRIATE chart types from this list:{CHART_TYPE_GUIDE}
+    4. Your ENTIRE response must be ONLY valid JSON with this exact format:
+    {{
+        "recommended_chart_types": [
+            {{
+                "chart_type": "first_type",
+                "reason": "Specific reason why this chart type is optimal for the requested data"
+            }},
+            {{
+                "chart_type": "second_type",
+                "reason": "Specific reason why this chart type is optimal for the requested data"
+            }},
+            {{
+                "chart_type": "third_type",
+                "reason": "Specific reason why this chart type is optimal for the requested data"
+            }}
+        ]
+    }}
+
+    REQUIREMENTS:
+    - Recommend EXACTLY 3 different chart types, most appropriate first
+    - Do NOT add any explanations, text, or markdown outside the JSON
+    - Ensure that your suggestions match the user's data structure and visualization goals
+    - Provide specific reasons tailored to the user's exact request, not generic descriptions
+    """
+
+def build_batch_recommendation_prompt(user_prompts):
+    """Build one prompt asking for chart type recommendations for several independent requests"""
+    numbered_requests = "\n".join(
+        f"    REQUEST {i}: {json.dumps(condense_inline_data(user_prompt))}" for i, user_prompt in enumerate(user_prompts)
+    )
+    return f"""
+    You are a data visualization expert tasked with recommending the most appropriate chart types
+    for SEVERAL INDEPENDENT user requests. Treat every request separately; never mix their data.
+
+{numbered_requests}
+
+    CRITICAL INSTRUCTIONS:
+    1. For EACH request, CAREFULLY ANALYZE what the user is trying to visualize, what data they've provided, and the relationships they want to show
+    2. For EACH request, recommend the 3 MOST APPROPRIATE chart types from this list:{CHART_TYPE_GUIDE}
+    3. Your ENTIRE response must be ONLY valid JSON with this exact format, with one entry per request:
+    {{
+        "results": [
+            {{
+                "id": 0,
+                "recommended_chart_types": [
+                    {{"chart_type": "first_type", "reason": "Specific reason for this request"}},
+                    {{"chart_type": "second_type", "reason": "Specific reason for this request"}},
+                    {{"chart_type": "third_type", "reason": "Specific reason for this request"}}
+                ]
+            }}
+        ]
+    }}
+
+    REQUIREMENTS:
+    - "id" MUST be the number of the REQUEST the entry answers
+    - Recommend EXACTLY 3 different chart types per request, most appropriate first
+    - Do NOT add any explanations, text, or markdown outside the JSON
+    """
+
+def fetch_chart_recommendations(user_prompt):
+    """Make a single recommendation call to Gemini and return the raw recommendation list"""
+    recommendation = generate_model_json(build_recommendation_prompt(user_prompt), "recommendation")
+    return recommendation.get("recommended_chart_types", [])
+
+class RecommendationBatcher:
+    """Collects recommendation requests arriving within a short window and sends them as one model call"""
+
+    def __init__(self, window_seconds, max_batch_size, dispatch_workers=4):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self.dispatch_executor = ThreadPoolExecutor(max_workers=dispatch_workers, thread_name_prefix="recommendation-batch")
+        self.collector = None
+        self.lock = threading.Lock()
+        self.stats = {"batches": 0, "batched_requests": 0, "single_requests": 0, "batch_failures": 0, "timeouts": 0}
+
+    def submit(self, user_prompt, timeout):
+        """Wait up to timeout seconds for this prompt's recommendations; None means the caller should make its own call"""
+        with self.lock:
+            if self.collector is None:
+                self.collector = threading.Thread(target=self.collect_batches, name="recommendation-collector", daemon=True)
+                self.collector.start()
+        future = Future()
+        # The batched call runs inside one waiter's context so it keeps a request budget and timings
+        self.pending.put((user_prompt, future, contextvars.copy_context()))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning(f"Batched recommendation call did not answer within {timeout:.1f}s")
+            with self.lock:
+                self.stats["timeouts"] += 1
+            return None
+
+    def collect_batches(self):
+        while True:
+            batch = [self.pending.get()]
+            window_ends = time.monotonic() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = window_ends - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.dispatch_executor.submit(self.dispatch, batch)
+
+    def dispatch(self, batch):
+        if len(batch) == 1:
+            # Nothing to share the call with, let the caller make its usual request
+            with self.lock:
+                self.stats["single_requests"] += 1
+            batch[0][1].set_result(None)
+            return
+
+        try:
+            batch_prompt = build_batch_recommendation_prompt([p for p, _, _ in batch])
+            # The waiter with the least time left bounds the call, so it can't outlive any request's budget
+            ctx = min((ctx for _, _, ctx in batch), key=budget_deadline)
+            results = ctx.run(generate_model_json, batch_prompt, "recommendation").get("results", [])
+            by_id = {}
+            for result in results:
+                if isinstance(result, dict) and isinstance(result.get("recommended_chart_types"), list):
+                    by_id[str(result.get("id"))] = result["recommended_chart_types"]
+            with self.lock:
+                self.stats["batches"] += 1
+                self.stats["batched_requests"] += len(batch)
+            logger.info(f"Batched recommendation call answered {len(by_id)}/{len(batch)} requests")
+            for i, (_, future, _) in enumerate(batch):
+                # Items the model skipped fall back to their own call
+                future.set_result(by_id.get(str(i)))
+        except Exception as e:
+            logger.error(f"Batched recommendation call failed, falling back to per-request calls: {str(e)}")
+            with self.lock:
+                self.stats["batch_failures"] += 1
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_result(None)
+
+def budget_deadline(ctx):
+    budget = ctx.get(request_budget)
+    return budget.deadline if budget is not None else float("inf")
+
+# Optional micro-batching of recommendation calls across concurrent requests
+RECOMMENDATION_BATCHING = os.getenv("RECOMMENDATION_BATCHING", "false").lower() == "true"
+recommendation_batcher = RecommendationBatcher(
+    window_seconds=int(os.getenv("RECOMMENDATION_BATCH_WINDOW_MS", "50")) / 1000,
+    max_batch_size=int(os.getenv("RECOMMENDATION_BATCH_MAX_SIZE", "8"))
+) if RECOMMENDATION_BATCHING else None
+
+# Explicit chart names in the prompt are the strongest signal
+EXPLICIT_CHART_PATTERNS = {
+    "stacked_bar": r"\bstacked[- ]bar",
+    "bar": r"(?<!stacked )(?<!stacked-)\bbar (?:chart|graph|plot)s?\b|\bcolumn chart",
+    "line": r"\bline (?:chart|graph|plot)s?\b",
+    "pie": r"\bpie\b|\bdonut\b|\bdoughnut\b",
+    "scatter": r"\bscatter",
+    "histogram": r"\bhistogram",
+    "heatmap": r"\bheat ?-?map",
+    "boxplot": r"\bbox ?-?(?:plot|and[- ]whisker)",
+    "violin": r"\bviolin",
+    "area": r"\barea (?:chart|graph|plot)s?\b",
+    "bubble": r"\bbubble (?:chart|graph|plot)s?\b",
+    "radar": r"\bradar\b|\bspider (?:chart|graph|plot)",
+    "treemap": r"\btree ?-?map",
+    "funnel": r"\bfunnel"
+}
+
+# (pattern, {chart_type: weight}) rules describing what the user wants to show
+INTENT_RULES = [
+    (r"\b(?:over time|trends?|timeline|time series|monthly|weekly|daily|yearly|annual|over the (?:past|last)|decade)\b",
+     {"line": 0.5, "area": 0.3, "bar": 0.2}),
+    (r"\b(?:market share|share of|proportions?|percentages?|breakdown|composition)\b",
+     {"pie": 0.5, "treemap": 0.3, "stacked_bar": 0.2}),
+    (r"\b(?:distributions?|spread|frequenc(?:y|ies))\b",
+     {"histogram": 0.5, "boxplot": 0.4, "violin": 0.3}),
+    (r"\b(?:quartiles?|median|outliers?)\b",
+     {"boxplot": 0.6, "violin": 0.3}),
+    (r"\b(?:correlations?|correlate[sd]?|relationship|versus|vs\.?)\b",
+     {"scatter": 0.5, "heatmap": 0.3, "bubble": 0.2}),
+    (r"\b(?:compare|comparing|comparison|ranking|top \d+)\b",
+     {"bar": 0.5, "stacked_bar": 0.2, "radar": 0.2}),
+    (r"\b(?:conversion|drop-?off|sales pipeline|stages)\b",
+     {"funnel": 0.6, "bar": 0.2}),
+    (r"\b(?:hierarch\w*|nested|market cap\w*|capitali[sz]ation)\b",
+     {"treemap": 0.5, "pie": 0.2}),
+    (r"\b(?:skills?|attributes|ratings?)\b",
+     {"radar": 0.4, "bar": 0.3}),
+    (r"\b(?:matrix|grid of)\b",
+     {"heatmap": 0.5}),
+    (r"\b(?:cumulative|stacked|running total)\b",
+     {"area": 0.4, "stacked_bar": 0.4})
+]
+
+# Good companions for the top pick when the rules only find one or two chart types
+COMPLEMENTARY_CHART_TYPES = {
+    "bar": ["line", "pie"],
+    "line": ["area", "bar"],
+    "pie": ["bar", "treemap"],
+    "scatter": ["bubble", "heatmap"],
+    "histogram": ["boxplot", "violin"],
+    "heatmap": ["bar", "scatter"],
+    "boxplot": ["violin", "histogram"],
+    "violin": ["boxplot", "histogram"],
+    "area": ["line", "stacked_bar"],
+    "stacked_bar": ["bar", "area"],
+    "bubble": ["scatter", "heatmap"],
+    "radar": ["bar", "line"],
+    "treemap": ["pie", "bar"],
+    "funnel": ["bar", "pie"]
+}
+
+# Ordered labels the column-wise x parsing doesn't read: quarters, full month names, week/day numbers
+TIME_LABEL_PATTERN = re.compile(r"^(?:q[1-4]|jan\w*|feb\w*|mar\w*|apr\w*|may|jun\w*|jul\w*|aug\w*|sep\w*|oct\w*|nov\w*|dec\w*|week \d+|day \d+)$")
+
+LOCAL_RECOMMENDER_THRESHOLD = float(os.getenv("LOCAL_RECOMMENDER_THRESHOLD", "0.8"))
+recommendation_path_stats = {"near_duplicate": 0, "local": 0, "batched": 0, "model": 0, "default": 0}
+recommendation_path_lock = threading.Lock()
+
+def count_recommendation_path(path):
+    with recommendation_path_lock:
+        recommendation_path_stats[path] += 1
+
+def recommend_chart_types_locally(user_prompt):
+    """Score chart types with keyword/intent rules and the shape of inline data
+
+    Returns (recommendations, confidence); recommendations is None when no rule matched.
+    """
+    text = user_prompt.lower()
+    scores = {}
+    reasons = {}
+
+    def add(chart_type, weight, reason):
+        scores[chart_type] = scores.get(chart_type, 0) + weight
+        reasons.setdefault(chart_type, reason)
+
+    for chart_type, pattern in EXPLICIT_CHART_PATTERNS.items():
+        if re.search(pattern, text):
+            add(chart_type, 1.0, f"Requested explicitly in the prompt. {CHART_TYPE_PURPOSES[chart_type]}")
+
+    for pattern, weights in INTENT_RULES:
+        match = re.search(pattern, text)
+        if match:
+            for chart_type, weight in weights.items():
+                add(chart_type, weight, f"{CHART_TYPE_PURPOSES[chart_type]}, which fits the request's focus on '{match.group(0)}'")
+
+    # Shape of any inline data: labelled values, ordered (time-like) labels, percentages adding up to 100
+    table = extract_inline_data(user_prompt)
+    if table and len(table["labels"]) >= 3:
+        labels = [str(label).strip() for label in table["labels"]]
+        add("bar", 0.3, f"{CHART_TYPE_PURPOSES['bar']}, matching the {len(labels)} labelled values provided")
+        readable = ~np.isnan(read_series_x(labels, month_names=True, fuzzy_dates=False))
+        ordered = sum(1 for label, read in zip(labels, readable)
+                      if read or TIME_LABEL_PATTERN.match(label.lower().split()[-1]))
+        if ordered >= len(labels) / 2:
+            add("line", 0.8, f"{CHART_TYPE_PURPOSES['line']}, matching the time-ordered values provided")
+            add("area", 0.3, f"{CHART_TYPE_PURPOSES['area']}, matching the time-ordered values provided")
+        first_series = next(iter(table["series"].values()))
+        if table["percent"] and abs(sum(first_series) - 100) <= 2:
+            add("pie", 0.8, f"{CHART_TYPE_PURPOSES['pie']}, and the percentages provided add up to 100%")
+
+    if not scores:
+        return None, 0.0
+
+    ranked = sorted(scores, key=lambda chart_type: scores[chart_type], reverse=True)
+    confidence = min(1.0, scores[ranked[0]])
+    # A tie for first place means the rules can't tell the intent apart
+    if len(ranked) > 1 and scores[ranked[1]] >= scores[ranked[0]] and confidence < 1.0:
+        confidence *= 0.75
+
+    chosen = [chart_type for chart_type in ranked if scores[chart_type] >= 0.3][:3] or ranked[:1]
+    for chart_type in COMPLEMENTARY_CHART_TYPES[chosen[0]] + [d["chart_type"] for d in DEFAULT_RECOMMENDATIONS]:
+        if len(chosen) >= 3:
+            break
+        if chart_type not in chosen:
+            chosen.append(chart_type)
+            reasons.setdefault(chart_type, f"{CHART_TYPE_PURPOSES[chart_type]}, as an alternative view of the same data")
+
+    return [{"chart_type": chart_type, "reason": reasons[chart_type]} for chart_type in chosen], confidence
+
+@timed("recommendation")
+def get_chart_recommendations(user_prompt):
+    """Ask Gemini for the 3 most appropriate chart types, falling back to defaults"""
+    try:
+        recommended_chart_types = None
+        path = "near_duplicate"
+        if not cache_bypass.get():
+            recommended_chart_types = near_duplicate_cache.lookup(user_prompt, "recommendation")
+        if recommended_chart_types is None:
+            # Obvious requests don't need a model round trip
+            local_recommendations, confidence = recommend_chart_types_locally(user_prompt)
+            if local_recommendations and confidence >= LOCAL_RECOMMENDER_THRESHOLD:
+                logger.info(f"Using local chart recommendations (confidence {confidence:.2f})")
+                recommended_chart_types, path = local_recommendations, "local"
+        if recommended_chart_types is None and recommendation_batcher and not cache_bypass.get():
+            budget = request_budget.get()
+            timeout = budget.stage_timeout("recommendation") if budget is not None else MODEL_CALL_TIMEOUT_SECONDS
+            # With too little budget to also sit out the batch window, call the model directly
+            if timeout >= MIN_MODEL_CALL_SECONDS + recommendation_batcher.window_seconds:
+                recommended_chart_types, path = recommendation_batcher.submit(user_prompt, timeout), "batched"
+        if recommended_chart_types is None:
+            recommended_chart_types, path = fetch_chart_recommendations(user_prompt), "model"
+        if recommended_chart_types and path in ("batched", "model"):
+            near_duplicate_cache.store(user_prompt, "recommendation", recommended_chart_types)
+        count_recommendation_path(path)
+
+        # Validate we have at least 3 recommendations
+        if len(recommended_chart_types) < 3:
+            # Add only the needed ones
+            for i in range(3 - len(recommended_chart_types)):
+                # Find a default type that isn't already recommended
+                for default in DEFAULT_RECOMMENDATIONS:
+                    if not any(r.get("chart_type") == default["chart_type"] for r in recommended_chart_types):
+                        recommended_chart_types.append(dict(default))
+                        break
+
+        # Ensure we have exactly 3 chart types
+        recommended_chart_types = recommended_chart_types[:3]
+
+        logger.info(f"Recommended chart types: {[r.get('chart_type') for r in recommended_chart_types]}")
+    except Exception as e:
+        logger.error(f"Error getting chart recommendations: {str(e)}")
+        if isinstance(e, ModelUnavailableError):
+            note_degradation("default_recommendations")
+        count_recommendation_path("default")
+        # Default recommendations if the API call fails
+        recommended_chart_types = [dict(default) for default in DEFAULT_RECOMMENDATIONS]
+
+    return recommended_chart_types
+
+@timed("parse")
+def parse_general_info(user_prompt):
+    """Ask Gemini for the general title/axes/palette requirements of the request"""
+    parsing_prompt = f"""
+    You are a data specification parser responsible for extracting GENERAL visualization requirements.
+
+    USER REQUEST: {condense_inline_data(user_prompt)}
+
+    CRITICAL INSTRUCTIONS:
+    Extract the following general information. Focus on high-level details. Defer detailed data point extraction.
+
+    1. data_description: General description of what the user wants to visualize.
+    2. x_axis: Suggested label for the x-axis (e.g., "Categories", "Time", "Value"). Use null if unclear.
+    3. y_axis: Suggested label for the y-axis (e.g., "Count", "Sales", "Measurement"). Use null if unclear.
+    4. title: Suggested clear, descriptive title. Use null if unclear.
+    5. subtitle: Optional subtitle providing additional context. Use null if none suggested.
+    6. palette: Color palette suggestion if mentioned (e.g., 'viridis', 'Blues'). Use null if not mentioned.
+
+    RESPONSE FORMAT:
+    Return ONLY a valid JSON object with these exact fields. No explanation text, no markdown formatting.
+
+    STRICT REQUIREMENTS:
+    - Every field MUST be present (use null for truly unknown values).
+    - Do NOT extract specific data points or detailed data structures yet.
+    - Keep descriptions concise.
+    """
+
+    general_parsed_info = None
+    if not cache_bypass.get():
+        general_parsed_info = near_duplicate_cache.lookup(user_prompt, "parse")
+    if general_parsed_info is None:
+        try:
+            general_parsed_info = generate_model_json(parsing_prompt, "parse")
+            near_duplicate_cache.store(user_prompt, "parse", general_parsed_info)
+        except ModelUnavailableError as e:
+            # Out of time or the model is failing: the local defaults below are good enough
+            logger.warning(f"Skipping general parse: {e.message}")
+            note_degradation("local_general_defaults")
+            general_parsed_info = {}
+
+    # Add default values if necessary
+    default_fields = {'title': 'Generated Chart', 'x_axis': 'X-Axis', 'y_axis': 'Y-Axis', 'data_description': user_prompt, 'subtitle': None, 'palette': 'viridis'}
+    for field, default_value in default_fields.items():
+        if field not in general_parsed_info or general_parsed_info[field] is None:
+            general_parsed_info[field] = default_value
+            logger.warning(f"Missing or null general info field: '{field}', using default: '{default_value}'")
+
+    logger.info(f"General Parsed Info: {json.dumps(general_parsed_info, indent=2)}")
+    return general_parsed_info
+
+def build_extraction_prompt(chart_type, user_prompt, general_parsed_info):
+    """Build the prompt asking Gemini to extract (or describe) the data for one chart type"""
+    return f"""
+    You are a data extraction expert focused on the '{chart_type}' chart type.
+    Analyze the user's request and general info provided below.
+
+    USER REQUEST: {user_prompt}
+    GENERAL INFO: {json.dumps(general_parsed_info)}
+    TARGET CHART TYPE: {chart_type}
+
+    CRITICAL INSTRUCTIONS:
+    1. Determine if the USER REQUEST contains specific data points/values suitable for a '{chart_type}' chart.
+    2. If YES (specific data found):
+       - Extract the EXACT data points relevant for the '{chart_type}' chart.
+       - Format them correctly into the appropriate structure for a '{chart_type}' chart.
+       - For standard charts: Use `x_values`, `y_values` for basic data.
+       - For pie chart: Use `labels` and `sizes`.
+       - For heatmap: Use `x_values` (column labels), `y_values` (row labels), and `z_values` (2D matrix).
+       - For boxplot/violin: Use `x_values` (categories) and `distributions` (list of lists).
+       - For radar chart: Use `categories` (axis labels) and `values` (data points).
+       - For treemap: Use `labels` (rectangle labels), `parents` (hierarchy), and `sizes` (rectangle sizes).
+       - For funnel: Use `stages` (stage names) and `values` (values for each stage).
+       - Set `exact_data_provided` to true.
+       - Set `data_specifications` to null.
+    3. If NO (no specific data found):
+       - Describe the data needed for a '{chart_type}' chart based on the request in `data_specifications`.
+       - Set `exact_data_provided` to false.
+       - Include the EXACT field names required for this chart type in your response.
+    4. Refine `x_axis` and `y_axis` labels specifically for this '{chart_type}' based on the extracted/specified data.
+    5. Refine `title` and `subtitle` if the user request gives more specific context for this chart type.
+
+    RESPONSE FORMAT:
+    Return ONLY a valid JSON object with these exact fields:
+    {{
+        "exact_data_provided": boolean,
+        // Include ONLY the appropriate fields for this chart type below:
+        "x_values": list | null,
+        "y_values": list | null,
+        "labels": list | null, // For pie, treemap
+        "sizes": list | null, // For pie, bubble, treemap
+        "categories": list | null, // For radar
+        "values": list | null, // For radar
+        "z_values": list[list] | null, // For heatmap
+        "distributions": list[list] | list | null, // For box/violin
+        "groups": list | null, // For stacked_bar, boxplot, violin
+        "stages": list | null, // For funnel
+        "values": list | null, // For funnel
+        "parents": list | null, // For treemap
+        // --- End chart-specific keys ---
+        "data_specifications": string | null, // Description for AI generation if no exact data
+        "x_axis": string, // Refined X-axis label
+        "y_axis": string, // Refined Y-axis label
+        "title": string, // Refined title
+        "subtitle": string | null // Refined subtitle
+    }}
+
+    REQUIREMENTS:
+    - Adhere strictly to the JSON format. No extra text.
+    - Include ONLY the fields relevant to this chart type.
+    - Preserve user's exact wording and values when `exact_data_provided` is true.
+    """
+
+def array_of(item_type):
+    return {"type": "array", "items": {"type": item_type}}
+
+def chart_data_schema(required, **fields):
+    """Build a Gemini response schema for one chart type's data payload"""
+    properties = {"data_source": {"type": "string"}}
+    properties.update(fields)
+    return {"type": "object", "properties": properties, "required": list(required)}
+
+# Data payload each chart type is rendered from; sent to Gemini as the structured-output
+# schema for data generation and checked locally before rendering
+CHART_DATA_SCHEMAS = {
+    "bar": chart_data_schema(["x_values", "y_values"], x_values=array_of("string"), y_values=array_of("number")),
+    "line": chart_data_schema(["x_values", "y_values"], x_values=array_of("string"), y_values=array_of("number")),
+    "area": chart_data_schema(["x_values", "y_values"], x_values=array_of("string"), y_values=array_of("number")),
+    "pie": chart_data_schema(["labels", "sizes"], labels=array_of("string"), sizes=array_of("number")),
+    "scatter": chart_data_schema(["x_values", "y_values"], x_values=array_of("number"), y_values=array_of("number"),
+                                 categories=array_of("string")),
+    "bubble": chart_data_schema(["x_values", "y_values"], x_values=array_of("number"), y_values=array_of("number"),
+                                sizes=array_of("number")),
+    "histogram": chart_data_schema(["y_values"], y_values=array_of("number")),
+    "heatmap": chart_data_schema(["x_values", "y_values", "z_values"], x_values=array_of("string"), y_values=array_of("string"),
+                                 z_values={"type": "array", "items": array_of("number")}),
+    "boxplot": chart_data_schema(["x_values", "distributions"], x_values=array_of("string"),
+                                 distributions={"type": "array", "items": array_of("number")}),
+    "violin": chart_data_schema(["x_values", "distributions"], x_values=array_of("string"),
+                                distributions={"type": "array", "items": array_of("number")}),
+    "stacked_bar": chart_data_schema(["x_values", "y_values"], x_values=array_of("string"), y_values=array_of("number"),
+                                     groups=array_of("string")),
+    "radar": chart_data_schema(["categories", "values"], categories=array_of("string"), values=array_of("number")),
+    "treemap": chart_data_schema(["labels", "sizes"], labels=array_of("string"), sizes=array_of("number"),
+                                 parents=array_of("string")),
+    "funnel": chart_data_schema(["stages", "values"], stages=array_of("string"), values=array_of("number")),
+}
+
+# Fields that must line up one-to-one, checked after the schema itself
+CHART_DATA_PAIRED_FIELDS = {
+    "bar": [("x_values", "y_values")],
+    "line": [("x_values", "y_values")],
+    "area": [("x_values", "y_values")],
+    "pie": [("labels", "sizes")],
+    "scatter": [("x_values", "y_values")],
+    "bubble": [("x_values", "y_values"), ("x_values", "sizes")],
+    "heatmap": [("y_values", "z_values")],
+    "boxplot": [("x_values", "distributions")],
+    "violin": [("x_values", "distributions")],
+    "stacked_bar": [("x_values", "y_values"), ("x_values", "groups")],
+    "radar": [("categories", "values")],
+    "treemap": [("labels", "sizes")],
+    "funnel": [("stages", "values")],
+}
+
+# Histograms built from aggregated uploads arrive already binned
+PREBINNED_HISTOGRAM_SCHEMA = chart_data_schema(["bin_edges", "counts"], bin_edges=array_of("number"), counts=array_of("number"))
+
+def chart_data_generation_config(chart_type):
+    """Structured-output configuration for the data generation call of one chart type"""
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": CHART_DATA_SCHEMAS.get(chart_type, CHART_DATA_SCHEMAS["bar"])
+    }
+
+def schema_errors(value, schema, path):
+    """List where value does not match schema; scalars are checked the way the renderer reads them"""
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        if not isinstance(value, dict):
+            return [f"{path} must be an object"]
+        errors = [f"{path}.{field} is required" for field in schema.get("required", []) if value.get(field) is None]
+        for field, field_schema in schema.get("properties", {}).items():
+            if value.get(field) is not None:
+                errors.extend(schema_errors(value[field], field_schema, f"{path}.{field}"))
+        return errors
+    if schema_type == "array":
+        if not isinstance(value, list):
+            return [f"{path} must be a list"]
+        if not value:
+            return [f"{path} must not be empty"]
+        errors = []
+        for i, item in enumerate(value):
+            errors.extend(schema_errors(item, schema["items"], f"{path}[{i}]"))
+            if len(errors) >= 5:
+                break
+        return errors
+    if schema_type == "number":
+        if isinstance(value, bool):
+            return [f"{path} must be a number"]
+        if isinstance(value, (int, float)):
+            return []
+        try:
+            float(value)
+            return []
+        except (ValueError, TypeError):
+            return [f"{path} must be a number"]
+    if schema_type == "string":
+        return [] if isinstance(value, (str, int, float)) and not isinstance(value, bool) else [f"{path} must be a string"]
+    return []
+
+def validate_chart_data(chart_type, chart_data):
+    """Reject chart data that does not match its chart type's schema before any rendering work"""
+    # Unknown chart types are rendered as bar charts
+    schema_type = chart_type if chart_type in CHART_DATA_SCHEMAS else "bar"
+    if schema_type == "histogram" and isinstance(chart_data, dict) and "bin_edges" in chart_data:
+        errors = schema_errors(chart_data, PREBINNED_HISTOGRAM_SCHEMA, "chart_data")
+        if not errors and len(chart_data["bin_edges"]) != len(chart_data["counts"]) + 1:
+            errors.append("bin_edges must have one more entry than counts")
+        if errors:
+            raise DiagramError(f"[{chart_type}] Invalid chart data: {'; '.join(errors[:5])}")
+        return
+    errors = schema_errors(chart_data, CHART_DATA_SCHEMAS[schema_type], "chart_data")
+    if not errors:
+        for first, second in CHART_DATA_PAIRED_FIELDS.get(schema_type, []):
+            if chart_data.get(second) is not None and len(chart_data[first]) != len(chart_data[second]):
+                errors.append(f"{first} and {second} must have the same length ({len(chart_data[first])} != {len(chart_data[second])})")
+        if schema_type == "heatmap" and any(len(row) != len(chart_data["x_values"]) for row in chart_data["z_values"]):
+            errors.append("every z_values row must have one value per x_values entry")
+    if errors:
+        raise DiagramError(f"[{chart_type}] Invalid chart data: {'; '.join(errors[:5])}")
+
+def build_chart(recommendation, user_prompt, general_parsed_info, render_images=True):
+    """Run the extract -> generate -> render chain for one recommended chart type"""
+    chart_type = recommendation.get("chart_type", "bar").lower()
+    reason = recommendation.get("reason", "")
+
+    logger.info(f"--- Processing chart type: {chart_type} ---")
+    timing_chart_type.set(chart_type)
+
+    # --- Chart-Specific Extraction ---
+    stage_started = time.perf_counter()
+    dataset = request_dataset.get()
+    inline_table = extract_inline_data(user_prompt) if dataset is None else None
+    local_chart_data = build_local_chart_data(chart_type, inline_table) if inline_table else None
+    if dataset is not None:
+        # Uploaded data is already aggregated locally; only its shape ever went to the model
+        dataset_chart_data = dataset.chart_data(chart_type)
+        if dataset_chart_data is None:
+            raise DiagramError(f"The uploaded data can't be shown as a {chart_type} chart")
+        x_axis, y_axis = dataset.axis_labels(chart_type)
+        specific_info = dict(dataset_chart_data)
+        specific_info.update({
+            "exact_data_provided": True,
+            "data_specifications": None,
+            "x_axis": x_axis,
+            "y_axis": y_axis,
+            "title": general_parsed_info["title"],
+            "subtitle": general_parsed_info["subtitle"]
+        })
+    elif local_chart_data:
+        # Data pasted into the prompt is parsed locally, no extraction call needed
+        logger.info(f"[{chart_type}] Using locally parsed inline data")
+        single_named_series = inline_table["label_name"] and len(inline_table["series"]) == 1
+        specific_info = dict(local_chart_data)
+        specific_info.update({
+            "exact_data_provided": True,
+            "data_specifications": None,
+            "x_axis": inline_table["label_name"] or general_parsed_info["x_axis"],
+            "y_axis": next(iter(inline_table["series"])) if single_named_series else general_parsed_info["y_axis"],
+            "title": general_parsed_info["title"],
+            "subtitle": general_parsed_info["subtitle"]
+        })
+    else:
+        extraction_prompt = build_extraction_prompt(chart_type, user_prompt, general_parsed_info)
+        specific_info = generate_model_json(extraction_prompt, "extraction")
+    record_stage_timing("extraction", time.perf_counter() - stage_started)
+    logger.info(f"[{chart_type}] Specific Info Extracted: {json.dumps(specific_info, indent=2)}")
+
+    # --- Chart-Specific Data Generation ---
+    stage_started = time.perf_counter()
+    specific_chart_data = None
+    if specific_info.get("exact_data_provided"):
+        logger.info(f"[{chart_type}] Using user-specified data.")
+        # Use extracted data directly, validate basic structure
+        extracted_data = {
+            "data_source": specific_info.get("data_source", "user_specified")
+        }
+
+        # Add only the relevant keys for this chart type
+        for key in ["x_values", "y_values", "labels", "sizes", "categories", "values",
+                   "z_values", "distributions", "groups", "stages", "parents", "bin_edges", "counts"]:
+            if specific_info.get(key) is not None:
+                extracted_data[key] = specific_info[key]
+
+        # Validate that we have the necessary data for this chart type
+        if chart_type == 'radar' and 'categories' not in extracted_data and 'values' not in extracted_data:
+            if 'x_values' in extracted_data and 'y_values' in extracted_data:
+                extracted_data['categories'] = extracted_data['x_values']
+                extracted_data['values'] = extracted_data['y_values']
+            else:
+                raise DiagramError(f"[{chart_type}] Missing required fields: categories and values")
+
+        elif chart_type == 'treemap' and 'labels' not in extracted_data and 'sizes' not in extracted_data:
+            if 'x_values' in extracted_data and 'y_values' in extracted_data:
+                extracted_data['labels'] = extracted_data['x_values']
+                extracted_data['sizes'] = extracted_data['y_values']
+            else:
+                raise DiagramError(f"[{chart_type}] Missing required fields: labels and sizes")
+
+        elif chart_type == 'funnel' and 'stages' not in extracted_data and 'values' not in extracted_data:
+            if 'x_values' in extracted_data and 'y_values' in extracted_data:
+                extracted_data['stages'] = extracted_data['x_values']
+                extracted_data['values'] = extracted_data['y_values']
+            else:
+                raise DiagramError(f"[{chart_type}] Missing required fields: stages and values")
+
+        elif chart_type == 'pie' and 'labels' not in extracted_data and 'sizes' not in extracted_data:
+            if 'x_values' in extracted_data and 'y_values' in extracted_data:
+                extracted_data['labels'] = extracted_data['x_values']
+                extracted_data['sizes'] = extracted_data['y_values']
+
+        elif chart_type in ('boxplot', 'violin') and 'distributions' not in extracted_data:
+            if isinstance(extracted_data.get('y_values'), list):
+                # A flat list of values is one distribution
+                extracted_data['distributions'] = [extracted_data['y_values']]
+                extracted_data['x_values'] = [specific_info.get('y_axis') or 'Values']
+
+        specific_chart_data = extracted_data
+    else:
+        logger.info(f"[{chart_type}] Generating AI data based on specifications.")
+        chart_specific_data_generation_prompt = f"""
+        You are a data generation expert for '{chart_type}' charts.
+        Generate data based ONLY on the specifications below.
+
+        TARGET CHART TYPE: {chart_type}
+        DATA SPECIFICATIONS: {specific_info.get("data_specifications", general_parsed_info["data_description"])}
+        X-AXIS HINT: {specific_info.get("x_axis")}
+        Y-AXIS HINT: {specific_info.get("y_axis")}
+
+        CRITICAL INSTRUCTIONS:
+        1. Generate realistic data points (aim for 8-12 points unless specifications dictate otherwise) suitable for a '{chart_type}' chart.
+        2. Structure the output based on the TARGET CHART TYPE:
+           - Bar/Line: Include `x_values` and `y_values`.
+           - Pie/Treemap: Include `labels` and `sizes`.
+           - Radar: Include `categories` and `values`.
+           - Heatmap: Include `x_values`, `y_values`, and `z_values` (2D matrix).
+           - Box/Violin: Include `x_values` (group labels) and `distributions` (list of lists).
+           - Funnel: Include `stages` and `values`.
+        3. ONLY include fields relevant to this chart type.
+        4. Ensure data structures have compatible lengths for the chart type.
+
+        RETURN FORMAT:
+        Return ONLY a valid JSON object containing the generated data. Include `data_source` set to "ai_generated".
+        """
+        specific_chart_data = generate_model_json(chart_specific_data_generation_prompt, "data_generation",
+                                                  chart_data_generation_config(chart_type))
+
+        # Add data_source if missing
+        if "data_source" not in specific_chart_data:
+            specific_chart_data["data_source"] = "ai_generated"
+
+        logger.info(f"[{chart_type}] AI-generated data: {json.dumps(specific_chart_data)}")
+    record_stage_timing("data_generation", time.perf_counter() - stage_started)
+
+    # --- Prepare final info for chart generation ---
+    chart_parsed_info = general_parsed_info.copy() # Start with general info
+    chart_parsed_info.update(specific_info) # Override with specific info (title, axes etc)
+    chart_parsed_info["chart_type"] = chart_type # Ensure chart_type is set
+    # Remove fields that don't belong in final parsed info for the image function
+    for key in ["exact_data_provided", "data_specifications", "x_values", "y_values", "labels", "sizes", "categories", "z_values", "distributions", "groups", "stages", "parents", "bin_edges", "counts", "data_source"]:
+         chart_parsed_info.pop(key, None)
+
+    logger.info(f"[{chart_type}] Final chart info for generation: {json.dumps(chart_parsed_info)}")
+    logger.info(f"[{chart_type}] Final chart data for generation: {json.dumps(specific_chart_data)}")
+
+    # --- Generate Chart Image ---
+    validate_chart_data(chart_type, specific_chart_data)
+    chart_result = {
+        "chart_type": chart_type,
+        "reason": reason,
+        "image": None,
+        "parsed_info": chart_parsed_info, # Pass the refined info
+        "chart_data": specific_chart_data # Also return the specific data used
+    }
+    if render_images:
+        chart_result["image"] = generate_chart_image(chart_type, specific_chart_data, chart_parsed_info)
+        logger.info(f"Generated {chart_type} chart successfully")
+    return store_chart(chart_result)
+
+def build_chart_safely(recommendation, user_prompt, general_parsed_info, render_images=True):
+    """Run build_chart, returning (chart_result, error_entry) so one failed chart never aborts the others"""
+    chart_type = recommendation.get("chart_type", "bar").lower()
+    try:
+        return build_chart(recommendation, user_prompt, general_parsed_info, render_images), None
+    except DiagramError as e: # Catch DiagramErrors specifically to report them
+        error_msg = f"Error generating {chart_type} chart: {e.message}"
+        logger.error(error_msg)
+        return None, {"chart_type": chart_type, "error": e.message}
+    except Exception as e: # Catch unexpected errors
+        error_msg = f"Unexpected error generating {chart_type} chart: {str(e)}"
+        logger.exception(error_msg) # Log stack trace for unexpected errors
+        return None, {"chart_type": chart_type, "error": f"An unexpected error occurred: {str(e)}"}
+
+@timed("fallback")
+def generate_fallback_chart(user_prompt, general_parsed_info, error_messages, render_images=True):
+    """Generate a simple bar chart when every recommended chart failed"""
+    logger.warning("All recommended charts failed, attempting fallback bar chart")
+    try:
+        # Simplified extraction/generation for fallback bar chart
+        fallback_chart_type = "bar"
+        logger.info(f"--- Processing fallback: {fallback_chart_type} ---")
+
+        # Minimal info extraction for fallback
+        fallback_specific_info = {
+            "exact_data_provided": False, # Assume AI generation for fallback
+            "data_specifications": f"Create a simple bar chart based on the user request: {user_prompt}. Use generic categories and values if necessary.",
+            "x_axis": general_parsed_info['x_axis'],
+            "y_axis": general_parsed_info['y_axis'],
+            "title": f"{general_parsed_info['title']} (Fallback Bar Chart)",
+            "subtitle": general_parsed_info['subtitle']
+        }
+
+        # Minimal data generation for fallback
+        fallback_data_gen_prompt = f"""
+        Generate simple data for a fallback 'bar' chart.
+        SPECIFICATIONS: {fallback_specific_info['data_specifications']}
+        Return JSON: {{"x_values": ["Cat1", "Cat2", "Cat3"], "y_values": [5, 8, 3], "data_source": "ai_generated_fallback"}}
+        """
+        try:
+            dataset = request_dataset.get()
+            if dataset is not None:
+                raise ModelUnavailableError("Uploaded data is charted from its local aggregates")
+            if model_breaker.is_open():
+                raise ModelUnavailableError("The AI model is temporarily unavailable")
+            fallback_chart_data = generate_model_json(fallback_data_gen_prompt, "fallback", chart_data_generation_config(fallback_chart_type))
+        except ModelUnavailableError as e:
+            # No time or no model left: go straight to the hardcoded data below
+            logger.warning(f"Skipping fallback data generation: {e.message}")
+            if dataset is not None:
+                fallback_chart_data = dataset.chart_data(fallback_chart_type)
+            else:
+                note_degradation("hardcoded_fallback_data")
+                fallback_chart_data = {}
+        if "data_source" not in fallback_chart_data: fallback_chart_data["data_source"] = "ai_generated_fallback"
+        try:
+            validate_chart_data(fallback_chart_type, fallback_chart_data)
+        except DiagramError as e:
+            logger.warning(f"Discarding fallback data: {e.message}")
+            fallback_chart_data = {"x_values": ["FB_Cat1", "FB_Cat2", "FB_Cat3"], "y_values": [5, 8, 3], "data_source": "ai_generated_fallback_hardcoded"} # Hardcoded fallback
+
+        fallback_parsed_info = general_parsed_info.copy()
+        fallback_parsed_info.update({k: v for k, v in fallback_specific_info.items() if k in ['x_axis', 'y_axis', 'title', 'subtitle', 'palette']})
+        fallback_parsed_info["chart_type"] = fallback_chart_type
+
+        logger.info(f"[Fallback] Final chart info: {json.dumps(fallback_parsed_info)}")
+        logger.info(f"[Fallback] Final chart data: {json.dumps(fallback_chart_data)}")
+
+        fallback_result = {
+            "chart_type": fallback_chart_type,
+            "reason": "Fallback chart type when others failed",
+            "image": None,
+            "parsed_info": fallback_parsed_info,
+            "chart_data": fallback_chart_data
+        }
+        if render_images:
+            fallback_result["image"] = generate_chart_image(fallback_chart_type, fallback_chart_data, fallback_parsed_info)
+            logger.info("Generated fallback bar chart successfully")
+        return store_chart(fallback_result)
+
+    except Exception as e:
+        logger.error(f"Even fallback chart failed: {str(e)}")
+        # If even the fallback fails, report the original errors if any, or a generic message
+        if error_messages:
+            failure_reason = f"Failed to generate any charts. Errors encountered: {json.dumps(error_messages)}"
+        else:
+            failure_reason = f"Failed to generate fallback chart: {str(e)}"
+        raise DiagramError(failure_reason)
+
+class SingleFlight:
+    """Coalesces identical in-flight computations: one caller runs it, the others wait and share the outcome"""
+
+    def __init__(self, wait_timeout_seconds):
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {"executed": 0, "coalesced": 0, "wait_timeouts": 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self.calls[key] = call
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            try:
+                call.set_result(fn())
+            except BaseException as e:
+                # Every waiter sees the same failure
+                call.set_exception(e)
+            finally:
+                with self.lock:
+                    self.calls.pop(key, None)
+            return call.result()
+
+        logger.info("Waiting for an identical request already in progress")
+        try:
+            return call.result(timeout=self.wait_timeout_seconds)
+        except FutureTimeoutError:
+            with self.lock:
+                self.stats["wait_timeouts"] += 1
+            raise DiagramError("Timed out waiting for an identical request in progress", 504)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.calls))
+
+def prompt_template_version():
+    """Version of the disk cache entries: a hash of the prompt builders and the parser producing the stored values
+
+    Editing a template or the repair that shapes parsed replies moves to a new version, so stale entries are
+    purged at startup without anyone having to remember a bump.
+    """
+    sources = [inspect.getsource(fn) for fn in (build_recommendation_prompt, build_batch_recommendation_prompt,
+                                               parse_general_info, build_extraction_prompt, build_chart,
+                                               scan_json_value)]
+    return int(hashlib.sha256("\n".join(sources).encode('utf-8')).hexdigest()[:15], 16)
+
+disk_cache_path = os.getenv("DISK_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "stage_cache.sqlite3"))
+if disk_cache_path:
+    try:
+        disk_cache = DiskResponseCache(
+            disk_cache_path,
+            max_bytes=int(os.getenv("DISK_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+            schema_version=prompt_template_version()
+        )
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Could not open disk cache at {disk_cache_path}, continuing without it: {str(e)}")
+
+single_flight = SingleFlight(wait_timeout_seconds=float(os.getenv("SINGLE_FLIGHT_TIMEOUT_SECONDS", "60")))
+
+def normalize_prompt_key(prompt):
+    """Normalize a prompt for request coalescing: case and whitespace differences don't matter"""
+    return " ".join(prompt.lower().split())
+
+def run_diagram_pipeline(user_prompt, on_event=None, render_images=True, cancelled=None):
+    """Run the full recommend -> parse -> per-chart pipeline, using the stage executor for independent calls
+
+    If on_event is given it is called as on_event(event_name, payload) as soon as each piece of the
+    result is ready: "recommendations", then "chart" or "chart_error" for every chart as it finishes.
+    With render_images=False charts come back as specs whose images are rendered by /api/render/<spec_id>.
+    Once the cancelled event is set no further model calls or renders start and the pipeline raises
+    RequestCancelledError.
+    """
+    emit = on_event or (lambda event, payload: None)
+
+    # Every model call made for this request (including on stage threads) shares one deadline
+    budget = RequestBudget(REQUEST_DEADLINE_SECONDS, cancelled)
+    budget_token = request_budget.set(budget)
+    timings = RequestTimings()
+    timings_token = request_timings.set(timings)
+    dataset = request_dataset.get()
+    if dataset is not None and dataset.parse_seconds is not None and not dataset.registered:
+        # The upload was parsed before the pipeline started; count it towards this request
+        timings.add("stages", {"stage": "upload_parse", "chart_type": None, "seconds": round(dataset.parse_seconds, 4)})
+    try:
+        result = execute_diagram_pipeline(user_prompt, budget, emit, render_images)
+    finally:
+        request_budget.reset(budget_token)
+        request_timings.reset(timings_token)
+
+    result["degradations"] = budget.degradations or None
+    result["timings"] = timings.summary()
+    stage_totals = {}
+    for entry in result["timings"]["stages"]:
+        stage_totals[entry["stage"]] = stage_totals.get(entry["stage"], 0) + entry["seconds"]
+    logger.info(f"Pipeline finished in {result['timings']['total_seconds']:.2f}s: " +
+                ", ".join(f"{stage}={seconds:.2f}s" for stage, seconds in stage_totals.items()))
+    return result
+
+def execute_diagram_pipeline(user_prompt, budget, emit, render_images=True):
+    """Pipeline body for run_diagram_pipeline, degrading gracefully as the request budget runs out"""
+    # Step 1 & 2: Recommendation and general parsing don't depend on each other
+    recommendation_future = submit_stage(get_chart_recommendations, user_prompt)
+    parsing_future = submit_stage(parse_general_info, user_prompt)
+    recommended_chart_types = recommendation_future.result()
+    emit("recommendations", {"recommended_chart_types": recommended_chart_types})
+    general_parsed_info = parsing_future.result()
+    raise_if_cancelled()
+
+    # Decide how many chart chains still fit in the budget
+    remaining = budget.remaining()
+    if model_breaker.is_open() or remaining < CHART_CHAIN_MIN_SECONDS:
+        budget.degrade("fallback_chart_only")
+        recommended_chart_types = []
+    elif remaining < FULL_CHARTS_MIN_SECONDS:
+        budget.degrade("reduced_chart_count")
+        recommended_chart_types = recommended_chart_types[:1]
+
+    # Step 3 & 4: Each chart's extract -> generate -> render chain runs concurrently
+    chart_futures = {
+        submit_stage(build_chart_safely, recommendation, user_prompt, general_parsed_info, render_images): index
+        for index, recommendation in enumerate(recommended_chart_types)
+    }
+
+    outcomes = [None] * len(chart_futures)
+    for future in as_completed(chart_futures):
+        chart_result, error_entry = future.result()
+        outcomes[chart_futures[future]] = (chart_result, error_entry)
+        if chart_result:
+            emit("chart", chart_result)
+        else:
+            emit("chart_error", error_entry)
+
+    chart_results = []
+    error_messages = []
+    # Collect in recommendation order so the response stays stable
+    for chart_result, error_entry in outcomes:
+        if chart_result:
+            chart_results.append(chart_result)
+        else:
+            error_messages.append(error_entry)
+
+    # If all charts failed, try to generate a simple bar chart as fallback
+    if len(chart_results) == 0:
+        raise_if_cancelled()
+        fallback_chart = generate_fallback_chart(user_prompt, general_parsed_info, error_messages, render_images)
+        chart_results.append(fallback_chart)
+        emit("chart", fallback_chart)
+
+    return {
+        "charts": chart_results,
+        "error_messages": error_messages if error_messages else None # Keep error messages
+    }
+
+def get_diagram_prompt():
+    """Validate the diagram request body (JSON, or multipart with an uploaded data file) and return the user prompt
+
+    A dataset_id of a registered dataset stands in for uploading the file again.
+    """
+    uploaded_file = request.files.get('file')
+    data = request.form if uploaded_file else request.get_json(silent=True)
+    if not data:
+        raise DiagramError("No data provided")
+
+    user_prompt = data.get('prompt')
+    if not user_prompt:
+        raise DiagramError("No prompt provided")
+
+    logger.info(f"Processing diagram request: {user_prompt[:50]}...")
+    cache_bypass.set(wants_cache_bypass())
+    dataset_id = data.get('dataset_id')
+    if uploaded_file and dataset_id:
+        raise DiagramError("Send either a file or a dataset_id, not both")
+    if dataset_id:
+        dataset = dataset_registry.get(dataset_id)
+        if dataset is None:
+            raise DiagramError("Dataset not found or evicted, please upload it again", 404)
+    elif uploaded_file:
+        dataset = read_request_upload(uploaded_file, user_prompt, data)
+    else:
+        dataset = None
+    # Set on every request: worker threads are reused, and a previous request's upload must not carry over
+    request_dataset.set(dataset)
+    if dataset is not None:
+        # The model only sees the shape of the data; charts are built from the local aggregates
+        user_prompt = f"{user_prompt}\n\n{dataset.describe()}"
+    return user_prompt
+
+def read_request_upload(uploaded_file, user_prompt, data):
+    """Read a multipart upload with its optional column binding and filter fields"""
+    return read_uploaded_file(
+        uploaded_file,
+        user_prompt,
+        filters=data.get('filters'),
+        label_column=data.get('x_column'),
+        value_column=data.get('y_column'),
+        group_column=data.get('group_column'),
+        aggregation=data.get('aggregation')
+    )
+
+@app.route('/api/datasets', methods=['POST'])
+@handle_errors
+@limiter.limit("10 per minute")
+def register_dataset():
+    """Upload a data file once and get a dataset_id to reuse in diagram requests"""
+    uploaded_file = request.files.get('file')
+    if not uploaded_file:
+        raise DiagramError("No file provided")
+    # The optional prompt only steers which columns are bound when none are named
+    dataset = read_request_upload(uploaded_file, request.form.get('prompt', ''), request.form)
+    size = dataset_registry.add(dataset)
+    return jsonify({"dataset_id": dataset.dataset_id, "bytes": size, "profile": dataset.profile()}), 201
+
+@app.route('/api/datasets/<dataset_id>', methods=['GET'])
+@handle_errors
+@limiter.limit("60 per minute")
+def get_dataset(dataset_id):
+    dataset = dataset_registry.get(dataset_id)
+    if dataset is None:
+        raise DiagramError("Dataset not found or evicted", 404)
+    return jsonify({"dataset_id": dataset_id, "profile": dataset.profile()})
+
+@app.route('/api/datasets/<dataset_id>', methods=['DELETE'])
+@handle_errors
+@limiter.limit("60 per minute")
+def delete_dataset(dataset_id):
+    if not dataset_registry.remove(dataset_id):
+        raise DiagramError("Dataset not found or evicted", 404)
+    return jsonify({"dataset_id": dataset_id, "deleted": True})
+
+def request_dataset_id():
+    dataset = request_dataset.get()
+    return dataset.dataset_id if dataset is not None else None
+
+@app.route('/api/generate-diagram', methods=['POST'])
+@handle_errors
+@limiter.limit("8 per minute")
+def generate_diagram():
+    user_prompt = get_diagram_prompt()
+    render_images = not wants_spec_only()
+
+    # Identical requests already in flight share one pipeline run
+    result = single_flight.do(
+        ("diagram", normalize_prompt_key(user_prompt), cache_bypass.get(), render_images, request_dataset_id()),
+        lambda: run_diagram_pipeline(user_prompt, render_images=render_images)
+    )
+
+    # Return all chart results
+    response = dict(result)
+    if not wants_timings():
+        response.pop("timings", None)
+    return jsonify(response)
+
+# Streaming pipelines run on their own bounded pool; past STREAM_MAX_PENDING running or queued, new streams get a 503
+stream_executor = ThreadPoolExecutor(max_workers=int(os.getenv("STREAM_WORKERS", "4")), thread_name_prefix="diagram-stream")
+stream_slots = threading.BoundedSemaphore(int(os.getenv("STREAM_MAX_PENDING", "20")))
+
+def format_sse(event, payload):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route('/api/generate-diagram/stream', methods=['POST'])
+@handle_errors
+@limiter.limit("8 per minute")
+def generate_diagram_stream():
+    """Streaming variant of generate-diagram that sends each result as a Server-Sent Event"""
+    user_prompt = get_diagram_prompt()
+    include_timings = wants_timings()
+    render_images = not wants_spec_only()
+    if not stream_slots.acquire(blocking=False):
+        raise DiagramError("Too many diagram streams in progress, please try again shortly", 503)
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def run_pipeline():
+        try:
+            result = run_diagram_pipeline(user_prompt, on_event=lambda event, payload: events.put((event, payload)),
+                                          render_images=render_images, cancelled=cancelled)
+            done = {
+                "chart_count": len(result["charts"]),
+                "error_messages": result["error_messages"],
+                "degradations": result["degradations"]
+            }
+            if include_timings:
+                done["timings"] = result["timings"]
+            events.put(("done", done))
+        except RequestCancelledError:
+            logger.info("Streaming client disconnected, pipeline stopped")
+        except DiagramError as e:
+            logger.error(f"DiagramError: {e.message}")
+            events.put(("error", {"error": e.message}))
+        except Exception as e:
+            logger.exception(f"Unexpected error in streaming pipeline: {str(e)}")
+            events.put(("error", {"error": "An unexpected error occurred"}))
+        finally:
+            stream_slots.release()
+            events.put(None)
+
+    # The pipeline runs on its own pool so it never waits on a stage worker it occupies itself
+    ctx = contextvars.copy_context()
+    stream_executor.submit(ctx.run, run_pipeline)
+
+    def stream():
+        try:
+            while True:
+                item = events.get()
+                if item is None:
+                    break
+                yield format_sse(*item)
+        except GeneratorExit:
+            # The client disconnected: stop the pipeline before it spends more model calls or render time
+            cancelled.set()
+            raise
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+class JobStore:
+    """Runs diagram generations on a bounded background pool and keeps their results for a limited time"""
+
+    def __init__(self, workers, max_pending, result_ttl_seconds):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="diagram-job")
+        self.max_pending = max_pending
+        self.result_ttl_seconds = result_ttl_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def cleanup(self):
+        """Drop finished jobs whose results have outlived the TTL (caller holds the lock)"""
+        cutoff = time.time() - self.result_ttl_seconds
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job["finished_at"] is not None and job["finished_at"] < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def submit(self, user_prompt, include_timings=False):
+        with self.lock:
+            self.cleanup()
+            active = sum(1 for job in self.jobs.values() if job["status"] in ("queued", "running"))
+            if active >= self.max_pending:
+                raise DiagramError("Too many diagram jobs in progress, please try again shortly", 503)
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "status": "queued",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "recommended_chart_types": None,
+                "charts": [],
+                "error_messages": [],
+                "degradations": None,
+                "timings": None,
+                "error": None
+            }
+            self.jobs[job["job_id"]] = job
+
+        # Carry the request's context (e.g. cache bypass) into the job thread
+        ctx = contextvars.copy_context()
+        self.executor.submit(ctx.run, self.run, job["job_id"], user_prompt, include_timings)
+        return self.get(job["job_id"])
+
+    def run(self, job_id, user_prompt, include_timings):
+        self.update(job_id, status="running", started_at=time.time())
+        try:
+            result = run_diagram_pipeline(user_prompt, on_event=lambda event, payload: self.record_event(job_id, event, payload))
+            # Replace the arrival-ordered partial results with the final, recommendation-ordered ones
+            self.update(job_id, status="done", charts=result["charts"], error_messages=result["error_messages"] or [],
+                        degradations=result["degradations"], timings=result["timings"] if include_timings else None,
+                        finished_at=time.time())
+        except DiagramError as e:
+            logger.error(f"Job {job_id} failed: {e.message}")
+            self.update(job_id, status="failed", error=e.message, finished_at=time.time())
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed unexpectedly: {str(e)}")
+            self.update(job_id, status="failed", error="An unexpected error occurred", finished_at=time.time())
+
+    def record_event(self, job_id, event, payload):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if event == "recommendations":
+                job["recommended_chart_types"] = payload["recommended_chart_types"]
+            elif event == "chart":
+                job["charts"].append(payload)
+            elif event == "chart_error":
+                job["error_messages"].append(payload)
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self.lock:
+            self.cleanup()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = dict(job)
+            snapshot["charts"] = list(job["charts"])
+            snapshot["error_messages"] = list(job["error_messages"]) or None
+            return snapshot
+
+    def get_stats(self):
+        with self.lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job["status"]] = statuses.get(job["status"], 0) + 1
+            return {"jobs": statuses, "max_pending": self.max_pending}
+
+job_store = JobStore(
+    workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_pending=int(os.getenv("JOB_MAX_PENDING", "20")),
+    result_ttl_seconds=int(os.getenv("JOB_RESULT_TTL_SECONDS", "600"))
+)
+
+@app.route('/api/jobs', methods=['POST'])
+@handle_errors
+@limiter.limit("8 per minute")
+def create_diagram_job():
+    """Queue a diagram generation and return its job id right away"""
+    user_prompt = get_diagram_prompt()
+    job = job_store.submit(user_prompt, include_timings=wants_timings())
+    logger.info(f"Queued diagram job {job['job_id']}")
+    return jsonify({
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "status_url": f"/api/jobs/{job['job_id']}"
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@handle_errors
+@limiter.limit("120 per minute")
+def get_diagram_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        raise DiagramError("Job not found or expired", 404)
+    return jsonify(job)
+
+
+class SpecStore:
+    """Bounded LRU store of generated charts (type, data, presentation and, once rendered, the image)"""
+
+    def __init__(self, max_entries, max_image_bytes):
+        self.max_entries = max_entries
+        self.max_image_bytes = max_image_bytes
+        self.specs = OrderedDict()
+        self.image_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"stored": 0, "renders": 0, "image_hits": 0, "updates": 0, "misses": 0, "evictions": 0,
+                      "image_evictions": 0}
+
+    def set_image(self, spec, image):
+        """Swap a spec's image, keeping image_bytes in step; called with the lock held"""
+        if spec["image"] is not None:
+            self.image_bytes -= len(spec["image"])
+        if image is not None:
+            self.image_bytes += len(image)
+        spec["image"] = image
+
+    def trim(self):
+        """Evict specs over max_entries, then drop the least recently used images until the rest fit max_image_bytes
+
+        A spec without its image renders again on demand. Called with the lock held.
+        """
+        while len(self.specs) > self.max_entries:
+            _, evicted = self.specs.popitem(last=False)
+            self.set_image(evicted, None)
+            self.stats["evictions"] += 1
+        for spec in self.specs.values():
+            if self.image_bytes <= self.max_image_bytes:
+                break
+            if spec["image"] is not None:
+                self.set_image(spec, None)
+                self.stats["image_evictions"] += 1
+
+    def add(self, chart_type, chart_data, parsed_info, image=None):
+        spec_id = uuid.uuid4().hex
+        with self.lock:
+            self.specs[spec_id] = {
+                "chart_type": chart_type,
+                "chart_data": copy.deepcopy(chart_data),
+                "parsed_info": copy.deepcopy(parsed_info),
+                "image": None,
+                "version": 0
+            }
+            self.set_image(self.specs[spec_id], image)
+            self.stats["stored"] += 1
+            self.trim()
+        return spec_id
+
+    def get(self, spec_id):
+        with self.lock:
+            spec = self.specs.get(spec_id)
+            if spec is None:
+                self.stats["misses"] += 1
+                return None
+            self.specs.move_to_end(spec_id)
+            return dict(spec)
+
+    def update(self, spec_id, chart_type, chart_data, parsed_info, image=None):
+        """Replace a spec's type, data and presentation along with the image rendered from them, if any"""
+        with self.lock:
+            spec = self.specs.get(spec_id)
+            if spec is None:
+                self.stats["misses"] += 1
+                return False
+            spec.update(chart_type=chart_type, chart_data=copy.deepcopy(chart_data),
+                        parsed_info=copy.deepcopy(parsed_info), version=spec["version"] + 1)
+            self.set_image(spec, image)
+            self.trim()
+            self.specs.move_to_end(spec_id)
+            self.stats["updates"] += 1
+            return True
+
+    def render(self, spec_id):
+        """Return the spec's image, rendering it the first time it is asked for"""
+        spec = self.get(spec_id)
+        if spec is None:
+            return None, None
+        if spec["image"] is not None:
+            with self.lock:
+                self.stats["image_hits"] += 1
+            return spec, spec["image"]
+
+        image = generate_chart_image(spec["chart_type"], spec["chart_data"], copy.deepcopy(spec["parsed_info"]))
+        with self.lock:
+            self.stats["renders"] += 1
+            current = self.specs.get(spec_id)
+            # An edit made while rendering wins over the image of the old version
+            if current is not None and current["version"] == spec["version"]:
+                self.set_image(current, image)
+                self.trim()
+        return spec, image
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.specs), max_entries=self.max_entries,
+                        image_bytes=self.image_bytes, max_image_bytes=self.max_image_bytes)
+
+spec_store = SpecStore(max_entries=int(os.getenv("SPEC_STORE_MAX_ENTRIES", "256")),
+                       max_image_bytes=int(os.getenv("SPEC_STORE_MAX_IMAGE_MB", "64")) * 1024 * 1024)
+
+def store_chart(chart_result):
+    """Keep a generated chart under a spec id so it can be rendered or edited later without the pipeline"""
+    spec_id = spec_store.add(chart_result["chart_type"], chart_result["chart_data"], chart_result["parsed_info"],
+                             chart_result["image"])
+    chart_result["spec_id"] = spec_id
+    chart_result["image_url"] = f"/api/render/{spec_id}"
+    return chart_result
+
+@app.route('/api/render/<spec_id>', methods=['GET'])
+@handle_errors
+@limiter.limit("60 per minute")
+def render_chart_spec(spec_id):
+    """Return the image of a generated chart, rendering it on first request for spec_only diagrams"""
+    # Concurrent fetches of the same chart share one render
+    spec, image = single_flight.do(("render", spec_id), lambda: spec_store.render(spec_id))
+    if spec is None:
+        raise DiagramError("Chart spec not found or expired", 404)
+    return jsonify({
+        "spec_id": spec_id,
+        "chart_type": spec["chart_type"],
+        "image": image
+    })
+
+# Label/value field pairs of the chart types that show one value per label
+CHART_DATA_PAIRS = {
+    "bar": ("x_values", "y_values"),
+    "line": ("x_values", "y_values"),
+    "area": ("x_values", "y_values"),
+    "scatter": ("x_values", "y_values"),
+    "bubble": ("x_values", "y_values"),
+    "pie": ("labels", "sizes"),
+    "treemap": ("labels", "sizes"),
+    "funnel": ("stages", "values"),
+    "radar": ("categories", "values"),
+}
+DISTRIBUTION_CHART_TYPES = {"boxplot", "violin"}
+# Presentation fields a stored chart may change without touching its data
+CHART_PRESENTATION_FIELDS = ("title", "subtitle", "x_axis", "y_axis", "palette")
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({"status": "healthy"}), 200
+def convert_chart_data(chart_type, new_chart_type, chart_data, parsed_info):
+    """Reshape chart data for another chart type showing the same values, or None if the types don't share a shape"""
+    if new_chart_type == chart_type:
+        return copy.deepcopy(chart_data)
 
-@app.route('/cors-test', methods=['GET', 'OPTIONS'])
-def cors_test():
+    converted = {"data_source": chart_data.get("data_source")}
+    if chart_type in CHART_DATA_PAIRS and new_chart_type in CHART_DATA_PAIRS:
+        labels_field, values_field = CHART_DATA_PAIRS[chart_type]
+        new_labels_field, new_values_field = CHART_DATA_PAIRS[new_chart_type]
+        converted[new_labels_field] = list(chart_data[labels_field])
+        converted[new_values_field] = list(chart_data[values_field])
+        if {chart_type, new_chart_type} == {"scatter", "bubble"}:
+            for field in ("sizes", "categories"):
+                if chart_data.get(field) is not None:
+                    converted[field] = list(chart_data[field])
+        if new_chart_type in ("pie", "treemap") and any(float(v) < 0 for v in converted[new_values_field]):
+            return None
+    elif chart_type in DISTRIBUTION_CHART_TYPES and new_chart_type in DISTRIBUTION_CHART_TYPES:
+        converted["x_values"] = list(chart_data["x_values"])
+        converted["distributions"] = copy.deepcopy(chart_data["distributions"])
+    elif chart_type == "histogram" and new_chart_type in DISTRIBUTION_CHART_TYPES and "y_values" in chart_data:
+        converted["x_values"] = [parsed_info.get("y_axis") or "Values"]
+        converted["distributions"] = [list(chart_data["y_values"])]
+    elif chart_type in DISTRIBUTION_CHART_TYPES and new_chart_type == "histogram":
+        converted["y_values"] = [v for distribution in chart_data["distributions"] for v in distribution]
+    else:
+        return None
+    return converted
+
+@app.route('/api/render/<spec_id>', methods=['PATCH'])
+@handle_errors
+@limiter.limit("60 per minute")
+def update_chart_spec(spec_id):
+    """Change a stored chart's presentation or switch it to a compatible chart type, then re-render it"""
+    changes = request.get_json(silent=True)
+    if not changes:
+        raise DiagramError("No changes provided")
+    if not isinstance(changes, dict):
+        raise DiagramError("Changes must be a JSON object")
+    unknown_fields = sorted(set(changes) - set(CHART_PRESENTATION_FIELDS) - {"chart_type"})
+    if unknown_fields:
+        raise DiagramError(f"Only chart_type and presentation fields ({', '.join(CHART_PRESENTATION_FIELDS)}) can be changed, "
+                           f"not: {', '.join(unknown_fields)}")
+    invalid_fields = [field for field in CHART_PRESENTATION_FIELDS
+                      if field in changes and changes[field] is not None and not isinstance(changes[field], str)]
+    if invalid_fields:
+        raise DiagramError(f"Presentation fields must be strings or null, not: {', '.join(invalid_fields)}")
+
+    spec = spec_store.get(spec_id)
+    if spec is None:
+        raise DiagramError("Chart spec not found or expired", 404)
+
+    parsed_info = copy.deepcopy(spec["parsed_info"])
+    for field in CHART_PRESENTATION_FIELDS:
+        if field in changes:
+            parsed_info[field] = changes[field]
+
+    chart_type = spec["chart_type"]
+    chart_data = spec["chart_data"]
+    new_chart_type = str(changes.get("chart_type", chart_type)).lower()
+    if new_chart_type != chart_type:
+        if new_chart_type not in CHART_DATA_SCHEMAS:
+            raise DiagramError(f"Unsupported chart_type '{new_chart_type}', expected one of: {', '.join(CHART_DATA_SCHEMAS)}")
+        converted = convert_chart_data(chart_type, new_chart_type, chart_data, parsed_info)
+        if converted is None:
+            raise DiagramError(f"A {chart_type} chart's data can't be shown as a {new_chart_type} chart")
+        validate_chart_data(new_chart_type, converted)
+        logger.info(f"Switching chart spec {spec_id} from {chart_type} to {new_chart_type}")
+        chart_type, chart_data = new_chart_type, converted
+        parsed_info["chart_type"] = new_chart_type
+
+    # Render before storing, so an edit that can't be drawn leaves the stored spec as it was
+    image = generate_chart_image(chart_type, chart_data, copy.deepcopy(parsed_info))
+    if not spec_store.update(spec_id, chart_type, chart_data, parsed_info, image):
+        raise DiagramError("Chart spec not found or expired", 404)
     return jsonify({
-        "status": "success",
-        "message": "CORS is properly configured",
-        "cors_config": {
-            "allowed_origins": ["https://plott.hitanshu.tech", "http://plott.hitanshu.tech"],
-            "allowed_methods": ["GET", "POST", "OPTIONS"],
-            "allowed_headers": ["Content-Type", "Authorization", "Accept"],
-            "supports_credentials": True
-        }
-    }), 200
+        "spec_id": spec_id,
+        "chart_type": chart_type,
+        "image": image,
+        "parsed_info": parsed_info,
+        "chart_data": chart_data
+    })
 
-@app.route('/api/generate-diagram', methods=['POST'])
+# Rendered PNGs of direct render requests, keyed by the full request payload
+render_cache = ResponseCache(max_entries=int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "256")))
+RENDER_CACHE_TTL_SECONDS = int(os.getenv("RENDER_CACHE_TTL_SECONDS", "300"))
+RENDER_RATE_LIMIT = os.getenv("RENDER_RATE_LIMIT", "120 per minute")
+
+@app.route('/api/render', methods=['POST'])
 @handle_errors
-@limiter.limit("8 per minute")
-def generate_diagram():
-    data = request.json
+@limiter.limit(RENDER_RATE_LIMIT)
+def render_chart_direct():
+    """Render chart_type + data straight to an image, without any model calls"""
+    data = request.get_json(silent=True)
     if not data:
         raise DiagramError("No data provided")
-    
-    user_prompt = data.get('prompt')
-    if not user_prompt:
-        raise DiagramError("No prompt provided")
-    
-    logger.info(f"Processing diagram request: {user_prompt[:50]}...")
-    
-    # Step 1: Ask Gemini for recommended chart types (multiple)
-    recommendation_prompt = f"""
-    You are a data visualization expert tasked with recommending the most appropriate chart types.
 
-    USER REQUEST: {user_prompt}
+    chart_type = str(data.get("chart_type", "")).lower()
+    if chart_type not in CHART_DATA_SCHEMAS:
+        raise DiagramError(f"Unsupported chart_type '{chart_type}', expected one of: {', '.join(CHART_DATA_SCHEMAS)}")
+    chart_data = data.get("data")
+    validate_chart_data(chart_type, chart_data)
 
-    CRITICAL INSTRUCTIONS:
-    1. CAREFULLY ANALYZE what the user is trying to visualize, what data they've provided, and the relationships they want to show
-    2. Consider the exact data structure mentioned (if any) in the user's request
-    3. Recommend the 3 MOST APPROPRIATE chart types from this list:
-       - bar: For comparing values across categories
-       - line: For showing trends over time or ordered categories
-       - pie: For showing proportions of a whole
-       - scatter: For showing relationship between two variables
-       - histogram: For showing distribution of a single variable
-       - heatmap: For showing patterns in a matrix of values
-       - boxplot: For showing distribution statistics with quartiles
-       - violin: For showing distribution density across categories
-       - area: For showing cumulative totals over time
-       - stacked_bar: For showing part-to-whole relationships across categories
-       - bubble: For showing relationships between three variables
-       - radar: For showing multivariate data on axes radiating from center
-       - treemap: For showing hierarchical data as nested rectangles
-       - funnel: For showing stages in a process with decreasing quantities
+    parsed_info = {
+        "chart_type": chart_type,
+        "title": data.get("title") or "",
+        "x_axis": data.get("x_axis") or "",
+        "y_axis": data.get("y_axis") or "",
+        "palette": data.get("palette") or "viridis"
+    }
+    if data.get("subtitle"):
+        parsed_info["subtitle"] = data["subtitle"]
 
-    4. Your ENTIRE response must be ONLY valid JSON with this exact format:
-    {{
-        "recommended_chart_types": [
-            {{
-                "chart_type": "first_type",
-                "reason": "Specific reason why this chart type is optimal for the requested data"
-            }},
-            {{
-                "chart_type": "second_type",
-                "reason": "Specific reason why this chart type is optimal for the requested data"
-            }},
-            {{
-                "chart_type": "third_type",
-                "reason": "Specific reason why this chart type is optimal for the requested data"
-            }}
-        ]
-    }}
+    key = hashlib.sha256(json.dumps([chart_type, chart_data, parsed_info], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    png_bytes = render_cache.get(key, "direct_render")
+    if png_bytes is None:
+        png_bytes = generate_chart_png(chart_type, chart_data, parsed_info)
+        render_cache.set(key, png_bytes, RENDER_CACHE_TTL_SECONDS)
 
-    REQUIREMENTS:
-    - Recommend EXACTLY 3 different chart types, most appropriate first
-    - Do NOT add any explanations, text, or markdown outside the JSON
-    - Ensure that your suggestions match the user's data structure and visualization goals
-    - Provide specific reasons tailored to the user's exact request, not generic descriptions
-    """
-    
-    try:
-        recommendation_response = model.generate_content(recommendation_prompt)
-        recommendation = parse_gemini_json(recommendation_response.text)
-        recommended_chart_types = recommendation.get("recommended_chart_types", [])
-        
-        # Validate we have at least 3 recommendations
-        if len(recommended_chart_types) < 3:
-            # Add default recommendations if needed
-            default_types = [
-                {"chart_type": "bar", "reason": "Default recommendation for comparing values"},
-                {"chart_type": "line", "reason": "Default recommendation for showing trends"},
-                {"chart_type": "pie", "reason": "Default recommendation for showing proportions"}
-            ]
-            
-            # Add only the needed ones
-            for i in range(3 - len(recommended_chart_types)):
-                # Find a default type that isn't already recommended
-                for default in default_types:
-                    if not any(r.get("chart_type") == default["chart_type"] for r in recommended_chart_types):
-                        recommended_chart_types.append(default)
-                        break
-        
-        # Ensure we have exactly 3 chart types
-        recommended_chart_types = recommended_chart_types[:3]
-        
-        logger.info(f"Recommended chart types: {[r.get('chart_type') for r in recommended_chart_types]}")
-    except Exception as e:
-        logger.error(f"Error getting chart recommendations: {str(e)}")
-        # Default recommendations if the API call fails
-        recommended_chart_types = [
-            {"chart_type": "bar", "reason": "Default recommendation for comparing values"},
-            {"chart_type": "line", "reason": "Default recommendation for showing trends"},
-            {"chart_type": "pie", "reason": "Default recommendation for showing proportions"}
-        ]
-    
-    # Step 2: Parse the user prompt for general information
-    parsing_prompt = f"""
-    You are a data specification parser responsible for extracting GENERAL visualization requirements.
+    if data.get("format") == "base64":
+        return jsonify({"chart_type": chart_type, "image": base64.b64encode(png_bytes).decode('utf-8')})
+    return Response(png_bytes, mimetype="image/png", headers={"Cache-Control": f"private, max-age={RENDER_CACHE_TTL_SECONDS}"})
 
-    USER REQUEST: {user_prompt}
+def generate_chart_image(chart_type, chart_data, parsed_info):
+    """Generate a chart image and return its base64 encoding"""
+    png_bytes = generate_chart_png(chart_type, chart_data, parsed_info)
+    encode_started = time.perf_counter()
+    image_base64 = base64.b64encode(png_bytes).decode('utf-8')
+    record_stage_timing("base64", time.perf_counter() - encode_started)
+    return image_base64
 
-    CRITICAL INSTRUCTIONS:
-    Extract the following general information. Focus on high-level details. Defer detailed data point extraction.
+def generate_chart_png(chart_type, chart_data, parsed_info):
+    """Generate a chart image and return the PNG bytes"""
+    raise_if_cancelled()
+    # Chart chains run on several threads, but pyplot is not thread-safe
+    wait_started = time.perf_counter()
+    with render_lock:
+        record_stage_timing("render_wait", time.perf_counter() - wait_started)
+        return render_chart_png(chart_type, chart_data, parsed_info)
 
-    1. data_description: General description of what the user wants to visualize.
-    2. x_axis: Suggested label for the x-axis (e.g., "Categories", "Time", "Value"). Use null if unclear.
-    3. y_axis: Suggested label for the y-axis (e.g., "Count", "Sales", "Measurement"). Use null if unclear.
-    4. title: Suggested clear, descriptive title. Use null if unclear.
-    5. subtitle: Optional subtitle providing additional context. Use null if none suggested.
-    6. palette: Color palette suggestion if mentioned (e.g., 'viridis', 'Blues'). Use null if not mentioned.
+# Resolution charts are saved at
+CHART_DPI = 150
+# Line/area series longer than the plot is wide in pixels are decimated: "lttb" or "minmax" per pixel column
+SERIES_DECIMATION = os.getenv("SERIES_DECIMATION", "lttb").lower()
+# Above these counts markers are dropped and value labels / x ticks are thinned to every n-th point
+SERIES_MAX_MARKERS = 60
+SERIES_MAX_VALUE_LABELS = 30
+SERIES_MAX_TICKS = 24
 
-    RESPONSE FORMAT:
-    Return ONLY a valid JSON object with these exact fields. No explanation text, no markdown formatting.
+def series_point_budget(ax):
+    """Width of the plotting area in output pixels, the most points a line can usefully show"""
+    return max(3, int(ax.get_position().width * ax.figure.get_figwidth() * CHART_DPI))
 
-    STRICT REQUIREMENTS:
-    - Every field MUST be present (use null for truly unknown values).
-    - Do NOT extract specific data points or detailed data structures yet.
-    - Keep descriptions concise.
+def lttb_indices(x, y, threshold):
+    """Indices of the threshold points kept by Largest-Triangle-Three-Buckets, first and last included"""
+    n = x.size
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # threshold - 2 buckets of about equal size between the fixed first and last points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < edges.size:
+            next_x, next_y = x[end:edges[bucket + 2]].mean(), y[end:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # Keep the point forming the largest triangle with the last kept point and the next bucket's average
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(areas.argmax())
+        indices[bucket + 1] = previous
+    return indices
+
+def minmax_indices(x, y, buckets):
+    """Indices of the lowest and highest point in each of buckets equal-width x ranges, plus both ends"""
+    n = x.size
+    span = x[-1] - x[0]
+    if span > 0:
+        bucket = np.minimum(((x - x[0]) / span * buckets).astype(np.int64), buckets - 1)
+    else:
+        bucket = np.zeros(n, dtype=np.int64)
+    # Sorted by bucket, then value: each bucket's run starts at its minimum and ends at its maximum
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.r_[True, np.diff(bucket[order]) != 0])
+    ends = np.r_[starts[1:], n] - 1
+    return np.unique(np.concatenate([[0, n - 1], order[starts], order[ends]]))
+
+def decimate_series(ax, x_values, y_values):
+    """Sorted series reduced to what the plot's output width can show, as float arrays"""
+    x = np.asarray(x_values, dtype=float)
+    y = np.asarray(y_values, dtype=float)
+    budget = series_point_budget(ax)
+    if x.size <= budget:
+        return x, y
+    if SERIES_DECIMATION == "minmax":
+        keep = minmax_indices(x, y, budget // 2)
+    else:
+        keep = lttb_indices(x, y, budget)
+    logger.info(f"Decimated a {x.size}-point series to {keep.size} points ({SERIES_DECIMATION})")
+    return x[keep], y[keep]
+
+MONTH_ABBREVIATIONS = {name: number for number, name in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), start=1)}
+
+def fuzzy_date(text):
+    try:
+        return date_parser.parse(text, fuzzy=True)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def read_series_x(x_values, month_names=False, fuzzy_dates=True):
+    """Numeric x positions of series labels read as numbers, month abbreviations or dates, NaN where none fits
+
+    Numbers and ISO 8601 dates are parsed column-wise; only labels neither reads go through dateutil.
     """
-    
-    parsing_response = model.generate_content(parsing_prompt)
-    general_parsed_info = parse_gemini_json(parsing_response.text)
-    
-    # Add default values if necessary
-    default_fields = {'title': 'Generated Chart', 'x_axis': 'X-Axis', 'y_axis': 'Y-Axis', 'data_description': user_prompt, 'subtitle': None, 'palette': 'viridis'}
-    for field, default_value in default_fields.items():
-        if field not in general_parsed_info or general_parsed_info[field] is None:
-            general_parsed_info[field] = default_value
-            logger.warning(f"Missing or null general info field: '{field}', using default: '{default_value}'")
+    labels = pd.Series(x_values, dtype=object)
+    positions = pd.to_numeric(labels, errors="coerce")
+    text = labels[positions.isna()]
+    text = text[[isinstance(label, str) for label in text]]
+    if month_names and len(text):
+        months = text.str.lower().map(MONTH_ABBREVIATIONS)
+        positions.update(months.dropna())
+        text = text[months.isna()]
+    if len(text):
+        dates = pd.to_datetime(text, errors="coerce", format="ISO8601", utc=True)
+        unparsed = text[dates.isna()]
+        if fuzzy_dates and len(unparsed):
+            dates = dates.fillna(pd.Series(pd.to_datetime([fuzzy_date(label) for label in unparsed], utc=True),
+                                           index=unparsed.index))
+        positions.update(((dates - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).dropna())
+    return positions.to_numpy(dtype=float, copy=True)
 
-    logger.info(f"General Parsed Info: {json.dumps(general_parsed_info, indent=2)}")
-    
-    # Step 3 & 4: Iterate through recommendations, extract/generate data, and create chart images
-    chart_results = []
-    error_messages = []
-    
-    for recommendation in recommended_chart_types:
-        chart_type = recommendation.get("chart_type", "bar").lower()
-        reason = recommendation.get("reason", "")
-        
-        try:
-            logger.info(f"--- Processing chart type: {chart_type} ---")
-            
-            # --- Chart-Specific Extraction ---
-            chart_specific_extraction_prompt = f"""
-            You are a data extraction expert focused on the '{chart_type}' chart type.
-            Analyze the user's request and general info provided below.
-
-            USER REQUEST: {user_prompt}
-            GENERAL INFO: {json.dumps(general_parsed_info)}
-            TARGET CHART TYPE: {chart_type}
-
-            CRITICAL INSTRUCTIONS:
-            1. Determine if the USER REQUEST contains specific data points/values suitable for a '{chart_type}' chart.
-            2. If YES (specific data found):
-               - Extract the EXACT data points relevant for the '{chart_type}' chart.
-               - Format them correctly into the appropriate structure for a '{chart_type}' chart.
-               - For standard charts: Use `x_values`, `y_values` for basic data.
-               - For pie chart: Use `labels` and `sizes`.
-               - For heatmap: Use `x_values` (column labels), `y_values` (row labels), and `z_values` (2D matrix).
-               - For boxplot/violin: Use `x_values` (categories) and `distributions` (list of lists).
-               - For radar chart: Use `categories` (axis labels) and `values` (data points).
-               - For treemap: Use `labels` (rectangle labels), `parents` (hierarchy), and `sizes` (rectangle sizes).
-               - For funnel: Use `stages` (stage names) and `values` (values for each stage).
-               - Set `exact_data_provided` to true.
-               - Set `data_specifications` to null.
-            3. If NO (no specific data found):
-               - Describe the data needed for a '{chart_type}' chart based on the request in `data_specifications`.
-               - Set `exact_data_provided` to false.
-               - Include the EXACT field names required for this chart type in your response.
-            4. Refine `x_axis` and `y_axis` labels specifically for this '{chart_type}' based on the extracted/specified data.
-            5. Refine `title` and `subtitle` if the user request gives more specific context for this chart type.
-
-            RESPONSE FORMAT:
-            Return ONLY a valid JSON object with these exact fields:
-            {{
-                "exact_data_provided": boolean,
-                // Include ONLY the appropriate fields for this chart type below:
-                "x_values": list | null,
-                "y_values": list | null,
-                "labels": list | null, // For pie, treemap
-                "sizes": list | null, // For pie, bubble, treemap
-                "categories": list | null, // For radar
-                "values": list | null, // For radar
-                "z_values": list[list] | null, // For heatmap
-                "distributions": list[list] | list | null, // For box/violin
-                "groups": list | null, // For stacked_bar, boxplot, violin
-                "stages": list | null, // For funnel
-                "values": list | null, // For funnel
-                "parents": list | null, // For treemap
-                // --- End chart-specific keys ---
-                "data_specifications": string | null, // Description for AI generation if no exact data
-                "x_axis": string, // Refined X-axis label
-                "y_axis": string, // Refined Y-axis label
-                "title": string, // Refined title
-                "subtitle": string | null // Refined subtitle
-            }}
+def series_x_positions(x_values, month_names=False):
+    """Numeric x positions of series labels, falling back to a label's index where it can't be read"""
+    positions = read_series_x(x_values, month_names)
+    unplaced = np.isnan(positions)
+    positions[unplaced] = np.flatnonzero(unplaced)
+    return positions
 
-            REQUIREMENTS:
-            - Adhere strictly to the JSON format. No extra text.
-            - Include ONLY the fields relevant to this chart type.
-            - Preserve user's exact wording and values when `exact_data_provided` is true.
-            """
-            
-            extraction_response = model.generate_content(chart_specific_extraction_prompt)
-            specific_info = parse_gemini_json(extraction_response.text)
-            logger.info(f"[{chart_type}] Specific Info Extracted: {json.dumps(specific_info, indent=2)}")
-
-            # --- Chart-Specific Data Generation ---
-            specific_chart_data = None
-            if specific_info.get("exact_data_provided"):
-                logger.info(f"[{chart_type}] Using user-specified data.")
-                # Use extracted data directly, validate basic structure
-                extracted_data = {
-                    "data_source": "user_specified"
-                }
-                
-                # Add only the relevant keys for this chart type
-                for key in ["x_values", "y_values", "labels", "sizes", "categories", "values", 
-                           "z_values", "distributions", "groups", "stages", "parents"]:
-                    if specific_info.get(key) is not None:
-                        extracted_data[key] = specific_info[key]
-
-                # Validate that we have the necessary data for this chart type
-                if chart_type == 'radar' and 'categories' not in extracted_data and 'values' not in extracted_data:
-                    if 'x_values' in extracted_data and 'y_values' in extracted_data:
-                        extracted_data['categories'] = extracted_data['x_values']
-                        extracted_data['values'] = extracted_data['y_values']
-                    else:
-                        raise DiagramError(f"[{chart_type}] Missing required fields: categories and values")
-                        
-                elif chart_type == 'treemap' and 'labels' not in extracted_data and 'sizes' not in extracted_data:
-                    if 'x_values' in extracted_data and 'y_values' in extracted_data:
-                        extracted_data['labels'] = extracted_data['x_values']
-                        extracted_data['sizes'] = extracted_data['y_values']
-                    else:
-                        raise DiagramError(f"[{chart_type}] Missing required fields: labels and sizes")
-                        
-                elif chart_type == 'funnel' and 'stages' not in extracted_data and 'values' not in extracted_data:
-                    if 'x_values' in extracted_data and 'y_values' in extracted_data:
-                        extracted_data['stages'] = extracted_data['x_values']
-                        extracted_data['values'] = extracted_data['y_values']
-                    else:
-                        raise DiagramError(f"[{chart_type}] Missing required fields: stages and values")
-                
-                specific_chart_data = extracted_data
-            else:
-                logger.info(f"[{chart_type}] Generating AI data based on specifications.")
-                chart_specific_data_generation_prompt = f"""
-                You are a data generation expert for '{chart_type}' charts.
-                Generate data based ONLY on the specifications below.
-
-                TARGET CHART TYPE: {chart_type}
-                DATA SPECIFICATIONS: {specific_info.get("data_specifications", general_parsed_info["data_description"])}
-                X-AXIS HINT: {specific_info.get("x_axis")}
-                Y-AXIS HINT: {specific_info.get("y_axis")}
-
-                CRITICAL INSTRUCTIONS:
-                1. Generate realistic data points (aim for 8-12 points unless specifications dictate otherwise) suitable for a '{chart_type}' chart.
-                2. Structure the output based on the TARGET CHART TYPE:
-                   - Bar/Line: Include `x_values` and `y_values`.
-                   - Pie/Treemap: Include `labels` and `sizes`.
-                   - Radar: Include `categories` and `values`.
-                   - Heatmap: Include `x_values`, `y_values`, and `z_values` (2D matrix).
-                   - Box/Violin: Include `x_values` (group labels) and `distributions` (list of lists).
-                   - Funnel: Include `stages` and `values`.
-                3. ONLY include fields relevant to this chart type.
-                4. Ensure data structures have compatible lengths for the chart type.
-
-                RETURN FORMAT:
-                Return ONLY a valid JSON object containing the generated data. Include `data_source` set to "ai_generated".
-                """
-                data_gen_response = model.generate_content(chart_specific_data_generation_prompt)
-                specific_chart_data = parse_gemini_json(data_gen_response.text)
-                
-                # Add data_source if missing
-                if "data_source" not in specific_chart_data:
-                    specific_chart_data["data_source"] = "ai_generated"
-
-                # Chart-specific validations and corrections
-                if chart_type == 'radar':
-                    # If radar chart data is missing categories/values, try to use x_values/y_values
-                    if 'categories' not in specific_chart_data and 'values' not in specific_chart_data:
-                        if 'x_values' in specific_chart_data and 'y_values' in specific_chart_data:
-                            logger.warning(f"[{chart_type}] Converting x_values/y_values to categories/values")
-                            specific_chart_data['categories'] = specific_chart_data['x_values']
-                            specific_chart_data['values'] = specific_chart_data['y_values']
-                        else:
-                            # Generate default radar data
-                            logger.warning(f"[{chart_type}] Generating default radar data")
-                            specific_chart_data['categories'] = ["Category 1", "Category 2", "Category 3", "Category 4", "Category 5"]
-                            specific_chart_data['values'] = [4, 7, 5, 8, 6]
-                            
-                elif chart_type == 'treemap':
-                    # If treemap data is missing labels/sizes, try to use x_values/y_values
-                    if 'labels' not in specific_chart_data and 'sizes' not in specific_chart_data:
-                        if 'x_values' in specific_chart_data and 'y_values' in specific_chart_data:
-                            logger.warning(f"[{chart_type}] Converting x_values/y_values to labels/sizes")
-                            specific_chart_data['labels'] = specific_chart_data['x_values']
-                            specific_chart_data['sizes'] = specific_chart_data['y_values']
-                        else:
-                            # Generate default treemap data
-                            logger.warning(f"[{chart_type}] Generating default treemap data")
-                            specific_chart_data['labels'] = ["Category A", "Category B", "Category C", "Category D"]
-                            specific_chart_data['sizes'] = [15, 30, 45, 10]
-                            
-                elif chart_type == 'funnel':
-                    # If funnel data is missing stages/values, try to use x_values/y_values
-                    if 'stages' not in specific_chart_data and 'values' not in specific_chart_data:
-                        if 'x_values' in specific_chart_data and 'y_values' in specific_chart_data:
-                            logger.warning(f"[{chart_type}] Converting x_values/y_values to stages/values")
-                            specific_chart_data['stages'] = specific_chart_data['x_values']
-                            specific_chart_data['values'] = specific_chart_data['y_values']
-                        else:
-                            # Generate default funnel data
-                            logger.warning(f"[{chart_type}] Generating default funnel data")
-                            specific_chart_data['stages'] = ["Awareness", "Interest", "Consideration", "Intent", "Purchase"]
-                            specific_chart_data['values'] = [100, 70, 50, 30, 15]
-
-                logger.info(f"[{chart_type}] AI-generated data: {json.dumps(specific_chart_data)}")
-
-            # --- Prepare final info for chart generation ---
-            chart_parsed_info = general_parsed_info.copy() # Start with general info
-            chart_parsed_info.update(specific_info) # Override with specific info (title, axes etc)
-            chart_parsed_info["chart_type"] = chart_type # Ensure chart_type is set
-            # Remove fields that don't belong in final parsed info for the image function
-            for key in ["exact_data_provided", "data_specifications", "x_values", "y_values", "labels", "sizes", "categories", "z_values", "distributions", "groups", "stages", "parents"]:
-                 chart_parsed_info.pop(key, None) 
-
-            logger.info(f"[{chart_type}] Final chart info for generation: {json.dumps(chart_parsed_info)}")
-            logger.info(f"[{chart_type}] Final chart data for generation: {json.dumps(specific_chart_data)}")
-
-            # --- Generate Chart Image ---
-            chart_image = generate_chart_image(chart_type, specific_chart_data, chart_parsed_info)
-            
-            chart_results.append({
-                "chart_type": chart_type,
-                "reason": reason,
-                "image": chart_image,
-                "parsed_info": chart_parsed_info, # Pass the refined info
-                "chart_data": specific_chart_data # Also return the specific data used
-            })
-            
-            logger.info(f"Generated {chart_type} chart successfully")
-            
-        except DiagramError as e: # Catch DiagramErrors specifically to report them
-             error_msg = f"Error generating {chart_type} chart: {e.message}"
-             logger.error(error_msg)
-             error_messages.append({"chart_type": chart_type, "error": e.message})
-        except Exception as e: # Catch unexpected errors
-            error_msg = f"Unexpected error generating {chart_type} chart: {str(e)}"
-            logger.exception(error_msg) # Log stack trace for unexpected errors
-            error_messages.append({"chart_type": chart_type, "error": f"An unexpected error occurred: {str(e)}"})
-            # Continue with other chart types even if one fails
-    
-    # If all charts failed, try to generate a simple bar chart as fallback
-    if len(chart_results) == 0:
-        logger.warning("All recommended charts failed, attempting fallback bar chart")
-        try:
-             # Simplified extraction/generation for fallback bar chart
-             fallback_chart_type = "bar"
-             logger.info(f"--- Processing fallback: {fallback_chart_type} ---")
-             
-             # Minimal info extraction for fallback
-             fallback_specific_info = {
-                 "exact_data_provided": False, # Assume AI generation for fallback
-                 "data_specifications": f"Create a simple bar chart based on the user request: {user_prompt}. Use generic categories and values if necessary.",
-                 "x_axis": general_parsed_info['x_axis'],
-                 "y_axis": general_parsed_info['y_axis'],
-                 "title": f"{general_parsed_info['title']} (Fallback Bar Chart)",
-                 "subtitle": general_parsed_info['subtitle']
-             }
-             
-             # Minimal data generation for fallback
-             fallback_data_gen_prompt = f"""
-             Generate simple data for a fallback 'bar' chart.
-             SPECIFICATIONS: {fallback_specific_info['data_specifications']}
-             Return JSON: {{"x_values": ["Cat1", "Cat2", "Cat3"], "y_values": [5, 8, 3], "data_source": "ai_generated_fallback"}}
-             """
-             fallback_data_response = model.generate_content(fallback_data_gen_prompt)
-             fallback_chart_data = parse_gemini_json(fallback_data_response.text)
-             if "data_source" not in fallback_chart_data: fallback_chart_data["data_source"] = "ai_generated_fallback"
-             if 'x_values' not in fallback_chart_data or 'y_values' not in fallback_chart_data:
-                  fallback_chart_data = {"x_values": ["FB_Cat1", "FB_Cat2", "FB_Cat3"], "y_values": [5, 8, 3], "data_source": "ai_generated_fallback_hardcoded"} # Hardcoded fallback
-
-             fallback_parsed_info = general_parsed_info.copy()
-             fallback_parsed_info.update({k: v for k, v in fallback_specific_info.items() if k in ['x_axis', 'y_axis', 'title', 'subtitle', 'palette']})
-             fallback_parsed_info["chart_type"] = fallback_chart_type
-
-             logger.info(f"[Fallback] Final chart info: {json.dumps(fallback_parsed_info)}")
-             logger.info(f"[Fallback] Final chart data: {json.dumps(fallback_chart_data)}")
-             
-             fallback_image = generate_chart_image(fallback_chart_type, fallback_chart_data, fallback_parsed_info)
-            
-             chart_results.append({
-                "chart_type": fallback_chart_type,
-                "reason": "Fallback chart type when others failed",
-                "image": fallback_image,
-                "parsed_info": fallback_parsed_info,
-                "chart_data": fallback_chart_data
-            })
-             logger.info("Generated fallback bar chart successfully")
+def sorted_series(x_values, y_values, month_names=False):
+    """(x positions, y values, x labels) of a line/area series as arrays sorted by x, non-numeric y as 0"""
+    n = min(len(x_values), len(y_values))
+    x = series_x_positions(x_values[:n], month_names)
+    y = pd.to_numeric(pd.Series(y_values[:n], dtype=object), errors="coerce").fillna(0).to_numpy(dtype=float)
+    order = np.argsort(x, kind="stable")
+    return x[order], y[order], np.asarray(x_values[:n], dtype=object)[order]
 
-        except Exception as e:
-            logger.error(f"Even fallback chart failed: {str(e)}")
-            # If even the fallback fails, report the original errors if any, or a generic message
-            if error_messages:
-                 failure_reason = f"Failed to generate any charts. Errors encountered: {json.dumps(error_messages)}"
-            else:
-                 failure_reason = f"Failed to generate fallback chart: {str(e)}"
-            raise DiagramError(failure_reason)
+def thinning_step(count, limit):
+    """Stride that brings count items down to at most limit"""
+    return max(1, -(-count // limit))
 
-    # Return all chart results
-    return jsonify({
-        "charts": chart_results,
-        # "chart_data": chart_data, # Remove generic chart_data
-        "error_messages": error_messages if error_messages else None # Keep error messages
-    })
+def draw_series_labels(ax, x_plot, y_plot, x_numeric, x_labels):
+    """Value labels above the plotted points and x ticks with the original labels, both thinned for long series"""
+    label_step = thinning_step(len(x_plot), SERIES_MAX_VALUE_LABELS)
+    for x, y in zip(x_plot[::label_step], y_plot[::label_step]):
+        ax.annotate(f'{y:.1f}', (x, y), textcoords="offset points",
+                    xytext=(0, 10), ha='center')
 
-def generate_chart_image(chart_type, chart_data, parsed_info):
-    """Generate a chart image and return its base64 encoding"""
+    tick_step = thinning_step(len(x_numeric), SERIES_MAX_TICKS)
+    tick_labels = x_labels[::tick_step]
+    ax.set_xticks(x_numeric[::tick_step])
+    ax.set_xticklabels(tick_labels, rotation=45 if any(len(str(x)) > 5 for x in tick_labels) else 0)
+
+# Scatter and bubble charts with more points than this are drawn binned, so render time follows the bins
+DENSITY_POINT_THRESHOLD = int(os.getenv("DENSITY_POINT_THRESHOLD", "5000"))
+# Bins across the x axis for the density image (y follows the 12x7 figure aspect) and per axis for binned bubbles
+DENSITY_GRID_BINS = 120
+DENSITY_BUBBLE_BINS = 30
+# Marker area in points^2 of the largest binned bubble
+DENSITY_BUBBLE_MAX_AREA = 800
+
+def finite_points(*columns):
+    """Columns as float arrays with the rows holding a NaN or infinity in any of them dropped"""
+    arrays = [np.asarray(column, dtype=float) for column in columns]
+    mask = np.logical_and.reduce([np.isfinite(array) for array in arrays])
+    return [array[mask] for array in arrays]
+
+def draw_density(ax, x_values, y_values, palette):
+    """Point counts on a histogram2d grid drawn as a single image, empty bins left blank"""
+    x, y = finite_points(x_values, y_values)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=(DENSITY_GRID_BINS, DENSITY_GRID_BINS * 7 // 12))
+    image = ax.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', aspect='auto', cmap=palette,
+                      interpolation='nearest', norm=matplotlib.colors.LogNorm(),
+                      extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+    ax.grid(False)
+    ax.figure.colorbar(image, ax=ax, label="Points per bin")
+    logger.info(f"Drew {x.size} scatter points as a {counts.shape[0]}x{counts.shape[1]} density grid")
+
+def draw_binned_bubbles(ax, x_values, y_values, sizes, palette):
+    """One bubble per occupied bin at its points' centroid, sized by the bin's total size and coloured by its point count"""
+    x, y, sizes = finite_points(x_values, y_values, sizes)
+    bins = DENSITY_BUBBLE_BINS
+    cells = []
+    for values in (x, y):
+        edges = np.histogram_bin_edges(values, bins)
+        cells.append(np.clip(np.searchsorted(edges, values, side='right') - 1, 0, bins - 1))
+    cell = cells[0] * bins + cells[1]
+    counts = np.bincount(cell, minlength=bins * bins)
+    occupied = np.flatnonzero(counts)
+    point_counts = counts[occupied]
+    centroid_x = np.bincount(cell, weights=x, minlength=bins * bins)[occupied] / point_counts
+    centroid_y = np.bincount(cell, weights=y, minlength=bins * bins)[occupied] / point_counts
+    totals = np.bincount(cell, weights=np.clip(sizes, 0, None), minlength=bins * bins)[occupied]
+    areas = totals / totals.max() * DENSITY_BUBBLE_MAX_AREA if totals.max() > 0 else np.full(occupied.size, 100.0)
+    bubbles = ax.scatter(centroid_x, centroid_y, s=areas, c=point_counts, cmap=palette, alpha=0.6,
+                         edgecolor='white', linewidth=0.5)
+    ax.figure.colorbar(bubbles, ax=ax, label="Points per bubble")
+    logger.info(f"Drew {x.size} bubbles as {occupied.size} binned bubbles")
+
+def draw_histogram(ax, bin_edges, counts):
+    """Bars for automatically sized display bins plus a KDE line computed from the binned counts"""
+    edges = np.asarray(bin_edges, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    # Only equal-width bins can be merged and smoothed; anything else is drawn as given
+    uniform = counts.size > 1 and np.allclose(np.diff(edges), edges[1] - edges[0])
+    display_edges, display_counts = rebin(edges, counts, histogram_bin_count(edges, counts)) if uniform else (edges, counts)
+    color = sns.color_palette()[0]
+    ax.hist(display_edges[:-1], bins=display_edges, weights=display_counts, color=color, alpha=0.75, edgecolor='white')
+    kde = binned_kde(edges, counts) if uniform else None
+    if kde is not None:
+        x, smoothed = kde
+        # Smoothed counts per fine bin, scaled to the height of the display bins
+        ax.plot(x, smoothed * (display_edges[1] - display_edges[0]) / (edges[1] - edges[0]), color=color, linewidth=2)
+
+# Heatmaps with more cells than this (about 30x30) are drawn as one image without per-cell value labels
+HEATMAP_ANNOTATE_MAX_CELLS = int(os.getenv("HEATMAP_ANNOTATE_MAX_CELLS", "900"))
+# Longer sides are averaged down in equal blocks to at most this many rows/columns; 0 keeps every cell
+HEATMAP_MAX_SIDE = int(os.getenv("HEATMAP_MAX_SIDE", "200"))
+HEATMAP_MAX_TICKS = 40
+
+def heatmap_matrix(z_values):
+    """z_values as a 2D float array; ragged rows are padded with 0 and non-numeric cells become 0"""
+    try:
+        matrix = np.array(z_values, dtype=float)
+    except (ValueError, TypeError):
+        matrix = None
+    if matrix is None or matrix.ndim > 2:
+        rows = [row if isinstance(row, list) else [row] for row in z_values]
+        matrix = pd.DataFrame(rows).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    elif matrix.ndim == 1:
+        # A flat list is one value per row
+        matrix = matrix.reshape(-1, 1)
+    return np.nan_to_num(matrix, nan=0.0, posinf=0.0, neginf=0.0)
+
+def block_aggregate(matrix, x_labels, y_labels, max_side):
+    """Average equal blocks of rows/columns so neither side exceeds max_side; blocks keep their first label"""
+    row_factor = -(-matrix.shape[0] // max_side)
+    column_factor = -(-matrix.shape[1] // max_side)
+    rows = -(-matrix.shape[0] // row_factor) * row_factor
+    columns = -(-matrix.shape[1] // column_factor) * column_factor
+    # NaN padding makes the last, partial blocks average only their real cells
+    padded = np.full((rows, columns), np.nan)
+    padded[:matrix.shape[0], :matrix.shape[1]] = matrix
+    blocks = np.nanmean(padded.reshape(rows // row_factor, row_factor, columns // column_factor, column_factor), axis=(1, 3))
+    logger.info(f"Averaged a {matrix.shape[0]}x{matrix.shape[1]} heatmap down to {blocks.shape[0]}x{blocks.shape[1]}")
+    return blocks, x_labels[::column_factor], y_labels[::row_factor]
+
+def draw_heatmap_image(ax, matrix, x_labels, y_labels, palette):
+    """The matrix as a single image with a colour bar and thinned tick labels"""
+    image = ax.imshow(matrix, cmap=palette, aspect='auto', interpolation='nearest')
+    ax.grid(False)
+    ax.figure.colorbar(image, ax=ax)
+    for set_ticks, set_labels, labels in ((ax.set_xticks, ax.set_xticklabels, x_labels),
+                                          (ax.set_yticks, ax.set_yticklabels, y_labels)):
+        step = thinning_step(len(labels), HEATMAP_MAX_TICKS)
+        set_ticks(range(0, len(labels), step))
+        set_labels(labels[::step])
+    plt.setp(ax.get_xticklabels(), rotation=90)
+
+def render_chart_png(chart_type, chart_data, parsed_info):
+    """Render a chart with pyplot and return the PNG bytes (caller must hold render_lock)"""
     plt_fig = None
     buffer = None
+    render_started = time.perf_counter()
     try:
         # Create figure
         plt_fig = plt.figure(figsize=(12, 7))
@@ -581,101 +3870,43 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                 ax.text(i, v + 0.1, f"{v:.1f}", ha='center')
                 
         elif chart_type == 'line':
-            # Convert to numeric values if possible
             try:
-                # Process x and y values ensuring they're primitive types
-                x_vals = []
-                y_vals = []
-                pairs = []  # For storing (x,y) pairs that will be sorted
-                
-                # First, try to parse all values as numeric
-                for i, (x, y) in enumerate(zip(chart_data['x_values'], chart_data['y_values'])):
-                    try:
-                        # Try to convert to numeric if possible
-                        if isinstance(x, (int, float)):
-                            x_val = x
-                        elif isinstance(x, str):
-                            # Try to parse as number or date
-                            try:
-                                # First try as simple float
-                                x_val = float(x)
-                            except ValueError:
-                                # If that fails, check if it looks like a date/month
-                                if x.lower() in ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 
-                                                'jul', 'aug', 'sep', 'oct', 'nov', 'dec']:
-                                    # Use month number for sorting
-                                    months = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4,
-                                            'may': 5, 'jun': 6, 'jul': 7, 'aug': 8,
-                                            'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
-                                    x_val = months.get(x.lower(), i)
-                                else:
-                                    # Try to parse as a date
-                                    try:
-                                        # Try to parse the string as a date
-                                        parsed_date = date_parser.parse(x, fuzzy=True)
-                                        # Use the timestamp as the numerical value for sorting
-                                        x_val = datetime.datetime.timestamp(parsed_date)
-                                    except (ValueError, TypeError):
-                                        # Use position as a fallback
-                                        x_val = i
-                        else:
-                            # For other types, use position index
-                            x_val = i
-                        
-                        # Convert y to float if possible
-                        if isinstance(y, (int, float)):
-                            y_val = y
-                        else:
-                            y_val = float(y) if isinstance(y, str) else 0
-                        
-                        # Store the (x,y) pair for sorting
-                        pairs.append((x_val, y_val, x))  # Include original x for labels
-                    except (ValueError, TypeError):
-                        logger.warning(f"Could not convert line data point {i} to numeric: x={x}, y={y}")
-                        # Try to use the index as x value
-                        pairs.append((i, 0 if not isinstance(y, (int, float)) else y, x))
-                
-                # Sort pairs by x value for proper line plotting
-                pairs.sort(key=lambda pair: pair[0])
-                
-                # Extract sorted values and original labels
-                x_numeric = [pair[0] for pair in pairs]
-                y_values = [pair[1] for pair in pairs]
-                x_labels = [pair[2] for pair in pairs]
+                # Numbers, month names and dates become x positions; the original strings label the ticks
+                x_numeric, y_values, x_labels = sorted_series(chart_data['x_values'], chart_data['y_values'], month_names=True)
                 
                 # Create the plot
-                if len(pairs) > 1:
+                if len(x_numeric) > 1:
                     # Plot with numeric x values for correct line placement
                     fig, ax = plt.subplots(figsize=(12, 7))  # Get axis for more control
                     
+                    # Long series keep only the points the output width can show
+                    x_plot, y_plot = decimate_series(ax, x_numeric, y_values)
+                    show_markers = len(x_plot) <= SERIES_MAX_MARKERS
+
                     # Create a better looking line chart
-                    line = ax.plot(x_numeric, y_values, marker='o', linewidth=2.5)[0]
+                    line = ax.plot(x_plot, y_plot, marker='o' if show_markers else None,
+                                   linewidth=2.5 if show_markers else 1.5)[0]
                     
                     # Add marker points with contrasting color
-                    ax.scatter(x_numeric, y_values, color=line.get_color(), s=80, zorder=5, 
-                               edgecolor='white', linewidth=1.5)
+                    if show_markers:
+                        ax.scatter(x_plot, y_plot, color=line.get_color(), s=80, zorder=5,
+                                   edgecolor='white', linewidth=1.5)
                     
                     # Add grid but only on the y-axis
                     ax.grid(axis='y', linestyle='--', alpha=0.7)
                     
-                    # Add value labels above points
-                    for i, (x, y) in enumerate(zip(x_numeric, y_values)):
-                        ax.annotate(f'{y:.1f}', (x, y), textcoords="offset points", 
-                                   xytext=(0, 10), ha='center')
-                    
-                    # But use original labels for the x-axis
-                    ax.set_xticks(x_numeric)
-                    ax.set_xticklabels(x_labels, rotation=45 if any(len(str(x)) > 5 for x in x_labels) else 0)
+                    # Add value labels above points, but use original labels for the x-axis
+                    draw_series_labels(ax, x_plot, y_plot, x_numeric, x_labels)
                     
                     # Set y-axis to start at 0 unless all values are negative
-                    if any(y < 0 for y in y_values):
+                    if (y_values < 0).any():
                         # If we have negative values, add some padding
-                        y_min = min(y_values) * 1.1
+                        y_min = y_values.min() * 1.1
                     else:
                         y_min = 0
                         
                     # Add some headroom above the highest point
-                    y_max = max(y_values) * 1.15
+                    y_max = y_values.max() * 1.15
                     
                     # Set the y limits
                     ax.set_ylim(y_min, y_max)
@@ -699,11 +3930,11 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
         elif chart_type == 'pie':
             # Get labels and sizes, ensuring they're primitive types
             try:
-                labels = [str(label) for label in chart_data.get('labels', chart_data['x_values'])]
+                labels = [str(label) for label in (chart_data['labels'] if 'labels' in chart_data else chart_data['x_values'])]
                 
                 # Handle y_values that might be dictionaries or other unhashable types
                 sizes = []
-                for size in chart_data.get('sizes', chart_data['y_values']):
+                for size in (chart_data['sizes'] if 'sizes' in chart_data else chart_data['y_values']):
                     if isinstance(size, (int, float)):
                         sizes.append(max(0, size))  # Ensure positive
                     else:
@@ -756,7 +3987,10 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                             y_vals.append(i)  # Use index as default y value
                 
                 # Handle categories if present
-                if len(x_vals) > 0:
+                if len(x_vals) > DENSITY_POINT_THRESHOLD:
+                    # Too many markers to draw or read; categories can't be shown on the density grid
+                    draw_density(plt.gca(), x_vals, y_vals, palette)
+                elif len(x_vals) > 0:
                     categories = chart_data.get('categories')
                     if categories and len(categories) > 0:
                         if len(categories) != len(x_vals):
@@ -778,20 +4012,25 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                 logger.error(f"Error in scatter plot: {str(e)}")
                 raise DiagramError(f"Could not generate scatter plot: {str(e)}")
             
+        elif chart_type == 'histogram' and 'bin_edges' in chart_data:
+            try:
+                # Pre-binned counts (e.g. from an uploaded file)
+                draw_histogram(plt.gca(), chart_data['bin_edges'], chart_data['counts'])
+            except Exception as e:
+                logger.error(f"Error in histogram: {str(e)}")
+                raise DiagramError(f"Could not generate histogram: {str(e)}")
+
         elif chart_type == 'histogram':
             try:
                 # Convert to numeric values, skipping non-numeric
-                values = []
-                for y in chart_data['y_values']:
-                    try:
-                        values.append(float(y) if not isinstance(y, (int, float)) else y)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Skipping non-numeric histogram value: {y}")
-                        # Skip non-numeric values
-                        continue
+                values = pd.to_numeric(pd.Series(chart_data['y_values']), errors='coerce').to_numpy(dtype=float)
+                skipped = int(np.count_nonzero(~np.isfinite(values)))
+                if skipped:
+                    logger.warning(f"Skipping {skipped} non-numeric histogram values")
                 
-                if len(values) > 0:
-                    sns.histplot(values, bins=min(10, len(values)), kde=True)
+                binned = bin_values(values)
+                if binned is not None:
+                    draw_histogram(plt.gca(), *binned)
                 else:
                     raise DiagramError("No valid numeric data for histogram")
             except Exception as e:
@@ -809,69 +4048,37 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                 if not z_values and data_source == 'user_specified':
                     raise DiagramError("User-provided data does not contain the required 'z_values' (2D array) for a heatmap.")
                 
-                # If z_values are missing and AI generated, the AI should have generated them. If not, raise error.
-                elif not z_values and data_source == 'ai_generated':
-                     # Attempt to create a simple 2D array based on x_values and y_values as a fallback for AI data
-                    logger.warning("AI-generated data missing 'z_values' for heatmap, attempting fallback generation.")
-                    x_len = min(5, len(chart_data['x_values']))
-                    y_len = min(5, len(chart_data['y_values']))
-                    
-                    # Check if y_values is empty or too short
-                    if not chart_data['y_values']:
-                         raise DiagramError("Cannot generate heatmap fallback: 'y_values' is empty.")
-
-                    new_z_values = []
-                    for i in range(y_len):
-                        row = []
-                        for j in range(x_len):
-                            y_idx = (i * x_len + j) % len(chart_data['y_values']) # Use modulo
-                            try:
-                                val = float(chart_data['y_values'][y_idx])
-                            except (ValueError, TypeError):
-                                val = i + j  # Fallback value
-                            row.append(val)
-                        new_z_values.append(row)
-                    z_values = new_z_values # Assign the generated fallback
-                    logger.info(f"Generated fallback z_values for heatmap: {json.dumps(z_values)}")
-
                 elif not z_values:
-                     raise DiagramError("Heatmap requires 'z_values' data (2D array), which was not found or generated.")
+                     raise DiagramError("Heatmap requires 'z_values' data (2D array), which was not found.")
 
                 if z_values and isinstance(z_values, list):
                     # Ensure z_values is a proper 2D array of numeric values
-                    processed_z = []
-                    for row in z_values:
-                        if not isinstance(row, list):
-                            # Convert non-list rows to a list with a single item
-                            processed_row = [float(row) if isinstance(row, (int, float)) else 0]
-                        else:
-                            # Process each cell in the row
-                            processed_row = [float(cell) if isinstance(cell, (int, float)) else 0 for cell in row]
-                        processed_z.append(processed_row)
-                    
-                    # Make sure all rows have the same length
-                    max_len = max(len(row) for row in processed_z)
-                    for i, row in enumerate(processed_z):
-                        if len(row) < max_len:
-                            processed_z[i] = row + [0] * (max_len - len(row))
+                    matrix = heatmap_matrix(z_values)
+                    rows, columns = matrix.shape
                     
                     # Convert labels to strings
                     x_labels = [str(x) for x in chart_data['x_values']]
                     y_labels = [str(y) for y in chart_data.get('y_labels', chart_data['y_values'])]
                     
                     # Limit labels to the actual data dimensions
-                    x_labels = x_labels[:len(processed_z[0])]
-                    y_labels = y_labels[:len(processed_z)]
+                    x_labels = x_labels[:columns]
+                    y_labels = y_labels[:rows]
                     
                     # If we have too few labels, add placeholders
-                    if len(x_labels) < len(processed_z[0]):
-                        x_labels += [f"Col {i+1}" for i in range(len(x_labels), len(processed_z[0]))]
-                    if len(y_labels) < len(processed_z):
-                        y_labels += [f"Row {i+1}" for i in range(len(y_labels), len(processed_z))]
+                    if len(x_labels) < columns:
+                        x_labels += [f"Col {i+1}" for i in range(len(x_labels), columns)]
+                    if len(y_labels) < rows:
+                        y_labels += [f"Row {i+1}" for i in range(len(y_labels), rows)]
+                    
+                    if HEATMAP_MAX_SIDE and max(rows, columns) > HEATMAP_MAX_SIDE:
+                        matrix, x_labels, y_labels = block_aggregate(matrix, x_labels, y_labels, HEATMAP_MAX_SIDE)
                     
-                    # Create the heatmap with our processed data
-                    sns.heatmap(processed_z, annot=True, cmap=palette, 
-                                xticklabels=x_labels, yticklabels=y_labels)
+                    # Value labels only while they stay readable; larger matrices are drawn as one image
+                    if matrix.size <= HEATMAP_ANNOTATE_MAX_CELLS:
+                        sns.heatmap(matrix, annot=True, cmap=palette,
+                                    xticklabels=x_labels, yticklabels=y_labels)
+                    else:
+                        draw_heatmap_image(plt.gca(), matrix, x_labels, y_labels, palette)
                 else:
                     raise DiagramError("Heatmap requires z_values data as a 2D array")
             except Exception as e:
@@ -895,26 +4102,8 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                     else:
                         raise DiagramError("User-provided data does not contain the required 'distributions' (list of lists or list of values) for a boxplot.")
 
-                # If distributions are missing and AI generated, the AI should have generated them.
-                elif not distributions and data_source == 'ai_generated':
-                     # Attempt to generate fallback distributions for AI data
-                    logger.warning("AI-generated data missing 'distributions' for boxplot, attempting fallback generation.")
-                    new_distributions = []
-                    if not chart_data.get('y_values'):
-                         raise DiagramError("Cannot generate boxplot fallback: 'y_values' is empty.")
-                         
-                    for y in chart_data['y_values']:
-                        try:
-                            base = float(y) if not isinstance(y, (int, float)) else y
-                            dist = np.random.normal(base, base * 0.2 + 1, 20).tolist()
-                            new_distributions.append(dist)
-                        except (ValueError, TypeError):
-                            new_distributions.append(np.random.normal(5, 2, 20).tolist())
-                    distributions = new_distributions
-                    logger.info("Generated fallback distributions for boxplot.")
-
                 elif not distributions:
-                     raise DiagramError("Boxplot requires 'distributions' data, which was not found or generated.")
+                     raise DiagramError("Boxplot requires 'distributions' data, which was not found.")
 
                 # Get groups and ensure they're strings
                 groups = [str(g) for g in chart_data.get('groups', chart_data['x_values'])]
@@ -939,10 +4128,10 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                         
                         if processed_dists:
                             # Create a dataframe for the plot
-                            import pandas as pd
                             # Ensure we don't have more distributions than groups
                             valid_groups = groups[:len(processed_dists)]
-                            data_dict = {group: dist for group, dist in zip(valid_groups, processed_dists)}
+                            # Series pad unequal distributions with NaN, which seaborn skips
+                            data_dict = {group: pd.Series(dist, dtype=float) for group, dist in zip(valid_groups, processed_dists)}
                             df = pd.DataFrame(data_dict)
                             sns.boxplot(data=df, palette=palette)
                         else:
@@ -986,24 +4175,8 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                      else:
                          raise DiagramError("User-provided data does not contain the required 'distributions' (list of lists or list of values) for a violin plot.")
 
-                elif not distributions and data_source == 'ai_generated':
-                    logger.warning("AI-generated data missing 'distributions' for violin plot, attempting fallback generation.")
-                    new_distributions = []
-                    if not chart_data.get('y_values'):
-                         raise DiagramError("Cannot generate violin plot fallback: 'y_values' is empty.")
-
-                    for y in chart_data['y_values']:
-                        try:
-                            base = float(y) if not isinstance(y, (int, float)) else y
-                            dist = np.random.normal(base, base * 0.2 + 1, 20).tolist()
-                            new_distributions.append(dist)
-                        except (ValueError, TypeError):
-                            new_distributions.append(np.random.normal(5, 2, 20).tolist())
-                    distributions = new_distributions
-                    logger.info("Generated fallback distributions for violin plot.")
-
                 elif not distributions:
-                    raise DiagramError("Violin plot requires 'distributions' data, which was not found or generated.")
+                    raise DiagramError("Violin plot requires 'distributions' data, which was not found.")
 
                 # Similar approach as boxplot
                 groups = [str(g) for g in chart_data.get('groups', chart_data['x_values'])]
@@ -1026,10 +4199,10 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                         
                         if processed_dists:
                             # Create a dataframe for the plot
-                            import pandas as pd
                             # Ensure we don't have more distributions than groups
                             valid_groups = groups[:len(processed_dists)]
-                            data_dict = {group: dist for group, dist in zip(valid_groups, processed_dists)}
+                            # Series pad unequal distributions with NaN, which seaborn skips
+                            data_dict = {group: pd.Series(dist, dtype=float) for group, dist in zip(valid_groups, processed_dists)}
                             df = pd.DataFrame(data_dict)
                             sns.violinplot(data=df, palette=palette)
                         else:
@@ -1060,66 +4233,27 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
         elif chart_type == 'area':
             try:
                 # Similar to line chart but with filled area
-                x_vals = []
-                y_vals = []
-                pairs = []
-                
-                for i, (x, y) in enumerate(zip(chart_data['x_values'], chart_data['y_values'])):
-                    try:
-                        # Convert x to numeric if possible
-                        if isinstance(x, (int, float)):
-                            x_val = x
-                        elif isinstance(x, str):
-                            try:
-                                x_val = float(x)
-                            except ValueError:
-                                # Try to parse as date
-                                try:
-                                    parsed_date = date_parser.parse(x, fuzzy=True)
-                                    x_val = datetime.datetime.timestamp(parsed_date)
-                                except (ValueError, TypeError):
-                                    x_val = i
-                        else:
-                            x_val = i
-                        
-                        # Convert y to float
-                        y_val = float(y) if not isinstance(y, (int, float)) else y
-                        
-                        pairs.append((x_val, y_val, x))  # Keep original x for labels
-                    except (ValueError, TypeError):
-                        pairs.append((i, 0 if not isinstance(y, (int, float)) else y, x))
-                
-                # Sort by x value
-                pairs.sort(key=lambda pair: pair[0])
+                x_numeric, y_values, x_labels = sorted_series(chart_data['x_values'], chart_data['y_values'])
                 
-                # Extract sorted values
-                x_numeric = [pair[0] for pair in pairs]
-                y_values = [pair[1] for pair in pairs]
-                x_labels = [pair[2] for pair in pairs]
-                
-                if len(pairs) > 1:
+                if len(x_numeric) > 1:
                     fig, ax = plt.subplots(figsize=(12, 7))
-                    ax.fill_between(x_numeric, y_values, alpha=0.4)
-                    ax.plot(x_numeric, y_values, linewidth=2.5)
+                    x_plot, y_plot = decimate_series(ax, x_numeric, y_values)
+                    ax.fill_between(x_plot, y_plot, alpha=0.4)
+                    ax.plot(x_plot, y_plot, linewidth=2.5 if len(x_plot) <= SERIES_MAX_MARKERS else 1.5)
                     
                     # Add markers
-                    ax.scatter(x_numeric, y_values, s=80, zorder=5, edgecolor='white', linewidth=1.5)
+                    if len(x_plot) <= SERIES_MAX_MARKERS:
+                        ax.scatter(x_plot, y_plot, s=80, zorder=5, edgecolor='white', linewidth=1.5)
                     
                     # Add grid
                     ax.grid(axis='y', linestyle='--', alpha=0.7)
                     
-                    # Add value labels
-                    for i, (x, y) in enumerate(zip(x_numeric, y_values)):
-                        ax.annotate(f'{y:.1f}', (x, y), textcoords="offset points", 
-                                   xytext=(0, 10), ha='center')
-                    
-                    # Set x-axis labels
-                    ax.set_xticks(x_numeric)
-                    ax.set_xticklabels(x_labels, rotation=45 if any(len(str(x)) > 5 for x in x_labels) else 0)
+                    # Add value labels and x-axis labels
+                    draw_series_labels(ax, x_plot, y_plot, x_numeric, x_labels)
                     
                     # Set y limits
-                    y_min = min(y_values) * 1.1 if any(y < 0 for y in y_values) else 0
-                    y_max = max(y_values) * 1.15
+                    y_min = y_values.min() * 1.1 if (y_values < 0).any() else 0
+                    y_max = y_values.max() * 1.15
                     ax.set_ylim(y_min, y_max)
                     
                     plt.close(plt_fig)
@@ -1186,7 +4320,9 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                     except (ValueError, TypeError):
                         continue
                 
-                if len(x_vals) > 0:
+                if len(x_vals) > DENSITY_POINT_THRESHOLD:
+                    draw_binned_bubbles(plt.gca(), x_vals, y_vals, sizes, palette)
+                elif len(x_vals) > 0:
                     plt.scatter(x=x_vals, y=y_vals, s=sizes, alpha=0.6)
                 else:
                     raise DiagramError("No valid data points for bubble chart")
@@ -1311,7 +4447,7 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                         sizes_normalized = sizes_numeric
                     
                     # Create colors using the specified palette
-                    cmap = plt.cm.get_cmap(palette)
+                    cmap = matplotlib.colormaps[palette]
                     colors = [cmap(i / len(labels)) for i in range(len(labels))]
                     
                     # Plot the treemap
@@ -1369,7 +4505,7 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
                     bar_positions = range(len(stages))
                     
                     # Get colormap from palette
-                    cmap = plt.cm.get_cmap(palette)
+                    cmap = matplotlib.colormaps[palette]
                     colors = cmap(np.linspace(0, 1, len(stages)))
                     
                     # Plot bars with different widths to create funnel effect
@@ -1430,16 +4566,16 @@ def generate_chart_image(chart_type, chart_data, parsed_info):
         plt.xlabel(parsed_info['x_axis'], fontsize=12)
         plt.ylabel(parsed_info['y_axis'], fontsize=12)
         plt.tight_layout()
+        record_stage_timing("render", time.perf_counter() - render_started)
         
         # Save the plot to a bytes buffer
+        encode_started = time.perf_counter()
         buffer = io.BytesIO()
-        plt_fig.savefig(buffer, format='png', dpi=150)
-        buffer.seek(0)
-        
-        # Encode the image to base64
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        plt_fig.savefig(buffer, format='png', dpi=CHART_DPI)
+        png_bytes = buffer.getvalue()
+        record_stage_timing("png_encode", time.perf_counter() - encode_started)
         
-        return image_base64
+        return png_bytes
         
     except Exception as e:
         logger.error(f"Error generating {chart_type} chart: {str(e)}", exc_info=True)
@@ -1531,6 +4667,51 @@ def get_chart_types():
         ]
     })
 
+def enhance_user_prompt(prompt):
+    """Ask Gemini to rewrite a prompt so it produces exactly the visualization the user wants"""
+    enhancement_prompt = f"""
+    You are an expert data visualization consultant that helps users create precise, accurate chart prompts.
+    
+    ORIGINAL USER REQUEST: "{prompt}"
+    
+    Your task is to enhance this request to ensure it produces EXACTLY the visualization the user wants.
+    
+    ENHANCEMENT REQUIREMENTS:
+    1. Maintain the user's original intent and data requirements
+    2. If the user specified exact data values or series, HIGHLIGHT and PRESERVE those specifications
+    3. Add precise details about:
+       - Axis labels with proper units
+       - Title/subtitle that clearly explains the visualization
+       - Data ranges or distributions if relevant
+       - Color schemes or styling preferences if appropriate
+    4. Clarify ambiguities in the original request
+    5. Ensure the enhanced prompt will produce a chart that accurately represents the user's data
+    
+    IMPORTANT FORMAT RULES:
+    - Keep your response concise and only 150 WORDS (max 3-4 sentences)
+    - Maintain the user's tone and terminology
+    - Return ONLY the enhanced prompt with no explanations or additional text
+    - DO NOT add "Chart showing..." or similar phrases unless part of the original prompt
+    - DO NOT add placeholder data unless the user explicitly asks for examples
+    """
+    
+    # Use Gemini model to enhance the prompt
+    enhanced_prompt = generate_model_text(enhancement_prompt, "enhance").strip()
+    
+    # Ensure we're not getting a response that includes markdown formatting or explanations
+    if "```" in enhanced_prompt or "Here's an enhanced prompt:" in enhanced_prompt:
+        # Extract just the prompt part
+        pattern = r'```(?:.*?)\n(.*?)```|Here\'s an enhanced prompt:(.*?)$'
+        match = re.search(pattern, enhanced_prompt, re.DOTALL)
+        if match:
+            if match.group(1):  # If found in code block
+                enhanced_prompt = match.group(1).strip()
+            elif match.group(2):  # If found after "Here's an enhanced prompt:"
+                enhanced_prompt = match.group(2).strip()
+    
+    logger.info(f"Enhanced prompt: {enhanced_prompt}")
+    return enhanced_prompt
+
 @app.route('/api/enhance-prompt', methods=['POST'])
 @handle_errors
 @limiter.limit("15 per minute")
@@ -1541,57 +4722,45 @@ def enhance_prompt():
     if not prompt:
         return jsonify({"error": "No prompt provided"}), 400
     
+    bypass = wants_cache_bypass()
+    cache_bypass.set(bypass)
+    
     try:
-        # Use Gemini model to enhance the prompt
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        enhancement_prompt = f"""
-        You are an expert data visualization consultant that helps users create precise, accurate chart prompts.
-        
-        ORIGINAL USER REQUEST: "{prompt}"
-        
-        Your task is to enhance this request to ensure it produces EXACTLY the visualization the user wants.
-        
-        ENHANCEMENT REQUIREMENTS:
-        1. Maintain the user's original intent and data requirements
-        2. If the user specified exact data values or series, HIGHLIGHT and PRESERVE those specifications
-        3. Add precise details about:
-           - Axis labels with proper units
-           - Title/subtitle that clearly explains the visualization
-           - Data ranges or distributions if relevant
-           - Color schemes or styling preferences if appropriate
-        4. Clarify ambiguities in the original request
-        5. Ensure the enhanced prompt will produce a chart that accurately represents the user's data
-        
-        IMPORTANT FORMAT RULES:
-        - Keep your response concise and only 150 WORDS (max 3-4 sentences)
-        - Maintain the user's tone and terminology
-        - Return ONLY the enhanced prompt with no explanations or additional text
-        - DO NOT add "Chart showing..." or similar phrases unless part of the original prompt
-        - DO NOT add placeholder data unless the user explicitly asks for examples
-        """
-        
-        response = model.generate_content(enhancement_prompt)
-        enhanced_prompt = response.text.strip()
-        
-        # Ensure we're not getting a response that includes markdown formatting or explanations
-        if "```" in enhanced_prompt or "Here's an enhanced prompt:" in enhanced_prompt:
-            # Extract just the prompt part
-            pattern = r'```(?:.*?)\n(.*?)```|Here\'s an enhanced prompt:(.*?)$'
-            match = re.search(pattern, enhanced_prompt, re.DOTALL)
-            if match:
-                if match.group(1):  # If found in code block
-                    enhanced_prompt = match.group(1).strip()
-                elif match.group(2):  # If found after "Here's an enhanced prompt:"
-                    enhanced_prompt = match.group(2).strip()
-        
-        logger.info(f"Enhanced prompt: {enhanced_prompt}")
+        # Identical prompts already being enhanced share the in-flight result
+        enhanced_prompt = single_flight.do(
+            ("enhance", normalize_prompt_key(prompt), bypass),
+            lambda: enhance_user_prompt(prompt)
+        )
         return jsonify({"enhanced_prompt": enhanced_prompt})
         
+    except DiagramError:
+        raise
     except Exception as e:
         logger.error(f"Error enhancing prompt: {str(e)}")
         return jsonify({"error": f"Failed to enhance prompt: {str(e)}"}), 500
 
+@app.route('/api/stats', methods=['GET'])
+@limiter.limit("30 per minute")
+def get_stats():
+    stats = {"response_cache": response_cache.get_stats()}
+    if disk_cache:
+        stats["disk_cache"] = disk_cache.get_stats()
+    stats["near_duplicate_cache"] = near_duplicate_cache.get_stats()
+    stats["jobs"] = job_store.get_stats()
+    stats["single_flight"] = single_flight.get_stats()
+    stats["circuit_breaker"] = model_breaker.get_stats()
+    with recommendation_path_lock:
+        stats["recommendation_paths"] = dict(recommendation_path_stats)
+    with json_repair_lock:
+        stats["json_repairs"] = dict(json_repair_stats)
+    stats["spec_store"] = spec_store.get_stats()
+    stats["render_cache"] = render_cache.get_stats()
+    stats["dataset_registry"] = dataset_registry.get_stats()
+    stats["timings"] = timing_stats.get_stats()
+    if recommendation_batcher:
+        stats["recommendation_batching"] = dict(recommendation_batcher.stats)
+    return jsonify(stats)
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', debug=os.environ.get("DEBUG", "True").lower() == "true", port=port)
\ No newline at end of file
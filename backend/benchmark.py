@@ -0,0 +1,93 @@
+"""Benchmark the diagram pipeline and chart rendering without network access
+
+Record model responses once with a real API key:
+    LLM_BACKEND=record python benchmark.py --runs 1 "Compare monthly sales for 2023"
+then replay them on a laptop or in CI, optionally with simulated model latency:
+    LLM_BACKEND=replay LLM_REPLAY_LATENCY_MS=400 python benchmark.py --runs 20 "Compare monthly sales for 2023"
+"""
+import argparse
+import logging
+import os
+import statistics
+import time
+
+import numpy as np
+
+os.environ.setdefault("LLM_BACKEND", "replay")
+import app  # noqa: E402  (must see LLM_BACKEND first)
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def report(name, samples):
+    print(f"{name:<28} n={len(samples):<4} mean={statistics.mean(samples) * 1000:8.1f}ms "
+          f"p50={percentile(samples, 50) * 1000:8.1f}ms p95={percentile(samples, 95) * 1000:8.1f}ms")
+
+def sample_chart_data(schema, points, rng):
+    """Build a payload matching a chart data schema"""
+    if schema["type"] == "object":
+        return {field: sample_chart_data(field_schema, points, rng)
+                for field, field_schema in schema["properties"].items() if field != "data_source"}
+    items = schema["items"]
+    if items["type"] == "array":
+        return [sample_chart_data(items, points, rng) for _ in range(points)]
+    if items["type"] == "number":
+        return [round(float(v), 2) for v in rng.uniform(1, 100, points)]
+    return [f"Item {i + 1}" for i in range(points)]
+
+def benchmark_rendering(runs, points):
+    rng = np.random.default_rng(0)
+    parsed_info = {"title": "Benchmark", "subtitle": None, "x_axis": "X", "y_axis": "Y", "palette": "viridis"}
+    for chart_type, schema in app.CHART_DATA_SCHEMAS.items():
+        chart_data = sample_chart_data(schema, points, rng)
+        app.validate_chart_data(chart_type, chart_data)
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            app.generate_chart_image(chart_type, chart_data, dict(parsed_info))
+            samples.append(time.perf_counter() - started)
+        report(f"render {chart_type}", samples)
+
+def benchmark_pipeline(prompts, runs):
+    samples = []
+    failures = 0
+    for _ in range(runs):
+        for prompt in prompts:
+            # Skip the response caches so every run exercises the backend
+            token = app.cache_bypass.set(True)
+            started = time.perf_counter()
+            try:
+                app.run_diagram_pipeline(prompt)
+            except app.DiagramError as e:
+                failures += 1
+                print(f"pipeline failed: {e.message}")
+            finally:
+                app.cache_bypass.reset(token)
+            samples.append(time.perf_counter() - started)
+            # The pipeline falls back past missing fixtures, which would time the fallbacks instead of the replay
+            missing = sorted(getattr(app.llm_backend, "missing_keys", ()))
+            if missing:
+                raise SystemExit(f"No recorded responses for fixtures {', '.join(missing)} in {app.LLM_FIXTURES_DIR}; "
+                                 f"record them with LLM_BACKEND=record")
+    report("pipeline", samples)
+    if failures:
+        print(f"{failures} pipeline runs failed")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompts", nargs="*", help="Diagram prompts to run through the full pipeline")
+    parser.add_argument("--runs", type=int, default=5, help="Repetitions of each measurement")
+    parser.add_argument("--points", type=int, default=12, help="Data points per chart in the rendering benchmark")
+    parser.add_argument("--skip-render", action="store_true", help="Only benchmark the pipeline")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"LLM backend: {app.llm_backend.name}")
+    if not args.skip_render:
+        benchmark_rendering(args.runs, args.points)
+    if args.prompts:
+        benchmark_pipeline(args.prompts, args.runs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("LLM_BACKEND", "replay")
+os.environ["DISK_CACHE_PATH"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+class StubBackend:
+    """Answers each pipeline prompt with a fixed, well-formed response"""
+    name = "stub"
+
+    def __init__(self):
+        self.prompts = []
+        self.generation_configs = []
+        # The answer to data generation calls; tests swap in malformed payloads
+        self.chart_data = {"x_values": ["a", "b", "c"], "y_values": [1, 2, 3], "labels": ["a", "b", "c"], "sizes": [1, 2, 3]}
+
+    def generate(self, prompt, generation_config=None, timeout=None):
+        self.prompts.append(prompt)
+        self.generation_configs.append(generation_config)
+        if "recommended_chart_types" in prompt:
+            text = {"recommended_chart_types": [{"chart_type": t, "reason": "r"} for t in ("bar", "line", "pie")]}
+        elif "GENERAL visualization requirements" in prompt:
+            text = {"data_description": "d", "x_axis": "X", "y_axis": "Y", "title": "T", "subtitle": None, "palette": None}
+        elif "data extraction expert" in prompt:
+            text = {"exact_data_provided": False, "data_specifications": "some data", "x_axis": "X", "y_axis": "Y",
+                    "title": "T", "subtitle": None}
+        else:
+            text = self.chart_data
+        return json.dumps(text), {"prompt_tokens": len(prompt) // 4, "response_tokens": 10}
+
+@pytest.fixture
+def stub_backend(monkeypatch):
+    backend = StubBackend()
+    monkeypatch.setattr(app_module, "llm_backend", backend)
+    return backend
+
+@pytest.fixture
+def client(stub_backend):
+    app_module.limiter.enabled = False
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
@@ -0,0 +1,56 @@
+import pytest
+
+import app as app_module
+
+GENERAL_INFO = {"data_description": "d", "x_axis": "X", "y_axis": "Y", "title": "T", "subtitle": None, "palette": None}
+
+@pytest.fixture
+def bypass_cache():
+    token = app_module.cache_bypass.set(True)
+    yield
+    app_module.cache_bypass.reset(token)
+
+def test_data_generation_is_constrained_by_the_chart_schema(stub_backend, bypass_cache):
+    stub_backend.chart_data = {"x_values": ["Jan", "Feb", "Mar"], "y_values": [3, 5, 4]}
+    chart = app_module.build_chart({"chart_type": "line"}, "Show the sales trend", dict(GENERAL_INFO), render_images=False)
+    assert chart["chart_data"]["y_values"] == [3, 5, 4]
+    assert chart["chart_data"]["data_source"] == "ai_generated"
+    assert app_module.chart_data_generation_config("line") in stub_backend.generation_configs
+    assert stub_backend.generation_configs[-1]["response_schema"] is app_module.CHART_DATA_SCHEMAS["line"]
+
+@pytest.mark.parametrize("payload", [
+    {"x_values": ["a", "b"], "y_values": [1]},
+    {"x_values": ["a", "b"], "y_values": ["one", "two"]},
+    {"x_values": ["a", "b"]},
+])
+def test_malformed_generated_data_is_rejected_before_rendering(stub_backend, bypass_cache, payload):
+    stub_backend.chart_data = payload
+    with pytest.raises(app_module.DiagramError, match="Invalid chart data"):
+        app_module.build_chart({"chart_type": "bar"}, "Compare sales by region", dict(GENERAL_INFO), render_images=False)
+
+@pytest.mark.parametrize("chart_type, chart_data, message", [
+    ("pie", {"labels": ["a", "b"], "sizes": [1, 2, 3]}, "same length"),
+    ("scatter", {"x_values": ["a", "b"], "y_values": [1, 2]}, "x_values[0] must be a number"),
+    ("bar", {"x_values": "a,b", "y_values": [1, 2]}, "x_values must be a list"),
+    ("heatmap", {"x_values": ["a", "b"], "y_values": ["r"], "z_values": [[1]]}, "one value per x_values entry"),
+    ("boxplot", {"x_values": ["a"], "distributions": [[]]}, "must not be empty"),
+    ("funnel", ["stages", "values"], "chart_data must be an object"),
+    # Unknown chart types are rendered, and so checked, as bar charts
+    ("sunburst", {"labels": ["a"], "sizes": [1]}, "x_values is required"),
+])
+def test_invalid_payloads_are_rejected(chart_type, chart_data, message):
+    with pytest.raises(app_module.DiagramError) as raised:
+        app_module.validate_chart_data(chart_type, chart_data)
+    assert message in raised.value.message
+
+@pytest.mark.parametrize("chart_type", sorted(app_module.CHART_DATA_SCHEMAS))
+def test_every_schema_accepts_its_own_shape(chart_type):
+    schema = app_module.CHART_DATA_SCHEMAS[chart_type]
+    sample = {"string": "a", "number": 1.5}
+    chart_data = {}
+    for field, field_schema in schema["properties"].items():
+        if field == "data_source":
+            continue
+        items = field_schema["items"]
+        chart_data[field] = [[1, 2]] * 2 if items["type"] == "array" else [sample[items["type"]]] * 2
+    app_module.validate_chart_data(chart_type, chart_data)
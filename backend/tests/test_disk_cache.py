@@ -0,0 +1,42 @@
+import sqlite3
+
+import app as app_module
+
+def last_access(path, cache, key):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT last_access FROM stage_cache WHERE key = ?", (cache.make_key("parse", key),)).fetchone()[0]
+
+def test_hits_record_access_time_with_the_next_write(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = app_module.DiskResponseCache(path, max_bytes=1024 * 1024, schema_version=app_module.prompt_template_version())
+    cache.set("parse", "first", {"title": "A"})
+    written = last_access(path, cache, "first")
+
+    assert cache.get("parse", "first") == {"title": "A"}
+    assert last_access(path, cache, "first") == written
+    assert cache.make_key("parse", "first") in cache.pending_touches
+
+    cache.set("parse", "second", {"title": "B"})
+    assert last_access(path, cache, "first") > written
+    assert not cache.pending_touches
+
+def test_hit_is_served_while_another_process_holds_the_write_lock(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = app_module.DiskResponseCache(path, max_bytes=1024 * 1024, schema_version=1)
+    cache.set("parse", "prompt", {"title": "A"})
+    writer = sqlite3.connect(path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        assert cache.get("parse", "prompt") == {"title": "A"}
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+    assert cache.stats["errors"] == 0
+    assert cache.stats["hits"] == 1
+
+def test_entries_of_other_template_versions_are_purged(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    app_module.DiskResponseCache(path, max_bytes=1024 * 1024, schema_version=1).set("parse", "prompt", {"title": "A"})
+    cache = app_module.DiskResponseCache(path, max_bytes=1024 * 1024, schema_version=2)
+    assert cache.get("parse", "prompt") is None
+    assert cache.get_stats()["entries"] == 0
@@ -0,0 +1,40 @@
+import pytest
+
+import app as app_module
+
+def test_bracketed_prose_before_the_object_is_skipped():
+    text = 'As noted in [1], here is the data:\n{"x_values": ["a", "b"], "y_values": [1, 2]}'
+    value, repairs = app_module.parse_gemini_json_with_repairs(text)
+    assert value == {"x_values": ["a", "b"], "y_values": [1, 2]}
+    assert "leading_brackets" in repairs
+
+def test_bracketed_prose_before_a_damaged_object_is_skipped():
+    text = "See [note] below. {'title': 'Sales', 'values': [1, 2, 3,],}"
+    value, _ = app_module.parse_gemini_json_with_repairs(text)
+    assert value == {"title": "Sales", "values": [1, 2, 3]}
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"a": [1, {"b": 2}]}\n```', {"a": [1, {"b": 2}]}),
+    ('[{"chart_type": "bar"}, {"chart_type": "line"}]', [{"chart_type": "bar"}, {"chart_type": "line"}]),
+    ('{"a": [1, 2', {"a": [1, 2]}),
+])
+def test_single_payload_is_parsed_as_before(text, expected):
+    assert app_module.parse_gemini_json(text) == expected
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"x_values": [Jan, Feb, Mar], "y_values": [1, 2, 3]}', {"x_values": ["Jan", "Feb", "Mar"], "y_values": [1, 2, 3]}),
+    ('{"city": New York, "count": None}', {"city": "New York", "count": None}),
+    ("{title: Sales, visible: True}", {"title": "Sales", "visible": True}),
+])
+def test_bare_words_are_quoted_not_nulled(text, expected):
+    value, repairs = app_module.parse_gemini_json_with_repairs(text)
+    assert value == expected
+    assert "bare_values" in repairs or "unquoted_keys" in repairs
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"range": 1-5, "count": 2}', {"range": "1-5", "count": 2}),
+    ('{"x_values": [2023-01-05, 2023-01-06], "y_values": [-3.5, .5]}',
+     {"x_values": ["2023-01-05", "2023-01-06"], "y_values": [-3.5, 0.5]}),
+])
+def test_bare_tokens_with_dashes_are_kept_as_strings(text, expected):
+    assert app_module.parse_gemini_json(text) == expected
@@ -0,0 +1,19 @@
+import pytest
+
+import app as app_module
+
+@pytest.mark.parametrize("prompt, top", [
+    ("Q1 120, Q2 135, Q3 150, Q4 170", "line"),
+    ("Revenue Jan 10, Feb 12, Mar 15, Apr 11", "line"),
+    ("Visits 2023-01-01: 10, 2023-01-02: 12, 2023-01-03: 9", "line"),
+    ("Market share: Apple 40%, Samsung 35%, Others 25%", "pie"),
+])
+def test_inline_data_shape_is_confident_enough_to_skip_the_model(prompt, top):
+    recommendations, confidence = app_module.recommend_chart_types_locally(prompt)
+    assert recommendations[0]["chart_type"] == top
+    assert confidence >= app_module.LOCAL_RECOMMENDER_THRESHOLD
+
+def test_unordered_labels_alone_defer_to_the_model():
+    recommendations, confidence = app_module.recommend_chart_types_locally("North 120, South 90, East 70, West 60")
+    assert recommendations[0]["chart_type"] == "bar"
+    assert confidence < app_module.LOCAL_RECOMMENDER_THRESHOLD
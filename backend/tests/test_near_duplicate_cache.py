@@ -0,0 +1,34 @@
+import random
+
+import numpy as np
+
+import app as app_module
+
+WORDS = ("sales revenue profit monthly weekly quarterly region north south east west product customers orders "
+         "growth share compare trend chart show breakdown by year category store online channel").split()
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+def test_signature_estimates_jaccard():
+    cache = app_module.NearDuplicateCache(max_entries=10, threshold=0.85, num_perm=64, bands=16)
+    rng = random.Random(0)
+    errors = []
+    for _ in range(300):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+        edited = list(words)
+        for _ in range(rng.randint(0, 6)):
+            edited[rng.randrange(len(edited))] = rng.choice(WORDS)
+        first, second = cache.shingles(words), cache.shingles(edited)
+        estimate = float(np.mean(cache.signature(first) == cache.signature(second)))
+        errors.append(abs(estimate - jaccard(first, second)))
+    assert np.mean(errors) < 0.05
+    assert max(errors) < 0.25
+
+def test_small_semantic_edit_is_not_reused():
+    cache = app_module.NearDuplicateCache(max_entries=10, threshold=0.85)
+    prompt = "Show monthly revenue for the north region stores, broken down by product category and sales channel"
+    cache.store(prompt, "parse", {"title": "Monthly revenue"})
+
+    assert cache.lookup(prompt.replace("Show", "Please show"), "parse") == {"title": "Monthly revenue"}
+    assert cache.lookup(prompt.replace("monthly", "weekly"), "parse") is None
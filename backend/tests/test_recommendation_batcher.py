@@ -0,0 +1,39 @@
+import threading
+import time
+
+import app as app_module
+
+def test_waiter_returns_within_timeout_when_batch_stalls(monkeypatch):
+    release = threading.Event()
+    batcher = app_module.RecommendationBatcher(window_seconds=0.01, max_batch_size=2)
+    monkeypatch.setattr(batcher, "dispatch", lambda batch: release.wait(5))
+    started = time.monotonic()
+    assert batcher.submit("show sales by region", timeout=0.2) is None
+    assert time.monotonic() - started < 2
+    assert batcher.stats["timeouts"] == 1
+    release.set()
+
+def test_batched_call_runs_with_callers_budget(monkeypatch):
+    seen = []
+
+    def fake_generate_model_json(prompt, stage, generation_config=None):
+        seen.append(app_module.request_budget.get())
+        return {"results": [{"id": i, "recommended_chart_types": [{"chart_type": "bar"}]} for i in range(2)]}
+
+    monkeypatch.setattr(app_module, "generate_model_json", fake_generate_model_json)
+    batcher = app_module.RecommendationBatcher(window_seconds=0.2, max_batch_size=2)
+    budgets = [app_module.RequestBudget(30), app_module.RequestBudget(10)]
+    results = []
+
+    def waiter(budget, prompt):
+        app_module.request_budget.set(budget)
+        results.append(batcher.submit(prompt, timeout=5))
+
+    threads = [threading.Thread(target=waiter, args=(b, f"prompt {i}")) for i, b in enumerate(budgets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [[{"chart_type": "bar"}]] * 2
+    # The tighter of the two budgets bounds the shared call
+    assert seen == [budgets[1]]
@@ -0,0 +1,62 @@
+import pytest
+
+import app as app_module
+
+def test_missing_fixture_does_not_trip_the_breaker(monkeypatch, tmp_path):
+    backend = app_module.ReplayBackend(str(tmp_path))
+    breaker = app_module.CircuitBreaker(failure_threshold=2, reset_timeout_seconds=60)
+    monkeypatch.setattr(app_module, "llm_backend", backend)
+    monkeypatch.setattr(app_module, "model_breaker", breaker)
+    token = app_module.cache_bypass.set(True)
+    try:
+        for _ in range(3):
+            with pytest.raises(app_module.MissingFixtureError) as raised:
+                app_module.generate_model_text("an unrecorded prompt", "recommendation")
+    finally:
+        app_module.cache_bypass.reset(token)
+    assert breaker.state == "closed"
+    assert backend.missing_keys == {raised.value.key}
+
+def test_missing_fixture_frees_the_half_open_trial(monkeypatch, tmp_path):
+    breaker = app_module.CircuitBreaker(failure_threshold=1, reset_timeout_seconds=0)
+    breaker.record_failure()
+    monkeypatch.setattr(app_module, "llm_backend", app_module.ReplayBackend(str(tmp_path)))
+    monkeypatch.setattr(app_module, "model_breaker", breaker)
+    token = app_module.cache_bypass.set(True)
+    try:
+        for _ in range(3):
+            # Each call is let through as the half-open trial rather than rejected as unavailable
+            with pytest.raises(app_module.MissingFixtureError):
+                app_module.generate_model_text("an unrecorded prompt", "recommendation")
+    finally:
+        app_module.cache_bypass.reset(token)
+    assert breaker.state == "half_open"
+    assert not breaker.trial_in_flight
+    assert breaker.stats["rejected"] == 0
+
+class FailingBackend:
+    name = "failing"
+
+    def __init__(self, error):
+        self.error = error
+
+    def generate(self, prompt, generation_config=None, timeout=None):
+        raise self.error
+
+@pytest.mark.parametrize("error, opens", [
+    (app_module.google_exceptions.InvalidArgument("bad request"), False),
+    (ValueError("response was blocked"), False),
+    (app_module.google_exceptions.InternalServerError("upstream"), True),
+])
+def test_only_health_errors_count_toward_the_breaker(monkeypatch, error, opens):
+    breaker = app_module.CircuitBreaker(failure_threshold=2, reset_timeout_seconds=60)
+    monkeypatch.setattr(app_module, "llm_backend", FailingBackend(error))
+    monkeypatch.setattr(app_module, "model_breaker", breaker)
+    token = app_module.cache_bypass.set(True)
+    try:
+        for _ in range(2):
+            with pytest.raises(Exception):
+                app_module.generate_model_text("a prompt", "recommendation")
+    finally:
+        app_module.cache_bypass.reset(token)
+    assert (breaker.state == "open") is opens
@@ -0,0 +1,34 @@
+import numpy as np
+
+import app as app_module
+
+def test_series_x_positions_read_numbers_months_and_dates():
+    positions = app_module.series_x_positions(["2.5", "Mar", "jan", "Item"], month_names=True)
+    assert positions.tolist() == [2.5, 3.0, 1.0, 3.0]
+    iso = app_module.series_x_positions(["2023-01-02", "2023-01-01T12:00", "March 5, 2023"])
+    assert iso[1] < iso[0] < iso[2]
+    assert iso[0] - iso[1] == 12 * 3600
+
+def test_sorted_series_orders_by_x_and_keeps_labels():
+    x, y, labels = app_module.sorted_series(["2023-03", "2023-01", "2023-02"], [3, 1, "oops"])
+    assert np.all(np.diff(x) > 0)
+    assert y.tolist() == [1.0, 0.0, 3.0]
+    assert labels.tolist() == ["2023-01", "2023-02", "2023-03"]
+
+def test_inline_pairs_read_year_labels():
+    table = app_module.find_inline_pairs("1990 10, 2000 20, 2010 30")
+    assert table["labels"] == ["1990", "2000", "2010"]
+    assert table["series"]["Values"] == [10.0, 20.0, 30.0]
+
+    table = app_module.find_inline_pairs("Sales in 2019 were 1,200, in 2020 1,500")
+    assert table["labels"] == ["2019", "2020"]
+    assert table["series"]["Values"] == [1200.0, 1500.0]
+
+    table = app_module.find_inline_pairs("Revenue in 2019 was 1,200, in 2020 1,500, and in 2021 1,800.")
+    assert table["labels"] == ["2019", "2020", "2021"]
+    assert table["series"]["Values"] == [1200.0, 1500.0, 1800.0]
+
+def test_inline_pairs_need_three_items_unless_keyed_by_year():
+    assert app_module.find_inline_pairs("Apples 5, Pears 7") is None
+    assert app_module.find_inline_pairs("Apples 5, in 2020 7") is None
+    assert app_module.find_inline_pairs("I have 2 cats, 3 dogs") is None
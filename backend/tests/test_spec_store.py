@@ -0,0 +1,55 @@
+import app as app_module
+
+def test_images_are_bounded_by_bytes(monkeypatch):
+    store = app_module.SpecStore(max_entries=10, max_image_bytes=250)
+    spec_ids = [store.add("bar", {"x_values": ["a"], "y_values": [1]}, {}, "x" * 100) for _ in range(4)]
+    assert store.image_bytes == 200
+    assert [store.get(spec_id)["image"] is not None for spec_id in spec_ids] == [False, False, True, True]
+    assert len(store.specs) == 4
+
+    # A dropped image is rendered again when asked for
+    monkeypatch.setattr(app_module, "generate_chart_image", lambda chart_type, chart_data, parsed_info: "y" * 100)
+    _, image = store.render(spec_ids[0])
+    assert image == "y" * 100
+    assert store.image_bytes == 200
+    assert store.get(spec_ids[1])["image"] is None
+
+def test_patch_with_non_object_body_is_rejected(client):
+    spec_id = app_module.spec_store.add("bar", {"x_values": ["a"], "y_values": [1]}, {})
+    response = client.patch(f"/api/render/{spec_id}", json=["title"])
+    assert response.status_code == 400
+
+def test_patch_with_non_string_presentation_field_is_rejected(client):
+    spec_id = app_module.spec_store.add("bar", {"x_values": ["a"], "y_values": [1]}, {"title": "Old"})
+    response = client.patch(f"/api/render/{spec_id}", json={"title": {"text": "New"}})
+    assert response.status_code == 400
+    assert app_module.spec_store.get(spec_id)["parsed_info"]["title"] == "Old"
+
+def test_failed_render_leaves_the_stored_spec_unchanged(client, monkeypatch):
+    spec_id = app_module.spec_store.add("bar", {"x_values": ["a"], "y_values": [1]}, {"title": "Old"}, "old image")
+
+    def failing_render(chart_type, chart_data, parsed_info):
+        raise app_module.DiagramError("Could not draw", 500)
+
+    monkeypatch.setattr(app_module, "generate_chart_image", failing_render)
+    response = client.patch(f"/api/render/{spec_id}", json={"title": "New"})
+    assert response.status_code == 500
+    spec = app_module.spec_store.get(spec_id)
+    assert spec["parsed_info"]["title"] == "Old"
+    assert spec["image"] == "old image"
+    assert spec["version"] == 0
+
+def test_patch_stores_the_image_it_rendered(client, monkeypatch):
+    spec_id = app_module.spec_store.add("bar", {"x_values": ["a"], "y_values": [1]}, {"title": "Old"})
+    renders = []
+
+    def render(chart_type, chart_data, parsed_info):
+        renders.append(parsed_info["title"])
+        return "new image"
+
+    monkeypatch.setattr(app_module, "generate_chart_image", render)
+    response = client.patch(f"/api/render/{spec_id}", json={"title": "New"})
+    assert response.status_code == 200
+    assert response.get_json()["image"] == "new image"
+    assert app_module.spec_store.get(spec_id)["image"] == "new image"
+    assert renders == ["New"]
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+import app as app_module
+
+def test_cancelled_pipeline_makes_no_model_calls(stub_backend):
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(app_module.RequestCancelledError):
+        app_module.run_diagram_pipeline("Compare apples and pears across five shops, cancelled before it starts",
+                                        cancelled=cancelled)
+    assert stub_backend.prompts == []
+
+def test_disconnected_stream_stops_the_pipeline(client, stub_backend, monkeypatch):
+    extraction_started = threading.Event()
+    release_extraction = threading.Event()
+    stub_generate = stub_backend.generate
+
+    def slow_generate(prompt, generation_config=None, timeout=None):
+        if "data extraction expert" in prompt:
+            extraction_started.set()
+            release_extraction.wait(5)
+        return stub_generate(prompt, generation_config, timeout)
+
+    monkeypatch.setattr(stub_backend, "generate", slow_generate)
+    renders = []
+    monkeypatch.setattr(app_module, "render_chart_png", lambda *args: renders.append(args) or b"png")
+    finished = threading.Event()
+    run_pipeline = app_module.run_diagram_pipeline
+
+    def tracked_pipeline(*args, **kwargs):
+        try:
+            return run_pipeline(*args, **kwargs)
+        finally:
+            finished.set()
+
+    monkeypatch.setattr(app_module, "run_diagram_pipeline", tracked_pipeline)
+
+    response = client.post("/api/generate-diagram/stream", buffered=False,
+                           json={"prompt": "Show the yearly rainfall of three towns, streamed then abandoned"})
+    first_event = next(iter(response.response))
+    assert first_event.startswith(b"event: recommendations")
+    assert extraction_started.wait(5)
+    response.close()
+    release_extraction.set()
+
+    assert finished.wait(5)
+    # The in-flight extractions finish, but no chart data is generated and nothing is rendered
+    assert not any("data extraction expert" not in prompt and "recommended_chart_types" not in prompt
+                   and "GENERAL visualization requirements" not in prompt for prompt in stub_backend.prompts)
+    assert renders == []
+
+def test_stream_is_rejected_when_every_slot_is_taken(client, monkeypatch):
+    monkeypatch.setattr(app_module, "stream_slots", threading.BoundedSemaphore(1))
+    app_module.stream_slots.acquire()
+    response = client.post("/api/generate-diagram/stream", json={"prompt": "Any chart at all"})
+    assert response.status_code == 503
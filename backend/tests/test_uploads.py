@@ -0,0 +1,57 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+import app as app_module
+
+CSV = b"department,salary\nEngineering,120\nSales,90\nEngineering,130\nSupport,70\n"
+
+def upload(client, **fields):
+    data = dict(fields, prompt="salary by department", spec_only="true",
+                file=(io.BytesIO(CSV), "hr.csv"))
+    return client.post("/api/generate-diagram", data=data, content_type="multipart/form-data")
+
+def plain_request(client, prompt):
+    return client.post("/api/generate-diagram", json={"prompt": prompt, "spec_only": True},
+                       headers={"X-Cache-Bypass": "1"})
+
+def sources(response):
+    return {chart["chart_data"].get("data_source") for chart in response.get_json()["charts"]}
+
+def test_upload_does_not_leak_into_next_request(client, stub_backend):
+    response = upload(client)
+    assert response.status_code == 200
+    assert sources(response) == {"uploaded"}
+
+    response = plain_request(client, "Compare monthly sales for 2023")
+    assert response.status_code == 200
+    assert "uploaded" not in sources(response)
+    assert "uploaded data" not in stub_backend.prompts[-1]
+
+def test_registered_dataset_does_not_leak_into_next_request(client):
+    response = client.post("/api/datasets", data={"file": (io.BytesIO(CSV), "hr.csv")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 201
+    dataset_id = response.get_json()["dataset_id"]
+
+    response = client.post("/api/generate-diagram", json={"prompt": "salary by department", "dataset_id": dataset_id,
+                                                         "spec_only": True})
+    assert response.status_code == 200
+    assert sources(response) == {"uploaded"}
+
+    response = plain_request(client, "Compare quarterly revenue for 2022")
+    assert response.status_code == 200
+    assert "uploaded" not in sources(response)
+    assert app_module.request_dataset.get() is None
+
+def test_large_scatter_upload_reaches_density_binning():
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({"height": rng.normal(170, 10, 12000), "weight": rng.normal(70, 8, 12000)})
+    dataset = app_module.UploadedDataset("people.csv")
+    dataset.bind_columns(table.head(100), "weight by height")
+    for start in range(0, len(table), 5000):
+        dataset.update(table.iloc[start:start + 5000].copy())
+    chart_data = dataset.chart_data("scatter")
+    assert len(chart_data["x_values"]) == len(table)
+    assert len(chart_data["x_values"]) > app_module.DENSITY_POINT_THRESHOLD